@@ -11,10 +11,10 @@ import library.temporal
 def main():
 
     # Load the data from the test library, filter out everything but Jarrad's tests,
-    # and then break it into test blocks separated by 10 minutes or more of inactivity
+    # and then break it into test blocks separated by 10 minutes or more of inactivity.
+    # The lazy plan runs the filter and the blocking together in a single scan.
     tests = library.tests.TestLibrary("data")
-    tests = tests.filter({"subject": "Jarrad"})
-    test_blocks = tests.break_into_blocks()
+    test_blocks = tests.lazy().filter({"subject": "Jarrad"}).break_into_blocks().collect()
 
     # Isolate the very first of Jarrad's blocks
     first_block = test_blocks['Jarrad'][0]
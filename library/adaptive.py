@@ -0,0 +1,270 @@
+"""
+    adaptive.py
+
+    This module contains an adaptive, multi-resolution alternative to the Manifold Mapper.  The Manifold Mapper simulates
+    a uniform dense grid, but most of the solution space is smooth and all of the interesting structure sits on the
+    boundaries of the hit region and of the obstacle, so most of its simulations are spent where a handful would do.
+
+    map_manifold() starts from a coarse grid of cells and simulates their corners, the centers and the midpoints of
+    their edges with the batch engine in library.simulation, one batch per level.  A cell is split into four if its
+    points disagree in outcome or in sign, or if the closest approach at the center and edge midpoints differs from what
+    the corners predict by more than a tolerance (the curvature of the manifold in the cell is too large to interpolate
+    over it).  Refinement stops at a maximum depth, and the resulting leaves form a quadtree over a lattice as fine as
+    a uniform grid refined everywhere to that depth, while only being simulated near the boundaries.
+
+    The AdaptiveManifold it returns answers lookups by bilinear interpolation within the leaf containing each point,
+    and can be resampled to a uniform ManifoldGrid, so get_manifold_matrix and the rest of library.manifold accept it
+    like any other manifold.
+"""
+import numpy
+
+try:
+    import manifold as manifold_library
+    import simulation
+except:
+    import library.manifold as manifold_library
+    import library.simulation as simulation
+
+# The default number of coarse cells along the angle and stretch axes, the depth to which they may be refined and the
+# largest deviation (in pixels) of the closest approach from the bilinear prediction before a cell is refined
+DEFAULT_COARSE = (32, 32)
+DEFAULT_MAX_DEPTH = 4
+DEFAULT_TOLERANCE = 1.0
+
+# The probes of a cell besides its corners, as multiples of half the cell size along the angle and stretch axes: the
+# center and the midpoints of the low angle, high angle, low stretch and high stretch edges
+PROBE_OFFSETS = ((1, 1), (0, 1), (2, 1), (1, 0), (1, 2))
+
+
+class AdaptiveManifold:
+    """
+    The AdaptiveManifold is the quadtree computed by map_manifold.  The solution space is divided into a lattice of
+    (angle_cells + 1) x (stretch_cells + 1) points, of which only the corners of the leaves (and the probes used to
+    decide on refinement) have been simulated.  The leaves are kept as one sorted array of node keys per level, and
+    the simulated points as a sorted array of lattice keys with their closest approach and outcome code.
+    """
+
+    def __init__(self, angle_range, stretch_range, coarse, max_depth, leaves, point_keys, point_cpa, point_outcome):
+        """
+        :param angle_range: the (minimum, maximum) angle of the mapped space
+        :param stretch_range: the (minimum, maximum) stretch of the mapped space
+        :param coarse: the number of coarse cells along the angle and stretch axes
+        :param max_depth: the number of levels of refinement below the coarse cells
+        :param leaves: a list with a sorted int64 array of node keys for each level
+        :param point_keys: the sorted int64 lattice keys of the simulated points
+        :param point_cpa: the closest approach of each simulated point
+        :param point_outcome: the outcome code of each simulated point (see simulation.OUTCOMES)
+        """
+        self.angle_range = (float(angle_range[0]), float(angle_range[1]))
+        self.stretch_range = (float(stretch_range[0]), float(stretch_range[1]))
+        self.coarse = (int(coarse[0]), int(coarse[1]))
+        self.max_depth = int(max_depth)
+        self.leaves = leaves
+        self.point_keys = point_keys
+        self.point_cpa = point_cpa
+        self.point_outcome = point_outcome
+
+        self.angle_cells = self.coarse[0] << self.max_depth
+        self.stretch_cells = self.coarse[1] << self.max_depth
+        self.angle_step = (self.angle_range[1] - self.angle_range[0]) / self.angle_cells
+        self.stretch_step = (self.stretch_range[1] - self.stretch_range[0]) / self.stretch_cells
+
+    def lattice_axes(self):
+        """
+        Return the angles and stretches of the full resolution lattice.
+        """
+        angles = self.angle_range[0] + numpy.arange(self.angle_cells + 1) * self.angle_step
+        stretches = self.stretch_range[0] + numpy.arange(self.stretch_cells + 1) * self.stretch_step
+        angles[-1] = self.angle_range[1]
+        stretches[-1] = self.stretch_range[1]
+        return angles, stretches
+
+    def point(self, i, j):
+        """
+        Return the closest approach and outcome code of simulated lattice points.
+        :param i: an integer array of angle lattice indices
+        :param j: an integer array of stretch lattice indices
+        """
+        keys = point_key(i, j, self.angle_cells)
+        positions = numpy.searchsorted(self.point_keys, keys)
+        return self.point_cpa[positions], self.point_outcome[positions]
+
+    def find_leaves(self, x, y):
+        """
+        Find the leaves which contain a set of points given in lattice coordinates.
+        :return: the angle and stretch lattice indices of the lower corner of each leaf, and the leaf sizes
+        """
+        corner_i = numpy.zeros(len(x), dtype=numpy.int64)
+        corner_j = numpy.zeros(len(x), dtype=numpy.int64)
+        size = numpy.zeros(len(x), dtype=numpy.int64)
+        unresolved = numpy.arange(len(x))
+        for level, keys in enumerate(self.leaves):
+            if not len(unresolved):
+                break
+            cell = 1 << (self.max_depth - level)
+            columns = self.coarse[0] << level
+            rows = self.coarse[1] << level
+            node_i = numpy.clip(numpy.floor(x[unresolved] / cell).astype(numpy.int64), 0, columns - 1)
+            node_j = numpy.clip(numpy.floor(y[unresolved] / cell).astype(numpy.int64), 0, rows - 1)
+            node_keys = node_j * columns + node_i
+            positions = numpy.minimum(numpy.searchsorted(keys, node_keys), max(len(keys) - 1, 0))
+            found = keys[positions] == node_keys if len(keys) else numpy.zeros(len(node_keys), dtype=bool)
+
+            hit = unresolved[found]
+            corner_i[hit] = node_i[found] * cell
+            corner_j[hit] = node_j[found] * cell
+            size[hit] = cell
+            unresolved = unresolved[~found]
+        return corner_i, corner_j, size
+
+    def lookup(self, angles, stretches):
+        """
+        Return the closest approach and outcome code of arrays of angles and stretches, interpolated bilinearly from the
+        corners of the leaf containing each point.  The outcome is that of the nearest corner.  Points outside of the
+        mapped space take the values at its edge.
+        :return: a float array of closest approaches and an integer array of outcome codes with the shape of the inputs
+        """
+        angles, stretches = numpy.broadcast_arrays(numpy.asarray(angles, dtype=numpy.float64),
+                                                   numpy.asarray(stretches, dtype=numpy.float64))
+        x = numpy.clip((angles.ravel() - self.angle_range[0]) / self.angle_step, 0, self.angle_cells)
+        y = numpy.clip((stretches.ravel() - self.stretch_range[0]) / self.stretch_step, 0, self.stretch_cells)
+        i, j, size = self.find_leaves(x, y)
+        t_angle = numpy.clip((x - i) / size, 0.0, 1.0)
+        t_stretch = numpy.clip((y - j) / size, 0.0, 1.0)
+
+        f00, o00 = self.point(i, j)
+        f10, o10 = self.point(i + size, j)
+        f01, o01 = self.point(i, j + size)
+        f11, o11 = self.point(i + size, j + size)
+        cpa = ((f00 * (1 - t_angle) + f10 * t_angle) * (1 - t_stretch) +
+               (f01 * (1 - t_angle) + f11 * t_angle) * t_stretch)
+
+        right = t_angle >= 0.5
+        top = t_stretch >= 0.5
+        outcome = numpy.where(top, numpy.where(right, o11, o01), numpy.where(right, o10, o00))
+        return cpa.reshape(angles.shape), outcome.reshape(angles.shape)
+
+    def to_grid(self, angles=None, stretches=None):
+        """
+        Resample the manifold onto a uniform grid.
+        :param angles: the angle axis of the grid, defaults to the full resolution lattice
+        :param stretches: the stretch axis of the grid, defaults to the full resolution lattice
+        :return: a manifold.ManifoldGrid
+        """
+        lattice_angles, lattice_stretches = self.lattice_axes()
+        angles = lattice_angles if angles is None else numpy.asarray(angles, dtype=numpy.float64)
+        stretches = lattice_stretches if stretches is None else numpy.asarray(stretches, dtype=numpy.float64)
+        grid_angles, grid_stretches = numpy.meshgrid(angles, stretches)
+        cpa, outcome = self.lookup(grid_angles, grid_stretches)
+        return manifold_library.ManifoldGrid(angles, stretches, cpa, outcome.astype(numpy.int8))
+
+    def stats(self):
+        """
+        Return a dictionary with the number of "leaves", the number of "evaluations" (simulated points), the number
+        of points a uniform grid of the same resolution would have simulated as "dense_evaluations", and the number of
+        leaves at each level as "leaves_per_level".
+        """
+        return {"leaves": int(sum(len(keys) for keys in self.leaves)),
+                "evaluations": int(len(self.point_keys)),
+                "dense_evaluations": int((self.angle_cells + 1) * (self.stretch_cells + 1)),
+                "leaves_per_level": [int(len(keys)) for keys in self.leaves]}
+
+
+def point_key(i, j, angle_cells):
+    """
+    Return the int64 key of lattice points, ordered by stretch and then angle.
+    """
+    return numpy.asarray(j, dtype=numpy.int64) * (angle_cells + 1) + numpy.asarray(i, dtype=numpy.int64)
+
+
+def map_manifold(settings, angle_range=None, stretch_range=None, coarse=DEFAULT_COARSE, max_depth=DEFAULT_MAX_DEPTH,
+                 tolerance=DEFAULT_TOLERANCE, engine=None):
+    """
+    Map the solution manifold of a settings dictionary adaptively.
+    :param settings: the settings dictionary of a test
+    :param angle_range: the (minimum, maximum) angle to map, defaults to the AngleMinimum and AngleMaximum settings
+    :param stretch_range: the (minimum, maximum) stretch to map, defaults to the StretchMinimum and StretchMaximum
+    settings
+    :param coarse: the number of coarse cells along the angle and stretch axes
+    :param max_depth: the number of times a coarse cell may be split in four
+    :param tolerance: the largest deviation (in pixels) of the closest approach at the probes of a cell from the
+    bilinear prediction of its corners before it is refined
+    :param engine: the batch engine to simulate with, defaults to a simulation.ClosestApproachEngine for the settings
+    :return: an AdaptiveManifold
+    """
+    if engine is None:
+        engine = simulation.ClosestApproachEngine(settings)
+    if angle_range is None:
+        angle_range = (settings["AngleMinimum"], settings["AngleMaximum"])
+    if stretch_range is None:
+        stretch_range = (settings["StretchMinimum"], settings["StretchMaximum"])
+
+    angle_cells = coarse[0] << max_depth
+    stretch_cells = coarse[1] << max_depth
+    angle_step = (float(angle_range[1]) - float(angle_range[0])) / angle_cells
+    stretch_step = (float(stretch_range[1]) - float(stretch_range[0])) / stretch_cells
+    store = {"keys": numpy.zeros(0, dtype=numpy.int64), "cpa": numpy.zeros(0), "outcome": numpy.zeros(0, numpy.int8)}
+
+    def evaluate(i, j):
+        """ Return the closest approach and outcome of lattice points, simulating those not simulated yet in one
+        batch. """
+        keys = point_key(i, j, angle_cells)
+        positions = numpy.searchsorted(store["keys"], keys)
+        known = positions < len(store["keys"])
+        known[known] = store["keys"][positions[known]] == keys[known]
+        missing = numpy.unique(keys[~known])
+        if len(missing):
+            missing_i = missing % (angle_cells + 1)
+            missing_j = missing // (angle_cells + 1)
+            angles = numpy.where(missing_i == angle_cells, float(angle_range[1]),
+                                 float(angle_range[0]) + missing_i * angle_step)
+            stretches = numpy.where(missing_j == stretch_cells, float(stretch_range[1]),
+                                    float(stretch_range[0]) + missing_j * stretch_step)
+            cpa, outcome = engine.simulate_batch(angles, stretches)
+
+            all_keys = numpy.concatenate([store["keys"], missing])
+            order = numpy.argsort(all_keys, kind="mergesort")
+            store["keys"] = all_keys[order]
+            store["cpa"] = numpy.concatenate([store["cpa"], cpa])[order]
+            store["outcome"] = numpy.concatenate([store["outcome"], outcome.astype(numpy.int8)])[order]
+            positions = numpy.searchsorted(store["keys"], keys)
+        return store["cpa"][positions], store["outcome"][positions]
+
+    node_j, node_i = numpy.meshgrid(numpy.arange(coarse[1], dtype=numpy.int64),
+                                    numpy.arange(coarse[0], dtype=numpy.int64), indexing="ij")
+    node_i = node_i.ravel()
+    node_j = node_j.ravel()
+    leaves = []
+    for level in range(max_depth + 1):
+        cell = 1 << (max_depth - level)
+        columns = coarse[0] << level
+        i = node_i * cell
+        j = node_j * cell
+        corners = [evaluate(i + di * cell, j + dj * cell) for dj in (0, 1) for di in (0, 1)]
+
+        if level == max_depth:
+            refine = numpy.zeros(len(i), dtype=bool)
+        else:
+            # The cell is refined if any of its points disagree with its first corner in outcome or sign, or if the
+            # probes deviate from the bilinear prediction of the corners by more than the tolerance
+            half = cell // 2
+            base_cpa, base_outcome = corners[0]
+            probes = [evaluate(i + pi * half, j + pj * half) for pi, pj in PROBE_OFFSETS]
+            refine = numpy.zeros(len(i), dtype=bool)
+            for cpa, outcome in corners[1:] + probes:
+                refine |= (outcome != base_outcome) | (numpy.sign(cpa) != numpy.sign(base_cpa))
+
+            f00, f10, f01, f11 = [cpa for cpa, _ in corners]
+            predictions = ((f00 + f10 + f01 + f11) / 4.0, (f00 + f01) / 2.0, (f10 + f11) / 2.0,
+                           (f00 + f10) / 2.0, (f01 + f11) / 2.0)
+            for (cpa, _), prediction in zip(probes, predictions):
+                refine |= numpy.abs(cpa - prediction) > tolerance
+
+        leaves.append(numpy.sort(node_j[~refine] * columns + node_i[~refine]))
+        parent_i = node_i[refine] * 2
+        parent_j = node_j[refine] * 2
+        node_i = numpy.concatenate([parent_i, parent_i + 1, parent_i, parent_i + 1])
+        node_j = numpy.concatenate([parent_j, parent_j, parent_j + 1, parent_j + 1])
+
+    return AdaptiveManifold(angle_range, stretch_range, coarse, max_depth, leaves, store["keys"], store["cpa"],
+                            store["outcome"])
@@ -0,0 +1,294 @@
+"""
+    batch.py
+
+    This module contains the batch cost runner, which computes the cost measures of many groups of tests (every block
+    of every subject in a study, for instance) with a pool of worker processes and collects them into a single table.
+
+    The groups are sorted by their manifold token and handed out in chunks of groups which share a token, so each
+    worker computes a chunk with a single simulator process (see costs.open_simulator) and the evaluation cache it has
+    already filled for that manifold.  The workers are only sent the files of each group (see _portable) and load the
+    tests themselves.  Every group becomes one row of a CSV file with its label, its costs and scores, the number of
+    points simulated for it and the time it took, and the rows are written and flushed as the chunks finish.  A group
+    which fails is recorded as an error row rather than stopping the run.
+
+    The CSV file doubles as the record of the work which is done: running the same batch again with resume=True skips
+    the groups which already have a successful row, so an interrupted run picks up where it stopped.  The finished
+    table can be read back with read_table() or written to a numpy archive with save_npz().
+"""
+import csv
+import multiprocessing
+import os
+import sys
+import time
+from collections import OrderedDict
+
+import numpy
+
+try:
+    import costs
+    import manifold
+    import parallel
+    import tests
+except:
+    import library.costs as costs
+    import library.manifold as manifold
+    import library.parallel as parallel
+    import library.tests as tests
+
+# The columns every table starts with, followed by the cost and final score of each of the analyses which were run
+BASE_COLUMNS = ("label", "manifold_token", "status", "error", "points", "seconds", "simulations", "cache_hits",
+                "initial_score")
+TEXT_COLUMNS = ("label", "manifold_token", "status", "error")
+
+
+def table_columns(which=costs.COSTS):
+    """
+    Return the columns of the table for a set of cost analyses.
+    :param which: the name, or a list of the names, of the analyses
+    """
+    if tests.is_string(which):
+        which = [which]
+    columns = list(BASE_COLUMNS)
+    for name in costs.COSTS:
+        if name in which:
+            columns += [name + "_cost", name + "_final_score"]
+    return columns
+
+
+def block_groups(blocks):
+    """
+    Label the blocks returned by TestGroup.break_into_blocks() for the batch runner.
+    :param blocks: a dictionary of subject to list of TestGroups
+    :return: an ordered dictionary of "subject/block number" to TestGroup, with the blocks numbered from 0
+    """
+    output = OrderedDict()
+    for subject in sorted(blocks):
+        for number, group in enumerate(blocks[subject]):
+            output["{}/{}".format(subject, number)] = group
+    return output
+
+
+def group_token(group):
+    """
+    Return the manifold token of a group of tests, which is used to schedule groups on the same manifold together, or
+    None if it can't be found.  A group with tests on several manifolds gets the first of its tokens (its costs will
+    fail in any case).
+    :param group: a TestGroup, a ContinuousGroup or a list of paths of test .json files
+    """
+    try:
+        if hasattr(group, "prepare_for_costs"):
+            return manifold.get_manifold_token(group.prepare_for_costs()[0])
+        if type(group) is list:
+            group = tests.TestGroup(group)
+        tokens = sorted(group.group_by_manifold())
+        return tokens[0] if tokens else None
+    except Exception:
+        return None
+
+
+def _portable(group):
+    """
+    Return a group in a form which is cheap to send to a worker process.  A TestGroup (or a TestLibrary, whose lock and
+    index connection can't be sent at all) shares the header table and records of the whole library it was filtered
+    from, so it is replaced by a plain TestGroup of its files carrying only the records of those files which it holds
+    itself (as a group restored by load_from_file does).  The worker loads the rest of the files itself.
+    :param group: a TestGroup, a ContinuousGroup or a list of paths of test .json files
+    """
+    if isinstance(group, tests.TestGroup):
+        files = list(group.files)
+        return tests.TestGroup(files, records=dict((path, group.records[path]) for path in files
+                                                  if path in group.records))
+    return group
+
+
+def _row(label, token, which, results=None, seconds=0.0, error=None):
+    """
+    Build the table row of a group from the results of costs.compute_all_costs, or from the error it raised.
+    """
+    row = dict((column, "") for column in table_columns(which))
+    row.update({"label": label, "manifold_token": token or "", "seconds": seconds})
+    if error is not None:
+        row.update({"status": "error", "error": error})
+        return row
+
+    names = [name for name in costs.COSTS if name in results]
+    row.update({"status": "ok",
+                "points": len(results[names[0]]["shifted_points"]) if names else "",
+                "simulations": results["evaluations"]["misses"],
+                "cache_hits": results["evaluations"]["hits"],
+                "initial_score": results["initial_score"]})
+    for name in names:
+        row[name + "_cost"] = results[name]["cost"]
+        row[name + "_final_score"] = results[name]["final_score"]
+    return row
+
+
+def _run_chunk(task):
+    """
+    Worker function which computes the costs of a chunk of groups on the same manifold with a single simulator.  This
+    has to be a module level function so that the process pool can pickle it.
+    :param task: a tuple of the manifold token, a list of (label, group) pairs (see _portable), the analyses and their
+    options
+    :return: a list of table rows
+    """
+    token, items, which, options = task
+    rows = []
+    simulator = None
+    try:
+        for label, group in items:
+            start = time.time()
+            try:
+                if simulator is None and token is not None:
+                    simulator = costs.open_simulator(group)
+                results = costs.compute_all_costs(group, which, options, simulator=simulator)
+                rows.append(_row(label, token, which, results, time.time() - start))
+            except Exception as e:
+                rows.append(_row(label, token, which, seconds=time.time() - start,
+                                 error="{}: {}".format(type(e).__name__, e)))
+    finally:
+        if simulator is not None:
+            simulator.close_process()
+    return rows
+
+
+def _open_csv(path, mode):
+    """ Open a csv file the way the csv module expects under python 2 and 3. """
+    if sys.version_info[0] < 3:
+        return open(path, mode + "b")
+    return open(path, mode, newline="")
+
+
+def _repair(path):
+    """ Cut off a row which was only partly written when a run was interrupted. """
+    with open(path, "rb") as handle:
+        contents = handle.read()
+    if contents and not contents.endswith(b"\n"):
+        with open(path, "r+b") as handle:
+            handle.truncate(contents.rfind(b"\n") + 1)
+
+
+def _read_rows(path):
+    """ Return the columns of a table file and its rows, keeping only the last row of each label. """
+    with _open_csv(path, "r") as handle:
+        reader = csv.reader(handle)
+        columns = next(reader, None)
+        rows = OrderedDict()
+        for values in reader:
+            if len(values) == len(columns):
+                row = dict(zip(columns, values))
+                rows[row["label"]] = row
+    return columns, rows
+
+
+def read_table(path):
+    """
+    Read a table written by run_costs.  A group which has several rows (because it failed and was run again on
+    resuming) is given by its last row.
+    :param path: the path of the CSV file
+    :return: an ordered dictionary of column name to numpy array, holding strings for the text columns and floats
+    (nan where empty) for the rest
+    """
+    columns, rows = _read_rows(path)
+    output = OrderedDict()
+    for column in columns or []:
+        values = [row[column] for row in rows.values()]
+        if column in TEXT_COLUMNS:
+            output[column] = numpy.array(values, dtype=str)
+        else:
+            output[column] = numpy.array([float(value) if value else numpy.nan for value in values],
+                                         dtype=numpy.float64)
+    return output
+
+
+def save_npz(csv_path, npz_path):
+    """
+    Write a table written by run_costs to a numpy archive with one array per column (see read_table).
+    """
+    numpy.savez(npz_path, **read_table(csv_path))
+
+
+def run_costs(groups, path, which=costs.COSTS, options=None, workers=None, chunk_size=None, resume=True,
+              npz_path=None):
+    """
+    Compute the costs of many groups of tests with a pool of worker processes, streaming a row per group into a CSV
+    table.  The groups are scheduled in chunks of groups on the same manifold, each computed by one worker with a
+    single simulator.
+    :param groups: a dictionary of label to TestGroup, ContinuousGroup or list of paths of test .json files
+    :param path: the path of the CSV file to write
+    :param which: the name, or a list of the names, of the analyses to run (see costs.compute_all_costs)
+    :param options: an optional dictionary of the keyword arguments of each analysis, keyed by its name
+    :param workers: the number of worker processes, defaults to the number of cores.  One or fewer computes the costs in
+    this process without a pool.
+    :param chunk_size: the most groups handed to a worker at a time, picked automatically if not given
+    :param resume: keep the rows of an existing file and skip the groups which already have a successful row.  If
+    False an existing file is started again.
+    :param npz_path: optionally, the path of a numpy archive to write the finished table to (see save_npz)
+    :return: the finished table, as returned by read_table
+    """
+    columns = table_columns(which)
+    labels = OrderedDict()
+    for label, group in groups.items():
+        if str(label) in labels:
+            raise Exception("Two groups have the same label: " + str(label))
+        labels[str(label)] = group
+
+    # Find the groups which are already done in an earlier run
+    done = set()
+    if resume and os.path.exists(path):
+        _repair(path)
+        existing, rows = _read_rows(path)
+        if existing is not None and existing != columns:
+            raise Exception("The table " + path + " was written with different columns, it can't be resumed")
+        done = set(label for label, row in rows.items() if row["status"] == "ok")
+    if not resume or not os.path.exists(path) or not os.path.getsize(path):
+        with _open_csv(path, "w") as handle:
+            csv.writer(handle).writerow(columns)
+
+    # Sort the remaining groups by manifold token and cut them into chunks of a single token
+    by_token = {}
+    for label, group in labels.items():
+        if label not in done:
+            by_token.setdefault(group_token(group), []).append((label, _portable(group)))
+    count = sum(len(items) for items in by_token.values())
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = max(1, min(workers, count))
+    if chunk_size is None:
+        chunk_size = parallel.default_chunk_size(count, workers)
+
+    tasks = []
+    for token in sorted(by_token, key=lambda token: (token is None, token)):
+        items = by_token[token]
+        for start in range(0, len(items), chunk_size):
+            tasks.append((token, items[start:start + chunk_size], which, options))
+
+    with _open_csv(path, "a") as handle:
+        writer = csv.writer(handle)
+
+        def write(rows):
+            for row in rows:
+                writer.writerow([repr(float(row[column])) if isinstance(row[column], float) else row[column]
+                                 for column in columns])
+            handle.flush()
+            os.fsync(handle.fileno())
+
+        if workers <= 1:
+            for task in tasks:
+                write(_run_chunk(task))
+        else:
+            pool = multiprocessing.Pool(workers)
+            try:
+                for rows in pool.imap_unordered(_run_chunk, tasks):
+                    write(rows)
+            except:
+                pool.terminate()
+                raise
+            else:
+                pool.close()
+            finally:
+                pool.join()
+
+    if npz_path is not None:
+        save_npz(path, npz_path)
+    return read_table(path)
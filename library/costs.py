@@ -8,16 +8,47 @@
 try:
     import manifold
     import tests
-    import vector
     import continuous
+    import evaluation_cache
 except:
     import library.manifold as manifold
     import library.tests as tests
-    import library.vector as vector
     import library.continuous as continuous
+    import library.evaluation_cache as evaluation_cache
 
+import numpy
 import scipy.optimize
 
+# The number of evenly spaced scale factors the noise cost evaluates, and the precision to which the best of them is
+# refined
+NOISE_STEPS = 100
+NOISE_SCALE_TOLERANCE = 1e-4
+
+# The number of hops of the basin-hopping search of the tolerance cost and the largest step of each hop in angle and in
+# stretch.  The hops can carry the shift up to TOLERANCE_HOPS * TOLERANCE_HOP_SIZE away from the zero shift in either
+# direction, which is where the fast mode draws its starting shifts from by default.
+TOLERANCE_HOPS = 50
+TOLERANCE_HOP_SIZE = 0.5
+
+# The defaults of the fast mode of the tolerance cost: the number of random starting shifts, the seed they are drawn
+# with, the most objective evaluations to spend, and the number of local searches in a row which may improve the best
+# score by less than the plateau (in pixels) before the search stops
+TOLERANCE_STARTS = 16
+TOLERANCE_SEED = 0
+TOLERANCE_BUDGET = 2000
+TOLERANCE_PATIENCE = 3
+TOLERANCE_PLATEAU = 0.01
+
+# The size of the initial Nelder-Mead simplex of the fast mode, as a fraction of the angle and stretch ranges of the
+# region
+TOLERANCE_SIMPLEX = 0.02
+
+# The number of candidate swaps of the covariation cost which are simulated together in a batch
+COVARIATION_BATCH = 256
+
+# The most angle and stretch pairs of the exact covariation cost which are simulated together in a batch
+COVARIATION_ASSIGNMENT_BATCH = 65536
+
 
 def __tolerance_evaluate(x, distribution, simulator):
     """ This is the tolerance evaluation function, which produces a single numerical
@@ -34,19 +65,68 @@ def __tolerance_evaluate(x, distribution, simulator):
     function) which we will interpret as taking the form of x = [u, v].  It's up
     to us to perform the evaluation here and return the result."""
 
-    # Extract u and v from the x array given to us by scipy
-    u, v = x
+    # Shift the whole distribution by u and v and simulate it in a single batch
+    return float(__tolerance_batch(numpy.asarray(x, dtype=numpy.float64)[None, :], distribution, simulator)[0])
 
-    # Create a temporary test distribution that is shifted by u and v
-    test = [(angle + u, stretch + v) for angle, stretch in distribution ]
 
-    # Calculate the sum of the distributions
-    sum_value = 0
-    for angle, stretch in test:
-        sum_value += abs(simulator.get_closest_approach(angle, stretch))
+def __tolerance_batch(shifts, distribution, simulator):
+    """ Evaluate the tolerance objective for an array of shifts at once.
+    :param shifts: a (k, 2) array of angle and stretch shifts
+    :param distribution: an (n, 2) array of release angles and stretches
+    :param simulator: the simulator
+    :return: an array of the k mean absolute closest approaches """
+    shifted = numpy.asarray(distribution, dtype=numpy.float64)[None, :, :] + shifts[:, None, :]
+    return numpy.abs(simulator.closest_approach_batch(shifted[..., 0], shifted[..., 1])).mean(axis=1)
+
+
+def __tolerance_fast(distribution, simulator, region, starts, seed, budget, patience, plateau):
+    """ The fast mode of the tolerance cost: a seeded multistart search with an evaluation budget.
+
+    The starting shifts are the zero shift and starts - 1 shifts which move the mean of the distribution to random
+    points of the region, all evaluated in one batch.  Nelder-Mead searches are then run from the starts in
+    order of their scores until the budget of objective evaluations is spent, or until patience searches in a row have
+    failed to improve the best score by more than the plateau.
+    :return: the best shift, its score, the number of objective evaluations, and the reason the search stopped
+    """
+    distribution = numpy.asarray(distribution, dtype=numpy.float64)
+    mean_point = distribution.mean(axis=0)
+    lows = numpy.array([region[0][0], region[1][0]], dtype=numpy.float64)
+    highs = numpy.array([region[0][1], region[1][1]], dtype=numpy.float64)
+    random = numpy.random.RandomState(seed)
+
+    starts = max(1, min(starts, budget))
+    candidates = numpy.vstack([numpy.zeros((1, 2)), random.uniform(lows, highs, (starts - 1, 2)) - mean_point])
+    scores = __tolerance_batch(candidates, distribution, simulator)
+    evaluations = [len(candidates)]
+
+    def objective(x):
+        evaluations[0] += 1
+        return float(__tolerance_batch(x[None, :], distribution, simulator)[0])
+
+    best = int(numpy.argmin(scores))
+    best_shift, best_score = candidates[best], float(scores[best])
+    simplex = numpy.array([[0, 0], [1, 0], [0, 1]]) * (highs - lows) * TOLERANCE_SIMPLEX
+    stalled = 0
+    reason = "converged"
+    for index in numpy.argsort(scores, kind="mergesort"):
+        remaining = budget - evaluations[0]
+        if remaining <= 0:
+            reason = "budget"
+            break
+        if stalled >= patience:
+            reason = "plateau"
+            break
+
+        result = scipy.optimize.minimize(objective, candidates[index], method="Nelder-Mead",
+                                         options={"maxfev": remaining, "initial_simplex": candidates[index] + simplex})
+        if result.fun < best_score - plateau:
+            stalled = 0
+        else:
+            stalled += 1
+        if result.fun < best_score:
+            best_shift, best_score = result.x, float(result.fun)
 
-    # Return the mean value
-    return sum_value / len(test)
+    return best_shift, best_score, evaluations[0], reason
 
 def __load_tests(test_group):
     """
@@ -59,15 +139,15 @@ def __load_tests(test_group):
         return test_group.prepare_for_costs()
 
     if isinstance(test_group, tests.TestGroup) or isinstance(test_group, tests.TestLibrary):
-        test_group = test_group.files
-
-    if type(test_group) is not list:
+        loaded = zip(test_group.files, test_group.get_data_list(shared=True))
+    elif type(test_group) is list:
+        loaded = [(item, tests.load_cached_test_file(item)) for item in test_group]
+    else:
         raise Exception("Expecting a TestGroup or list of test file names")
 
     test_data = []
     failed = []
-    for item in test_group:
-        data = tests.load_test_file(item)
+    for item, data in loaded:
         if data is None:
             failed.append(item)
         else:
@@ -78,185 +158,375 @@ def __load_tests(test_group):
     return test_data
 
 
-def compute_noise_cost(test_group):
+def __create_simulator(test_data):
     """
-    Compute the noise cost for a TestGroup object or a list of filepaths using the algorithm described by Sternad and
-    Cohen 2009. Return a dictionary with the results of the analysis.
-    :param test_group: a TestGroup object or a list of paths of test .json files
-    :return: a results dictionary
+    Create the simulator for a list of test dictionaries which have been validated to lie on the same manifold.  The
+    simulator is put behind the shared evaluation cache, so points which have been simulated before for the same
+    manifold (in this analysis or an earlier one) are not simulated again.
+    :param test_data: a list of test dictionaries
+    :return: a MemoizedSimulator
+    """
+    return evaluation_cache.MemoizedSimulator(manifold.SolutionManifold(test_data[0]['settings']),
+                                              manifold.get_manifold_token(test_data[0]))
+
+
+def open_simulator(test_group):
+    """
+    Create a simulator for the solution manifold of a group of tests, behind the shared evaluation cache.  It can be
+    passed to compute_all_costs for every group on the same manifold, so that they share a single simulator process
+    rather than each starting their own, and it has to be closed by the caller with close_process().
+    :param test_group: a TestGroup object, a ContinuousGroup or a list of paths of test .json files
+    :return: a MemoizedSimulator
     """
     test_data = __load_tests(test_group)
     if not manifold.validate_same_manifold(test_data):
         raise Exception("The test group provided has tests which do not all lie on the same solution manifold")
+    return __create_simulator(test_data)
 
 
+def __open_session(test_group, simulator=None):
+    """
+    Load and validate a group of tests, create their simulator (unless one is given) and simulate their release points
+    once, which is the work shared by every cost analysis.
+    :param test_group: a TestGroup object, a ContinuousGroup or a list of paths of test .json files
+    :param simulator: an optional simulator from open_simulator, which must be for the manifold of the tests
+    :return: the list of test dictionaries, the simulator, an (n, 2) array of the release angles and stretches and an
+    array of their absolute closest approaches
+    """
+    test_data = __load_tests(test_group)
+    if not manifold.validate_same_manifold(test_data):
+        raise Exception("The test group provided has tests which do not all lie on the same solution manifold")
 
-    # Now that we've got the test data loaded and validated, we can create a simulator object based off of the settings
-    # of the first test in the list (we have just validated that they are all the same, so this is acceptable)
-    simulator = manifold.SolutionManifold(test_data[0]['settings'])
-
-    # Find the mean point in the test group
-    release_points = []
-    for data in test_data:
-        release_points.append(vector.Vector(data['release_angle'], data['release_stretch'], 0))
-    n = len(release_points)
-    mean_point = vector.get_average_point(release_points)
+    if simulator is None:
+        # Now that we've got the test data loaded and validated, we can create a simulator object based off of the
+        # settings of the first test in the list (we have just validated that they are all the same, so this is
+        # acceptable)
+        simulator = __create_simulator(test_data)
+        owned = True
+    elif simulator.token != manifold.get_manifold_token(test_data[0]):
+        raise Exception("The simulator given is for a different solution manifold than the test group")
+    else:
+        owned = False
+
+    # Now let's assemble the test distribution, an (n, 2) array of release angle and stretch pairs, with the scores of
+    # the throws as they were made
+    points = numpy.array([[data['release_angle'], data['release_stretch']] for data in test_data], dtype=numpy.float64)
+    try:
+        scores = numpy.abs(simulator.closest_approach_batch(points[:, 0], points[:, 1]))
+    except:
+        if owned:
+            simulator.close_process()
+        raise
+    return test_data, simulator, points, scores
+
+
+def __evaluations_since(simulator, before):
+    """ Return the simulator's evaluation counters counted from an earlier simulator.stats() dictionary. """
+    after = simulator.stats()
+    hits = after["hits"] - before["hits"]
+    misses = after["misses"] - before["misses"]
+    return {"hits": hits,
+            "misses": misses,
+            "hit_rate": hits / float(hits + misses) if hits + misses else 0.0}
+
+
+def __noise_analysis(test_data, points, scores, simulator, steps=NOISE_STEPS, refine=True):
+    """ The noise cost of a distribution, see compute_noise_cost. """
+    # The distribution is held as deviations from its mean point
+    mean_point = points.mean(axis=0)
+    deviations = points - mean_point
+
+    def score(scales):
+        """ Return the mean absolute closest approach of the distribution scaled by each of an array of factors. """
+        scaled = mean_point + numpy.asarray(scales, dtype=numpy.float64)[:, None, None] * deviations
+        return numpy.abs(simulator.closest_approach_batch(scaled[..., 0], scaled[..., 1])).mean(axis=1)
 
     # Get the initial score
-    results = [abs(simulator.get_closest_approach(v.x, v.y)) for v in release_points]
-    initial_score = sum(results) / n
-
-    # Create a list where each point is represented by a vector from the mean point
-    mean_vectors = [point - mean_point for point in release_points]
-
-    # Go through 100 steps and transform each point by that percentage from the mean
-    total_results = []
-    for scale in range(100):
-        # Scale the distribution
-        scale_factor = scale / 100.0
-        scaled_distribution = []
-
-        for v in mean_vectors:
-            direction = v.unit()
-            length = scale_factor * v.length()
-
-            scaled_distribution.append(mean_point + direction * length)
-
-        # Evaluate the scaled distribution
-        results = [abs(simulator.get_closest_approach(v.x, v.y)) for v in scaled_distribution]
-        total_results.append([sum(results)/ n, scale_factor, scaled_distribution])
-
-    simulator.close_process()
-
-    # Find the one with the lowest value
-    final_score, scale_factor, distribution = min(total_results)
+    initial_score = float(scores.mean())
+
+    # Evaluate every step at once and find the one with the lowest value, the smallest scale winning a tie
+    scales = numpy.arange(steps) / float(steps)
+    step_scores = score(scales)
+    best = int(numpy.argmin(step_scores))
+    scale_factor = float(scales[best])
+    final_score = float(step_scores[best])
+
+    # The score is only piecewise smooth in the scale, so the refinement is kept between the neighbouring steps and
+    # only accepted if it improves on the best step
+    if refine:
+        bounds = (max(0.0, scale_factor - 1.0 / steps), min(1.0, scale_factor + 1.0 / steps))
+        result = scipy.optimize.minimize_scalar(lambda x: float(score([x])[0]), bounds=bounds, method="bounded",
+                                                options={"xatol": NOISE_SCALE_TOLERANCE})
+        if result.fun < final_score:
+            scale_factor = float(result.x)
+            final_score = float(result.fun)
+
+    distribution = mean_point + scale_factor * deviations
 
     output = {  "cost": initial_score - final_score,
                 "initial_score": initial_score,
                 "final_score": final_score,
                 "scale": scale_factor,
-                "shifted_points": [(v.x, v.y) for v in distribution] }
+                "shifted_points": [(a, s) for a, s in distribution.tolist()] }
 
     return output
 
-def compute_tolerance_cost(test_group):
+
+def compute_noise_cost(test_group, steps=NOISE_STEPS, refine=True):
     """
-    Compute the tolerance cost for a TestGroup object or a list of filepaths. Return a dictionary with the results of
-    the analysis, including the tolerance cost, the initial score, the final score, the shift and the shifted
-    distribution, and a string description of the output of the analysis.
+    Compute the noise cost for a TestGroup object or a list of filepaths using the algorithm described by Sternad and
+    Cohen 2009. Return a dictionary with the results of the analysis.
+
+    The distribution is shrunk towards its mean point by each of the scale factors 0, 1/steps, 2/steps ... up to (but
+    not including) 1, all simulated together in a single batch, and the best scale is then refined by a bounded scalar
+    search (Brent's method) between its neighbouring steps.
     :param test_group: a TestGroup object or a list of paths of test .json files
+    :param steps: the number of evenly spaced scale factors to evaluate
+    :param refine: refine the best scale factor beyond the spacing of the steps
     :return: a results dictionary
     """
-    test_data = __load_tests(test_group)
-    if not manifold.validate_same_manifold(test_data):
-        raise Exception("The test group provided has tests which do not all lie on the same solution manifold")
-
-    # Now that we've got the test data loaded and validated, we can create a simulator object based off of the settings
-    # of the first test in the list (we have just validated that they are all the same, so this is acceptable)
-    simulator = manifold.SolutionManifold(test_data[0]['settings'])
+    return __compute_one(test_group, "noise", {"steps": steps, "refine": refine})
 
-    # Now let's assemble the test distribution, which ends up as a nested list of release angle and stretch pairs.
-    distribution = []
-    for data in test_data:
-        release_angle   = data['release_angle']
-        release_stretch = data['release_stretch']
-        distribution.append([release_angle, release_stretch])
 
+def __tolerance_analysis(test_data, distribution, scores, simulator, fast=False, starts=TOLERANCE_STARTS,
+                         seed=TOLERANCE_SEED, budget=TOLERANCE_BUDGET, patience=TOLERANCE_PATIENCE,
+                         plateau=TOLERANCE_PLATEAU, region=None):
+    """ The tolerance cost of a distribution, see compute_tolerance_cost. """
     # Create the initial guess
     x0 = [0, 0]
 
     # Check the initial score
-    initial_score = __tolerance_evaluate(x0, distribution, simulator)
-
-    # Perform the optimization, a basin-hopping global search using the Nelder-Mead downhill simplex algorithm
-    result = scipy.optimize.basinhopping(__tolerance_evaluate, x0, minimizer_kwargs={"method":"Nelder-Mead", "args":(distribution, simulator)}, niter=50)
-
-    # Evaluate the optimized score
-    final_score = __tolerance_evaluate(result.x, distribution, simulator)
+    initial_score = float(scores.mean())
+    before = simulator.stats()
+
+    output = {}
+    if fast:
+        if region is None:
+            reach = TOLERANCE_HOPS * TOLERANCE_HOP_SIZE
+            mean_angle, mean_stretch = distribution.mean(axis=0)
+            region = ((mean_angle - reach, mean_angle + reach), (mean_stretch - reach, mean_stretch + reach))
+        shift, final_score, objective_evaluations, reason = __tolerance_fast(
+            distribution, simulator, region, starts, seed, budget, patience, plateau)
+        output["stop_reason"] = reason
+    else:
+        # Perform the optimization, a basin-hopping global search using the Nelder-Mead downhill simplex algorithm
+        result = scipy.optimize.basinhopping(__tolerance_evaluate, x0,
+                                             minimizer_kwargs={"method":"Nelder-Mead", "args":(distribution, simulator)},
+                                             niter=TOLERANCE_HOPS, stepsize=TOLERANCE_HOP_SIZE)
+        shift = result.x
+        objective_evaluations = int(result.nfev)
+
+        # Evaluate the optimized score
+        final_score = __tolerance_evaluate(result.x, distribution, simulator)
 
     # Print the results
     description = []
     description.append("Initial score: {:.2f} px".format(initial_score))
     description.append("Final score:   {:.2f} px".format(final_score))
     description.append("Difference:    {:.2f} px".format(initial_score-final_score))
-    description.append("Shift:         (angle = {:.3f}, stretch = {:.3f})".format(result.x[0], result.x[1]))
+    description.append("Shift:         (angle = {:.3f}, stretch = {:.3f})".format(shift[0], shift[1]))
     description = "\n".join(description)
 
-    # Close the simulator process that's running in the background
-    simulator.close_process()
-
-    output = {  "cost": initial_score - final_score,
-                "description": description,
-                "initial_score": initial_score,
-                "final_score": final_score,
-                "shift": (result.x[0], result.x[1]),
-                "shifted_points": [[a + result.x[0], v + result.x[1]] for a, v in distribution] }
+    output.update({ "cost": initial_score - final_score,
+                    "description": description,
+                    "initial_score": initial_score,
+                    "final_score": final_score,
+                    "shift": (shift[0], shift[1]),
+                    "shifted_points": [[a + shift[0], v + shift[1]] for a, v in distribution.tolist()],
+                    "objective_evaluations": objective_evaluations,
+                    "simulator_evaluations": __evaluations_since(simulator, before)["misses"] })
 
     return output
 
 
-def compute_covariation_cost(test_group):
+def compute_tolerance_cost(test_group, fast=False, starts=TOLERANCE_STARTS, seed=TOLERANCE_SEED,
+                           budget=TOLERANCE_BUDGET, patience=TOLERANCE_PATIENCE, plateau=TOLERANCE_PLATEAU,
+                           region=None):
     """
-    Compute the covariation cost according to the algorithm described in Cohen and Sternad 2009. Return a results
-    dictionary containing the cost and the initial and final scores.
+    Compute the tolerance cost for a TestGroup object or a list of filepaths. Return a dictionary with the results of
+    the analysis, including the tolerance cost, the initial score, the final score, the shift and the shifted
+    distribution, a string description of the output of the analysis, and the number of evaluations of the objective
+    and the number of points simulated by the search.
+
+    By default the shift is found with a basin-hopping search.  With fast=True a seeded multistart search is used
+    instead, which is limited to a budget of objective evaluations and stops early once it stops improving (see
+    __tolerance_fast); its results are reproducible for a given seed.
     :param test_group: a TestGroup object or a list of paths of test .json files
+    :param fast: use the budgeted multistart search
+    :param starts: the number of starting shifts of the fast search
+    :param seed: the random seed of the starting shifts of the fast search
+    :param budget: the most objective evaluations the fast search may make
+    :param patience: the number of local searches in a row which may fail to improve the best score by more than the
+    plateau before the fast search stops
+    :param plateau: the improvement in pixels which counts as progress for the fast search
+    :param region: the ((angle min, angle max), (stretch min, stretch max)) region the fast search moves the mean of
+    the distribution into for its starting shifts.  It defaults to the shifts the hops of the basin-hopping search can
+    reach, so both searches look for the same best shift; a smaller region, such as the angle and stretch ranges of the
+    settings, gives a search restricted to it, whose cost can be much lower.
     :return: a results dictionary
     """
-    test_data = __load_tests(test_group)
-    if not manifold.validate_same_manifold(test_data):
-        raise Exception("The test group provided has tests which do not all lie on the same solution manifold")
+    return __compute_one(test_group, "tolerance", {"fast": fast, "starts": starts, "seed": seed, "budget": budget,
+                                                   "patience": patience, "plateau": plateau, "region": region})
+
+
+def __covariation_swaps(angles, stretches, scores, simulator):
+    """ Improve the pairing of angles and stretches by the swaps of Cohen and Sternad 2009, in place.
+
+    Starting from the worst scoring throw, each throw tries swapping its stretch with every better scoring throw in
+    turn and keeps the swaps which lower the sum of the two scores.  Once a throw finds no profitable swap the search
+    stops.  The candidate swaps of a throw are simulated in batches of COVARIATION_BATCH: until a swap is kept the
+    candidates don't affect each other, so a batch is only cut short (and the rest simulated again with the new stretch
+    of the throw) at the first profitable swap in it, which gives exactly the results of trying the swaps one by one.
+    :param angles: an array of release angles
+    :param stretches: an array of release stretches, which is updated in place
+    :param scores: an array of the absolute closest approaches of the pairs, which is updated in place
+    :param simulator: the simulator
+    """
+    n = len(scores) - 1
+    while n > 0:
+        profitable = 0
+
+        # The partners of the throw, in the order they are tried
+        partners = numpy.arange(n - 1, -1, -1)
+        start = 0
+        while start < len(partners):
+            m = partners[start:start + COVARIATION_BATCH]
+            swapped = numpy.abs(simulator.closest_approach_batch(
+                numpy.concatenate([numpy.full(len(m), angles[n]), angles[m]]),
+                numpy.concatenate([stretches[m], numpy.full(len(m), stretches[n])])))
+            swapped_n, swapped_m = swapped[:len(m)], swapped[len(m):]
+
+            better = numpy.flatnonzero(swapped_n + swapped_m < scores[n] + scores[m])
+            if not len(better):
+                start += len(m)
+                continue
+
+            # Keep the first profitable swap and carry on from the partner after it
+            first = better[0]
+            partner = m[first]
+            stretches[n], stretches[partner] = stretches[partner], stretches[n]
+            scores[n], scores[partner] = swapped_n[first], swapped_m[first]
+            profitable += 1
+            start += first + 1
 
-    # Now that we've got the test data loaded and validated, we can create a simulator object based off of the settings
-    # of the first test in the list (we have just validated that they are all the same, so this is acceptable)
-    simulator = manifold.SolutionManifold(test_data[0]['settings'])
+        if not profitable:
+            break
 
-    # Now let's assemble the test distribution, which ends up as a list of release angle and stretch scores with
-    # their resulting score.
-    distribution = []
-    for data in test_data:
-        release_angle   = data['release_angle']
-        release_stretch = data['release_stretch']
-        score           = abs(simulator.get_closest_approach(release_angle, release_stretch))
-        distribution.append({"a": release_angle, "s": release_stretch, "score": score})
+        n -= 1
 
-    # Now we put them in order from best to worst score
-    distribution.sort(key=lambda x: x['score'])
 
-    n = len(distribution) - 1
-    pre_optimized_score = sum([x['score'] for x in distribution]) / len(distribution)
+def __covariation_assignment(angles, stretches, simulator):
+    """ Find the pairing of angles and stretches with the lowest total score.
 
-    while n > 0:
-        profitable = 0
+    Every angle is simulated with every stretch, in batches of whole rows of about COVARIATION_ASSIGNMENT_BATCH
+    throws, and the optimal assignment of stretches to angles is solved with scipy.optimize.linear_sum_assignment.
+    The n x n throws go straight to the simulator behind the evaluation cache: they are hardly ever asked for again,
+    and storing them would push the points the other analyses share out of the cache.  They still count as misses.
+    :return: the array of stretches paired with each angle and the array of their absolute closest approaches
+    """
+    simulate = simulator.closest_approach_batch
+    if isinstance(simulator, evaluation_cache.MemoizedSimulator):
+        simulate = simulator.closest_approach_batch_uncached
+
+    n = len(angles)
+    pairing = numpy.empty((n, n))
+    step = max(1, COVARIATION_ASSIGNMENT_BATCH // max(1, n))
+    for start in range(0, n, step):
+        pairing[start:start + step] = numpy.abs(simulate(angles[start:start + step, None], stretches[None, :]))
+    rows, columns = scipy.optimize.linear_sum_assignment(pairing)
+    return stretches[columns], pairing[rows, columns]
+
+
+def __covariation_analysis(test_data, points, scores, simulator, exact=False):
+    """ The covariation cost of a distribution, see compute_covariation_cost. """
+    # The release angles and stretches with their scores, put in order from best to worst score
+    order = numpy.argsort(scores, kind="mergesort")
+    angles, stretches, scores = points[order, 0], points[order, 1], scores[order]
+
+    pre_optimized_score = scores.sum() / len(scores)
+
+    if exact:
+        stretches, scores = __covariation_assignment(angles, stretches, simulator)
+    else:
+        __covariation_swaps(angles, stretches, scores, simulator)
+
+    post_optimized_score = scores.sum() / len(scores)
+
+    output = {  "initial_score": float(pre_optimized_score),
+                "final_score": float(post_optimized_score),
+                "cost": float(pre_optimized_score - post_optimized_score),
+                "shifted_points": list(zip(angles.tolist(), stretches.tolist())) }
+    return output
 
-        offset = 1
 
-        while n - offset >= 0:
-            # Compute the mean score
-            initial_score = distribution[n]['score'] + distribution[n - offset]['score']
+def compute_covariation_cost(test_group, exact=False):
+    """
+    Compute the covariation cost according to the algorithm described in Cohen and Sternad 2009. Return a results
+    dictionary containing the cost and the initial and final scores.
 
-            # Perform the swap and evaluate the new score
-            d = [dict(pair) for pair in distribution]
-            d[n]['s'], d[n - offset]['s'] = d[n - offset]['s'], d[n]['s']
-            d[n]['score'] = abs(simulator.get_closest_approach(d[n]['a'], d[n]['s']))
-            d[n-offset]['score'] = abs(simulator.get_closest_approach(d[n - offset]['a'], d[n - offset]['s']))
-            swapped_score = d[n]['score'] + d[n - offset]['score']
+    With exact=True the greedy swaps are replaced by the optimal pairing of the angles and stretches, found by solving
+    the assignment problem over every angle and stretch pair.  This makes n x n simulations but gives the lowest final
+    score which any re-pairing of the distribution can reach.
+    :param test_group: a TestGroup object or a list of paths of test .json files
+    :param exact: find the optimal pairing instead of making greedy swaps
+    :return: a results dictionary
+    """
+    return __compute_one(test_group, "covariation", {"exact": exact})
 
-            # If the score improved, update the distribution and record a profitable swap
-            if swapped_score < initial_score:
-                profitable += 1
-                distribution = [dict(pair) for pair in d]
-            offset += 1
 
-        if not profitable:
-            break
+# The cost analyses computed by compute_all_costs, in the order they are run
+COST_ANALYSES = (("tolerance", __tolerance_analysis),
+                 ("noise", __noise_analysis),
+                 ("covariation", __covariation_analysis))
+COSTS = tuple(name for name, analysis in COST_ANALYSES)
 
-        n -= 1
 
-    post_optimized_score = sum([x['score'] for x in distribution]) / len(distribution)
-    simulator.close_process()
+def compute_all_costs(test_group, which=COSTS, options=None, simulator=None):
+    """
+    Compute several of the cost measures of a group of tests together.  The tests are loaded and validated once, and
+    the analyses share a single simulator process and its evaluation cache, so the release points are only simulated
+    once for the initial score of every analysis and any point which one analysis has simulated is free to the others.
+
+    Return a dictionary with the shared "initial_score", the results dictionary of each of the analyses under its name
+    (as returned by the compute_*_cost function of the same name, with "evaluations" counting only the simulator
+    lookups made by that analysis) and the total "evaluations" of the simulator for this group.
+    :param test_group: a TestGroup object, a ContinuousGroup or a list of paths of test .json files
+    :param which: the name, or a list of the names, of the analyses to run from "tolerance", "noise" and "covariation"
+    :param options: an optional dictionary of the keyword arguments of each analysis, keyed by its name, for example
+    {"tolerance": {"fast": True}, "covariation": {"exact": True}}
+    :param simulator: an optional simulator from open_simulator to use, and leave open, instead of starting one
+    :return: a results dictionary
+    """
+    if tests.is_string(which):
+        which = [which]
+    options = options or {}
+    unknown = [name for name in list(which) + list(options) if name not in COSTS]
+    if unknown:
+        raise Exception("Unknown cost analyses: " + ", ".join(unknown) + ", expecting some of " + ", ".join(COSTS))
+
+    owned = simulator is None
+    start = simulator.stats() if not owned else None
+    test_data, simulator, points, scores = __open_session(test_group, simulator)
+    output = {"initial_score": float(scores.mean())}
+    try:
+        for name, analysis in COST_ANALYSES:
+            if name not in which:
+                continue
+            before = simulator.stats()
+            output[name] = analysis(test_data, points, scores.copy(), simulator, **options.get(name, {}))
+            output[name]["evaluations"] = __evaluations_since(simulator, before)
+    finally:
+        # Close the simulator process that's running in the background
+        if owned:
+            simulator.close_process()
+
+    output["evaluations"] = simulator.stats() if owned else __evaluations_since(simulator, start)
+    return output
+
 
-    output = {  "initial_score": pre_optimized_score,
-                "final_score": post_optimized_score,
-                "cost": pre_optimized_score - post_optimized_score,
-                "shifted_points": [ (x['a'], x['s']) for x in distribution] }
+def __compute_one(test_group, name, options):
+    """ Compute a single cost analysis, with the "evaluations" of the whole session. """
+    results = compute_all_costs(test_group, which=[name], options={name: options})
+    output = results[name]
+    output["evaluations"] = results["evaluations"]
     return output
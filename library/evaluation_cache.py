@@ -0,0 +1,370 @@
+"""
+    evaluation_cache.py
+
+    This module holds a memoization layer for closest approach evaluations.  The cost analyses ask the simulator for the
+    same (angle, stretch) points over and over, the covariation cost re-simulating pairs while it tries its swaps and
+    the basin-hopping search in the tolerance cost revisiting nearly identical shifts, and every one of those is a full
+    simulation.  The EvaluationCache remembers the results keyed by the manifold token of the settings along with the
+    angle and stretch quantized to a configurable step, so points which fall in the same step share a result.  The cache
+    is bounded and evicts the least recently used results first, and it can be saved to and loaded from disk so that
+    later analyses start with the results of earlier ones.
+
+    A MemoizedSimulator wraps a SolutionManifold (or a SolutionManifoldPool) and answers from the cache where it can,
+    passing only the points which are missing on to the simulator.
+"""
+import os
+import threading
+
+import numpy
+
+# The default quantization steps of the cache keys.  They are fine enough that sharing a result between two points in
+# the same step makes no practical difference to the closest approach.
+DEFAULT_ANGLE_STEP = 1e-6
+DEFAULT_STRETCH_STEP = 1e-8
+
+# The default maximum number of results in the cache, 32 bytes each
+DEFAULT_MAX_ENTRIES = 1000000
+
+# The largest magnitude of a key.  The keys are packed into complex numbers (see _pack_keys), which hold integers
+# exactly up to this size.
+KEY_LIMIT = 2 ** 53
+
+
+
+class EvaluationCache:
+    """
+    The EvaluationCache is a least recently used cache of closest approach results, keyed by the manifold token and
+    the quantized angle and stretch.  It keeps hit, miss and eviction counters like the RecordCache.
+
+    The results of each token are kept in numpy arrays sorted by their (angle, stretch) keys, so a whole batch of points
+    is looked up with a single search rather than one dictionary lookup at a time.  Every result carries the number of
+    the last operation which used it, and the results with the oldest are the ones evicted.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, angle_step=DEFAULT_ANGLE_STEP,
+                 stretch_step=DEFAULT_STRETCH_STEP, path=None):
+        """
+        :param max_entries: the maximum number of results to keep
+        :param angle_step: the quantization step of the angle in degrees
+        :param stretch_step: the quantization step of the stretch
+        :param path: optional path of a file to persist the cache to.  If the file exists it is loaded now, and save()
+        writes to it.
+        """
+        self.max_entries = max_entries
+        self.angle_step = float(angle_step)
+        self.stretch_step = float(stretch_step)
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._tables = {}
+        self._clock = 0
+        self._lock = threading.RLock()
+
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def quantize(self, angles, stretches):
+        """
+        Return the integer angle and stretch keys of arrays of angles and stretches.  Values too large for a key get
+        the largest key of their sign.
+        """
+        with numpy.errstate(invalid="ignore", over="ignore"):
+            angle_keys = numpy.floor(numpy.asarray(angles, dtype=numpy.float64) / self.angle_step + 0.5)
+            stretch_keys = numpy.floor(numpy.asarray(stretches, dtype=numpy.float64) / self.stretch_step + 0.5)
+        return (numpy.clip(angle_keys, -KEY_LIMIT, KEY_LIMIT).astype(numpy.int64),
+                numpy.clip(stretch_keys, -KEY_LIMIT, KEY_LIMIT).astype(numpy.int64))
+
+    def get(self, token, angle, stretch):
+        """
+        Return the cached result of a single point, or None if it is not cached.
+        """
+        angle_keys, stretch_keys = self.quantize([angle], [stretch])
+        value = self.lookup(token, angle_keys, stretch_keys)[0]
+        return None if numpy.isnan(value) else float(value)
+
+    def put(self, token, angle, stretch, value):
+        """
+        Store the result of a single point.
+        """
+        angle_keys, stretch_keys = self.quantize([angle], [stretch])
+        self.store(token, angle_keys, stretch_keys, numpy.array([value], dtype=numpy.float64))
+
+    def lookup(self, token, angle_keys, stretch_keys):
+        """
+        Look up a set of quantized points.
+        :param token: the manifold token
+        :param angle_keys: the integer angle keys (see quantize)
+        :param stretch_keys: the integer stretch keys
+        :return: a float array of the cached results, with nan for the points which are not cached
+        """
+        keys = _pack_keys(angle_keys, stretch_keys)
+        results = numpy.full(len(keys), numpy.nan)
+        with self._lock:
+            self._clock += 1
+            table = self._tables.get(token)
+            found = numpy.zeros(len(keys), dtype=bool)
+            if table is not None and len(table[0]):
+                positions, found = _search(table[0], keys)
+                results[found] = table[1][positions[found]]
+                table[2][positions[found]] = self._clock
+            hits = int(found.sum())
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return results
+
+    def store(self, token, angle_keys, stretch_keys, values):
+        """
+        Store the results of a set of quantized points.
+        """
+        with self._lock:
+            self._clock += 1
+            self._merge(token, _pack_keys(angle_keys, stretch_keys), values, self._clock)
+            self._evict()
+
+    def invalidate(self, token=None):
+        """
+        Drop the results of a single manifold token, or the entire cache if no token is given.
+        """
+        with self._lock:
+            if token is None:
+                self._tables.clear()
+            else:
+                self._tables.pop(token, None)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(table[0]) for table in self._tables.values())
+
+    def stats(self):
+        """
+        Return a dictionary with the hit, miss and eviction counters along with the current size of the cache.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "hit_rate": self.hits / float(lookups) if lookups else 0.0,
+                    "entries": len(self),
+                    "max_entries": self.max_entries}
+
+    def reset_stats(self):
+        """
+        Reset the hit, miss and eviction counters without touching the cached results.
+        """
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def save(self, path=None):
+        """
+        Write the cache to a compressed numpy archive, by way of a temporary file so that a reader never sees a
+        partially written cache.  The results are written from the least to the most recently used.
+        :param path: the file to write, defaults to the path the cache was created with
+        """
+        path = path if path is not None else self.path
+        if path is None:
+            raise Exception("No path was given to save the evaluation cache to")
+
+        with self._lock:
+            tokens = sorted(self._tables)
+            tables = [self._tables[token] for token in tokens]
+            keys = numpy.concatenate([table[0] for table in tables] or [numpy.zeros(0, dtype=numpy.complex128)])
+            values = numpy.concatenate([table[1] for table in tables] or [numpy.zeros(0)])
+            used = numpy.concatenate([table[2] for table in tables] or [numpy.zeros(0, dtype=numpy.int64)])
+        token_codes = numpy.repeat(numpy.arange(len(tokens), dtype=numpy.int32), [len(table[0]) for table in tables])
+        order = numpy.argsort(used, kind="mergesort")
+
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as handle:
+            numpy.savez_compressed(handle,
+                                   steps=numpy.array([self.angle_step, self.stretch_step]),
+                                   tokens=numpy.array(tokens, dtype=str),
+                                   token_codes=token_codes[order],
+                                   angle_keys=keys.real[order].astype(numpy.int64),
+                                   stretch_keys=keys.imag[order].astype(numpy.int64),
+                                   values=values[order])
+        if os.name == "nt" and os.path.exists(path):
+            os.remove(path)
+        os.rename(temporary, path)
+
+    def load(self, path):
+        """
+        Add the results saved in a file by save() to the cache, as the most recently used results in the order they
+        were saved.  A file saved with different quantization steps is ignored, since its keys mean different points.
+        :return: True if the file was loaded, False if its steps didn't match
+        """
+        with numpy.load(path) as archive:
+            if not numpy.array_equal(archive["steps"], [self.angle_step, self.stretch_step]):
+                return False
+            tokens = archive["tokens"].tolist()
+            token_codes = archive["token_codes"]
+            angle_keys = archive["angle_keys"]
+            stretch_keys = archive["stretch_keys"]
+            values = archive["values"]
+
+        # The results are used one after another in the order they were saved
+        with self._lock:
+            used = self._clock + 1 + numpy.arange(len(values), dtype=numpy.int64)
+            for code in numpy.unique(token_codes).tolist():
+                rows = numpy.flatnonzero(token_codes == code)
+                self._merge(tokens[code], _pack_keys(angle_keys[rows], stretch_keys[rows]), values[rows], used[rows])
+            self._clock += len(values)
+            self._evict()
+        return True
+
+    def _merge(self, token, keys, values, used):
+        """
+        Merge results into the sorted arrays of a token, replacing the results of keys which are already there.
+        :param used: the operation number to mark the results with, a single number or one for each result
+        """
+        used = numpy.broadcast_to(numpy.asarray(used, dtype=numpy.int64), keys.shape)
+        keys, first = numpy.unique(keys, return_index=True)
+        values = numpy.asarray(values, dtype=numpy.float64)[first]
+        used = used[first]
+
+        table = self._tables.get(token)
+        if table is None or not len(table[0]):
+            self._tables[token] = [keys, values, used]
+            return
+        positions, found = _search(table[0], keys)
+        table[1][positions[found]] = values[found]
+        table[2][positions[found]] = used[found]
+
+        # The new keys are sorted, so inserting each before the first larger key keeps the arrays sorted
+        new = ~found
+        positions = numpy.searchsorted(table[0], keys[new])
+        self._tables[token] = [numpy.insert(table[0], positions, keys[new]),
+                               numpy.insert(table[1], positions, values[new]),
+                               numpy.insert(table[2], positions, used[new])]
+
+    def _evict(self):
+        """
+        Drop the least recently used results until there are no more than max_entries.
+        """
+        excess = len(self) - self.max_entries
+        if excess <= 0:
+            return
+        tokens = list(self._tables)
+        used = numpy.concatenate([self._tables[token][2] for token in tokens])
+        drop = numpy.zeros(len(used), dtype=bool)
+        drop[numpy.argpartition(used, excess - 1)[:excess]] = True
+
+        start = 0
+        for token in tokens:
+            table = self._tables[token]
+            keep = ~drop[start:start + len(table[0])]
+            start += len(table[0])
+            self._tables[token] = [array[keep] for array in table]
+            if not keep.any():
+                del self._tables[token]
+        self.evictions += excess
+
+
+def _pack_keys(angle_keys, stretch_keys):
+    """
+    Pack arrays of angle and stretch keys into a single complex array.  Numpy sorts complex numbers by their real and
+    then their imaginary parts, so the packed keys sort by angle and then stretch, and they are sorted and searched
+    natively.
+    """
+    return numpy.asarray(angle_keys, dtype=numpy.float64) + 1j * numpy.asarray(stretch_keys, dtype=numpy.float64)
+
+
+def _search(table_keys, keys):
+    """
+    Find keys in a non-empty sorted array of keys.
+    :return: the positions of the keys in the sorted array, and a boolean array of which of them were found there
+    """
+    positions = numpy.minimum(numpy.searchsorted(table_keys, keys), len(table_keys) - 1)
+    return positions, table_keys[positions] == keys
+
+
+class MemoizedSimulator:
+    """
+    A MemoizedSimulator puts an EvaluationCache in front of a simulator (a SolutionManifold or SolutionManifoldPool)
+    and has the same methods, so it can be used in its place.  Only the points which are not in the cache are passed
+    on to the simulator, in a single batch.  The hits and misses of this simulator alone are kept in its own counters,
+    so the savings of a single analysis can be reported even when the cache is shared.
+    """
+
+    def __init__(self, simulator, token, cache=None):
+        """
+        :param simulator: the simulator to pass cache misses on to
+        :param token: the manifold token of the simulator's settings
+        :param cache: the EvaluationCache to use, defaults to the shared EVALUATION_CACHE
+        """
+        self.simulator = simulator
+        self.token = token
+        self.cache = cache if cache is not None else EVALUATION_CACHE
+        self.hits = 0
+        self.misses = 0
+
+    def get_closest_approach(self, angle, stretch):
+        """ Return the closest approach of a single point. """
+        value = self.cache.get(self.token, angle, stretch)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = float(self.simulator.get_closest_approach(angle, stretch))
+        self.cache.put(self.token, angle, stretch, value)
+        return value
+
+    def closest_approach_batch(self, angles, stretches):
+        """ Return a numpy array of the closest approaches of arrays of angles
+        and stretches, simulating only the points which are not cached. """
+        angles, stretches = numpy.broadcast_arrays(numpy.asarray(angles, dtype=numpy.float64),
+                                                   numpy.asarray(stretches, dtype=numpy.float64))
+        flat_angles = angles.ravel()
+        flat_stretches = stretches.ravel()
+        angle_keys, stretch_keys = self.cache.quantize(flat_angles, flat_stretches)
+        results = self.cache.lookup(self.token, angle_keys, stretch_keys)
+
+        missing = numpy.flatnonzero(numpy.isnan(results))
+        sent = 0
+        if len(missing):
+            # Points which share a key within the batch are only simulated once, and only those count as misses
+            keys = _pack_keys(angle_keys[missing], stretch_keys[missing])
+            unique_keys, first, inverse = numpy.unique(keys, return_index=True, return_inverse=True)
+            sent = len(unique_keys)
+            values = numpy.asarray(self.simulator.closest_approach_batch(flat_angles[missing[first]],
+                                                                         flat_stretches[missing[first]]),
+                                   dtype=numpy.float64)
+            self.cache.store(self.token, unique_keys.real, unique_keys.imag, values)
+            results[missing] = values[inverse.ravel()]
+        self.hits += len(results) - sent
+        self.misses += sent
+        return results.reshape(angles.shape)
+
+    def closest_approach_batch_uncached(self, angles, stretches):
+        """ Return a numpy array of the closest approaches of arrays of angles and stretches, simulating every point
+        without looking it up in the cache or storing it there.  Every point counts as a miss. """
+        results = numpy.asarray(self.simulator.closest_approach_batch(angles, stretches), dtype=numpy.float64)
+        self.misses += results.size
+        return results
+
+    def stats(self):
+        """
+        Return a dictionary of this simulator's "hits" and "misses" and the "hit_rate".  The misses are the points
+        which were passed on to the simulator, so a point repeated within a batch is a single miss and its repeats are
+        hits, and the hits are every other point which was asked for.
+        """
+        lookups = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / float(lookups) if lookups else 0.0}
+
+    def close_process(self):
+        self.simulator.close_process()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close_process()
+
+
+# The shared cache of closest approach results used by the cost analyses
+EVALUATION_CACHE = EvaluationCache()
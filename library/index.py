@@ -0,0 +1,288 @@
+"""
+    index.py
+
+    This module maintains a persistent metadata index for a folder of test files.  The index is a small SQLite database
+    which lives inside the library folder and records, for every .json file, whether it is a valid test, the header
+    fields which are most commonly used for filtering and sorting, and the manifold token of its settings.  When a
+    TestLibrary is opened again later, only the files whose size or modification time have changed are parsed, and the
+    rest of the information comes straight from the index.
+"""
+import os
+import json
+import sqlite3
+import datetime
+
+INDEX_FILE_NAME = ".test_index.sqlite"
+
+# Bump this when the table layout changes, the index will be rebuilt from scratch on the next update
+SCHEMA_VERSION = 2
+
+# The header fields which are stored in the index, along with their sqlite column types.  The timestamp is stored as
+# seconds since the epoch and every other field as json text, so that it comes back with the same python type as it
+# has in the loaded test (a test_id of 12345 stays an integer, for instance).
+HEADER_FIELDS = [("subject", "TEXT"),
+                 ("timestamp", "REAL"),
+                 ("outcome", "TEXT"),
+                 ("release_angle", "TEXT"),
+                 ("release_stretch", "TEXT"),
+                 ("closest_approach", "TEXT"),
+                 ("test_id", "TEXT")]
+
+# The header fields which get a hash index, so that equality filters on them can be answered without opening files
+INDEXED_FIELDS = ("subject", "outcome", "manifold_token", "test_id")
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def timestamp_to_seconds(timestamp):
+    """
+    Convert a test timestamp (a naive datetime object) to floating point seconds since the epoch for storage.
+    """
+    return (timestamp - EPOCH).total_seconds()
+
+
+def seconds_to_timestamp(seconds):
+    """
+    Convert floating point seconds since the epoch back into a naive datetime object.
+    """
+    return EPOCH + datetime.timedelta(seconds=seconds)
+
+
+def encode_field(field, value):
+    """
+    Convert the value of a header field into the form it is stored in the index (see HEADER_FIELDS).
+    """
+    if value is None:
+        return None
+    if field == "timestamp":
+        return timestamp_to_seconds(value)
+    return json.dumps(value)
+
+
+def decode_field(field, value):
+    """
+    Convert a header field read from the index back into the value it has in the loaded test.
+    """
+    if value is None:
+        return None
+    if field == "timestamp":
+        return seconds_to_timestamp(value)
+    return json.loads(value)
+
+
+def manifold_token(data):
+    """
+    Return the manifold token of a loaded test dictionary, which is the one stored with it when it was loaded if it has
+    one (see manifold.get_manifold_token), or None if its settings are missing any of the fields the token is made of.
+    """
+    try:
+        import manifold
+    except:
+        import library.manifold as manifold
+    try:
+        return manifold.get_manifold_token(data)
+    except (KeyError, TypeError):
+        return None
+
+
+def extract_header(data):
+    """
+    Extract the indexed header fields and the manifold token from a loaded test dictionary.
+    :param data: a test dictionary as returned by tests.load_test_file
+    :return: a dictionary of the header fields, with None for any fields missing from the test and for the manifold
+    token of a test with incomplete settings
+    """
+    header = {}
+    for field, column_type in HEADER_FIELDS:
+        header[field] = data.get(field)
+    header['manifold_token'] = manifold_token(data)
+    return header
+
+
+class HeaderTable(dict):
+    """
+    A dictionary of file path to header dictionary, which builds a hash index of value to file paths for each of the
+    INDEXED_FIELDS the first time that field is looked up.  The hash indexes are discarded whenever the table changes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._hash_indexes = {}
+
+    def lookup(self, field, value):
+        """
+        Return the set of file paths whose header has the given value for an indexed field.
+        :param field: one of the INDEXED_FIELDS
+        :param value: the value to match
+        :return: a set of file paths
+        """
+        hash_index = self._hash_indexes.get(field)
+        if hash_index is None:
+            hash_index = {}
+            for path, header in list(self.items()):
+                hash_index.setdefault(header.get(field), set()).add(path)
+            self._hash_indexes[field] = hash_index
+        return hash_index.get(value, set())
+
+    def __setitem__(self, key, value):
+        self._hash_indexes = {}
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._hash_indexes = {}
+        dict.__delitem__(self, key)
+
+    def clear(self):
+        self._hash_indexes = {}
+        dict.clear(self)
+
+    def update(self, *args, **kwargs):
+        self._hash_indexes = {}
+        dict.update(self, *args, **kwargs)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._hash_indexes = {}
+        return dict.setdefault(self, key, default)
+
+    def pop(self, key, *default):
+        self._hash_indexes = {}
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        self._hash_indexes = {}
+        return dict.popitem(self)
+
+
+class LibraryIndex:
+    """
+    The LibraryIndex class wraps the sidecar SQLite database of a test library folder.  The update() method brings the
+    index up to date with the contents of the folder and returns the headers of all of the valid tests.
+    """
+
+    def __init__(self, library_path):
+        """
+        :param library_path: the directory path of the test library
+        """
+        self.library_path = library_path
+        self.index_path = os.path.join(library_path, INDEX_FILE_NAME)
+        self.connection = sqlite3.connect(self.index_path)
+        self.__prepare_schema()
+
+    def __prepare_schema(self):
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self.connection.execute("DROP TABLE IF EXISTS files")
+
+        columns = ", ".join(["{} {}".format(field, column_type) for field, column_type in HEADER_FIELDS])
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+                                "valid INTEGER, {}, manifold_token TEXT)".format(columns))
+        self.connection.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+        self.connection.commit()
+
+    def __known_files(self):
+        known = {}
+        for row in self.connection.execute("SELECT name, size, mtime FROM files"):
+            known[row[0]] = (row[1], row[2])
+        return known
+
+    def __changed_files(self, file_names, known):
+        changed = []
+        for name in file_names:
+            try:
+                stat = os.stat(os.path.join(self.library_path, name))
+            except OSError:
+                continue
+            if known.get(name) != (stat.st_size, stat.st_mtime):
+                changed.append((name, stat.st_size, stat.st_mtime))
+        return changed
+
+    def stale(self, file_names):
+        """
+        Return the names of the files which are new or have changed since they were indexed, and which would therefore
+        be loaded by the next update().
+        :param file_names: a list of the names (not full paths) of the .json files in the library folder
+        :return: a list of file names
+        """
+        return [name for name, size, mtime in self.__changed_files(file_names, self.__known_files())]
+
+    def update(self, file_names, loader):
+        """
+        Bring the index up to date with a list of file names in the library folder.  Files which are new or whose size
+        or modification time have changed are loaded with the loader and re-indexed, entries for files which are no
+        longer present are removed.
+        :param file_names: a list of the names (not full paths) of the .json files in the library folder
+        :param loader: a function which takes a file path and returns a test dictionary or None if it isn't valid
+        :return: a list of (path, header) tuples for every valid test, in the order of file_names
+        """
+        known = self.__known_files()
+        present = set(file_names)
+        self.__index_files(self.__changed_files(file_names, known), loader)
+        self.__remove_files([name for name in known if name not in present])
+        self.connection.commit()
+
+        headers = self.headers()
+        output = []
+        for name in file_names:
+            path = os.path.join(self.library_path, name)
+            if path in headers:
+                output.append((path, headers[path]))
+        return output
+
+    def refresh(self, file_names, loader, removed=()):
+        """
+        Re-index a few files which are known to be new or changed and drop the entries of files which are known to be
+        removed, without reading the rest of the index.  This is how a LibraryWatcher keeps the index up to date on
+        every poll.
+        :param file_names: a list of the names of the new or changed files
+        :param loader: a function which takes a file path and returns a test dictionary or None if it isn't valid
+        :param removed: a list of the names of the files which are no longer in the folder
+        """
+        self.__index_files(self.__changed_files(file_names, {}), loader)
+        self.__remove_files(removed)
+        self.connection.commit()
+
+    def __index_files(self, changed, loader):
+        field_names = [field for field, column_type in HEADER_FIELDS]
+        insert = "INSERT OR REPLACE INTO files (name, size, mtime, valid, {}, manifold_token) VALUES ({})".format(
+            ", ".join(field_names), ", ".join(["?"] * (len(field_names) + 5)))
+
+        for name, size, mtime in changed:
+            data = loader(os.path.join(self.library_path, name))
+            if data is None:
+                self.connection.execute(insert, [name, size, mtime, 0] + [None] * (len(field_names) + 1))
+                continue
+            header = extract_header(data)
+            self.connection.execute(insert, [name, size, mtime, 1] + [encode_field(f, header[f]) for f in field_names]
+                                    + [header['manifold_token']])
+
+    def __remove_files(self, names):
+        self.connection.executemany("DELETE FROM files WHERE name = ?", [(name, ) for name in names])
+
+    def stamps(self):
+        """
+        Return a dictionary of file path to the (size, mtime) stamp each file had when it was indexed, for the files
+        which aren't valid tests as well as those which are.
+        """
+        return dict((os.path.join(self.library_path, name), stamp) for name, stamp in self.__known_files().items())
+
+    def headers(self):
+        """
+        Return a dictionary of file path to header dictionary for every valid test in the index.  The fields have the
+        same values and types as in the test dictionaries load_test_file produces.
+        """
+        field_names = [field for field, column_type in HEADER_FIELDS]
+        query = "SELECT name, manifold_token, {} FROM files WHERE valid = 1".format(", ".join(field_names))
+
+        output = {}
+        for row in self.connection.execute(query):
+            header = dict((field, decode_field(field, value)) for field, value in zip(field_names, row[2:]))
+            header['manifold_token'] = row[1]
+            output[os.path.join(self.library_path, row[0])] = header
+        return output
+
+    def close(self):
+        """
+        Close the connection to the index database.
+        """
+        self.connection.close()
@@ -0,0 +1,356 @@
+"""
+    ingest.py
+
+    This module contains the live ingest mode of a TestLibrary.  During a data collection session new test files land in
+    the library folder every few seconds, and rebuilding the library and summarizing it from scratch each time means
+    parsing every file again.  The LibraryWatcher polls the folder instead, picks up only the files which are new or
+    have changed since the last poll, validates them, adds them to the library, and passes them to a set of running
+    aggregates and callbacks.
+
+    An aggregate is any object with add(path, header) and remove(path, header) methods, where the header is the test
+    dictionary without its trace (see tests.load_test_header).  A file which changes on disk is removed from the
+    aggregates with its old header and added again with its new one.  Three aggregates are provided: RunningSummary,
+    which keeps the same figures as TestGroup.summarize(), SubjectMeans, which keeps the per-subject means of numeric
+    fields, and BlockTracker, which follows the block boundaries of each subject the same way break_into_blocks does.
+"""
+import bisect
+import datetime
+import os
+import threading
+import time
+
+try:
+    import tests
+    import index
+    import record_cache
+except:
+    import library.tests as tests
+    import library.index as index
+    import library.record_cache as record_cache
+
+
+class RunningSummary:
+    """
+    Running counts of the tests seen by a watcher, reported in the same form as TestGroup.summarize().
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.outcomes = {}
+        self.subjects = {}
+        self.timestamps = []
+
+    def add(self, path, header):
+        self.count += 1
+        self.outcomes[header.get('outcome')] = self.outcomes.get(header.get('outcome'), 0) + 1
+        self.subjects[header.get('subject')] = self.subjects.get(header.get('subject'), 0) + 1
+        bisect.insort(self.timestamps, header['timestamp'])
+
+    def remove(self, path, header):
+        self.count -= 1
+        for tally, key in ((self.outcomes, 'outcome'), (self.subjects, 'subject')):
+            tally[header.get(key)] -= 1
+            if not tally[header.get(key)]:
+                del tally[header.get(key)]
+        del self.timestamps[bisect.bisect_left(self.timestamps, header['timestamp'])]
+
+    def summary(self):
+        """
+        Return a summary dictionary of the tests seen so far, with the same keys as TestGroup.summarize()
+        """
+        span = self.timestamps[-1] - self.timestamps[0] if self.timestamps else datetime.timedelta(0)
+        return {"subjects": sorted(subject for subject in self.subjects if subject is not None),
+                "count": self.count,
+                "hits": self.outcomes.get("hit", 0),
+                "misses": self.outcomes.get("miss", 0),
+                "obstacles": self.outcomes.get("obstacle", 0),
+                "timespan": tests.td_format(span)}
+
+
+class SubjectMeans:
+    """
+    Running per-subject means of numeric fields of the tests seen by a watcher.
+    """
+
+    def __init__(self, keys=("closest_approach", "release_angle", "release_stretch")):
+        """
+        :param keys: the numeric fields to average
+        """
+        self.keys = tuple(keys)
+        self.totals = {}
+
+    def add(self, path, header):
+        self.__accumulate(header, 1)
+
+    def remove(self, path, header):
+        self.__accumulate(header, -1)
+
+    def __accumulate(self, header, sign):
+        totals = self.totals.setdefault(header.get('subject'), {})
+        for key in self.keys:
+            value = header.get(key)
+            if value is None:
+                continue
+            count, total = totals.get(key, (0, 0.0))
+            totals[key] = (count + sign, total + sign * value)
+
+    def means(self, subject=None):
+        """
+        Return a dictionary of key to mean value for one subject, or a dictionary of subject to such dictionaries if no
+        subject is given.  Keys with no values are left out.
+        """
+        if subject is None:
+            return dict((name, self.means(name)) for name in self.totals)
+        totals = self.totals.get(subject, {})
+        return dict((key, total / count) for key, (count, total) in totals.items() if count)
+
+
+class BlockTracker:
+    """
+    Follows the blocks of each subject as the tests arrive, where a block is a set of time-adjacent trials separated
+    from the next by more than time_delay, the same as TestGroup.break_into_blocks.  Tests which arrive out of order are
+    placed correctly.
+    """
+
+    def __init__(self, time_delay=datetime.timedelta(minutes=10), on_new_block=None):
+        """
+        :param time_delay: the minimum span between two time-adjacent trials which starts a new block
+        :param on_new_block: optional function called with the subject and the timestamp of the first trial whenever a
+        test starts a new block at the end of a subject's trials
+        """
+        self.time_delay = time_delay
+        self.on_new_block = on_new_block
+        self.timestamps = {}
+
+    def add(self, path, header):
+        timestamps = self.timestamps.setdefault(header.get('subject'), [])
+        timestamp = header['timestamp']
+        position = bisect.bisect_right(timestamps, timestamp)
+        timestamps.insert(position, timestamp)
+        if position == len(timestamps) - 1 and (position == 0 or timestamp - timestamps[-2] > self.time_delay):
+            if self.on_new_block is not None:
+                self.on_new_block(header.get('subject'), timestamp)
+
+    def remove(self, path, header):
+        timestamps = self.timestamps[header.get('subject')]
+        del timestamps[bisect.bisect_left(timestamps, header['timestamp'])]
+        if not timestamps:
+            del self.timestamps[header.get('subject')]
+
+    def block_count(self, subject):
+        """
+        Return the number of blocks the subject's trials fall into.
+        """
+        timestamps = self.timestamps.get(subject, [])
+        if not timestamps:
+            return 0
+        return 1 + sum(1 for a, b in zip(timestamps, timestamps[1:]) if b - a > self.time_delay)
+
+    def current_block(self, subject):
+        """
+        Return a dictionary describing the latest block of a subject, with its "start" and "end" timestamps and the
+        "count" of trials in it, or None if no trials of the subject have been seen.
+        """
+        timestamps = self.timestamps.get(subject)
+        if not timestamps:
+            return None
+        first = len(timestamps) - 1
+        while first > 0 and timestamps[first] - timestamps[first - 1] <= self.time_delay:
+            first -= 1
+        return {"start": timestamps[first], "end": timestamps[-1], "count": len(timestamps) - first}
+
+
+class LibraryWatcher:
+    """
+    The LibraryWatcher polls the folder of a TestLibrary for new, changed and removed .json files.  Each poll only looks
+    at the size and modification time of the files, and only the files which differ from the last poll are loaded.
+    Valid tests are added to (or removed from) the library's file list, the subscribed aggregates, and the callbacks,
+    which are called with the event ("added", "changed" or "removed"), the file path and the test header (None for a
+    removed file).
+
+    A file which can't be parsed, such as one which is still being written, is listed in errors and tried again on the
+    next poll.  The library is changed while holding its lock (see tests.TestLibrary), and only the files picked up by
+    a poll are written to its index.  A watcher on a library with an index starts from the stamps and headers held in
+    the index, so none of the files are read until they change; the headers of those tests hold just the fields of
+    index.HEADER_FIELDS.
+    """
+
+    def __init__(self, library, interval=2.0):
+        """
+        :param library: the TestLibrary to keep up to date
+        :param interval: the number of seconds between polls when running
+        """
+        self.library = library
+        self.interval = interval
+        self.aggregates = []
+        self.callbacks = []
+        self.errors = {}
+        self.failure = None
+        self.seen = {}
+        self._lock = threading.RLock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._index = None
+
+        with library.lock:
+            if library.index is not None:
+                for path, stamp in library.index.stamps().items():
+                    self.seen[path] = (stamp, library.headers.get(path))
+            else:
+                for path in library.files:
+                    self.seen[path] = (record_cache.file_stamp(path), tests.load_cached_test_header(path))
+
+    def subscribe(self, aggregate):
+        """
+        Add a running aggregate, which is first brought up to date with every test this watcher has already seen.  Tests
+        which reached the library some other way (through update_library, say) are added by the next poll.
+        :param aggregate: an object with add(path, header) and remove(path, header) methods
+        :return: the aggregate
+        """
+        with self._lock:
+            for path, (stamp, header) in list(self.seen.items()):
+                if header is not None:
+                    aggregate.add(path, header)
+            self.aggregates.append(aggregate)
+        return aggregate
+
+    def add_callback(self, callback):
+        """
+        Add a function to be called as callback(event, path, header) for every file picked up by a poll.
+        """
+        with self._lock:
+            self.callbacks.append(callback)
+        return callback
+
+    def poll(self):
+        """
+        Check the library folder once and process any new, changed or removed files.
+        :return: a list of (event, path, header) tuples in the order they were processed
+        """
+        with self._lock:
+            names = sorted(item for item in os.listdir(self.library.library_path) if item.endswith(".json"))
+            paths = [os.path.join(self.library.library_path, name) for name in names]
+
+            events = []
+            for path in paths:
+                stamp = record_cache.file_stamp(path)
+                previous = self.seen.get(path)
+                if stamp is None or (previous is not None and previous[0] == stamp):
+                    continue
+                try:
+                    header = tests.load_cached_test_header(path)
+                except Exception as e:
+                    tests.HEADER_CACHE.invalidate(path)
+                    self.errors[path] = "{}: {}".format(type(e).__name__, e)
+                    continue
+                self.errors.pop(path, None)
+                self.seen[path] = (stamp, header)
+
+                if previous is not None and previous[1] is not None:
+                    events.append(("changed" if header is not None else "removed", path, header, previous[1]))
+                elif header is not None:
+                    events.append(("added", path, header, None))
+
+            present = set(paths)
+            for path in [path for path in self.errors if path not in present]:
+                del self.errors[path]
+            for path in [path for path in self.seen if path not in present]:
+                stamp, header = self.seen.pop(path)
+                if header is not None:
+                    events.append(("removed", path, None, header))
+
+            if events:
+                self.__apply(events, present)
+
+            output = []
+            for event, path, header, old_header in events:
+                for aggregate in self.aggregates:
+                    if old_header is not None:
+                        aggregate.remove(path, old_header)
+                    if header is not None:
+                        aggregate.add(path, header)
+                for callback in self.callbacks:
+                    callback(event, path, header)
+                output.append((event, path, header))
+            return output
+
+    def __apply(self, events, present):
+        """
+        Bring the library's file list, headers and index up to date with a list of events.
+        :param events: the events of a poll
+        :param present: the set of the paths of the .json files which are in the folder
+        """
+        library = self.library
+        removed = set(path for event, path, header, old_header in events if header is None)
+        added = [path for event, path, header, old_header in events if event == "added"]
+
+        if library.index is not None:
+            # sqlite connections can't be shared between threads, so a watcher running in the background keeps its own
+            if threading.current_thread() is self._thread:
+                if self._index is None:
+                    self._index = index.LibraryIndex(library.library_path)
+                library_index = self._index
+            else:
+                library_index = library.index
+            names = [os.path.basename(path) for event, path, header, old_header in events]
+            library_index.refresh([name for name, event in zip(names, events) if event[1] in present],
+                                  tests.load_cached_test_header,
+                                  [name for name, event in zip(names, events) if event[1] not in present])
+
+        with library.lock:
+            # A file may already be listed if the library was updated since the watcher last saw the folder
+            listed = set(library.files)
+            library.files = ([path for path in library.files if path not in removed]
+                             + [path for path in added if path not in listed])
+            if library.index is not None:
+                for path in removed:
+                    library.headers.pop(path, None)
+                for event, path, header, old_header in events:
+                    if header is not None:
+                        library.headers[path] = index.extract_header(header)
+
+    def run(self, duration=None):
+        """
+        Poll the library folder every interval seconds until stop() is called, or for duration seconds if given.
+        """
+        self._stop_event.clear()
+        end = None if duration is None else time.time() + duration
+        while not self._stop_event.is_set():
+            self.poll()
+            if end is not None and time.time() >= end:
+                break
+            self._stop_event.wait(self.interval)
+
+    def start(self):
+        """
+        Start polling in a background thread.  If a poll raises an exception (for example from a callback) the thread
+        stops and the exception is kept in self.failure.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return self
+
+        def target():
+            try:
+                self.run()
+            except Exception as e:
+                self.failure = e
+            finally:
+                if self._index is not None:
+                    self._index.close()
+                    self._index = None
+
+        self.failure = None
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=target)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop a watcher which was started with start(), waiting for the current poll to finish.
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
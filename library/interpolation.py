@@ -0,0 +1,213 @@
+"""
+    interpolation.py
+
+    This module contains the ManifoldInterpolator, a surrogate for the simulator which answers closest approach queries
+    by interpolating the grid of a solution manifold (as computed by the Manifold Mapper and cached by
+    manifold.get_solution_manifold) instead of simulating each throw.
+
+    The closest approach is smooth over most of the solution space, but it jumps where the outcome changes (the edges
+    of the obstacle and of the hit region) and where the sign changes (the ball passing above rather than below the
+    target).  Interpolating across one of those jumps gives values which are simply wrong, so every grid cell whose
+    corners disagree in outcome or in sign is marked, and queries falling in a marked cell (or outside of the grid) are
+    passed on to the exact simulator.  Every cell also carries an estimate of its interpolation error, taken as the
+    difference between the bilinear and bicubic interpolants at the center of the cell (or, when verifying, the actual
+    error at a set of probe points inside it), and cells whose estimate is above an optional tolerance are passed on to
+    the simulator as well.  Some discontinuities don't show at the corners of a cell at all, so for dependable results
+    the interpolator should be created with verify=True and a tolerance.
+"""
+import numpy
+
+try:
+    import manifold as manifold_library
+except:
+    import library.manifold as manifold_library
+
+METHODS = ("bilinear", "bicubic")
+
+# The fractional positions along each axis of a cell at which a verifying interpolator simulates its probes
+VERIFY_POSITIONS = (0.25, 0.5, 0.75)
+
+
+def cubic_weights(t):
+    """
+    Return the four cubic convolution (Catmull-Rom) weights of the grid points at offsets -1, 0, 1 and 2 from the start
+    of a cell, for fractional positions t within the cell.
+    """
+    t2 = t * t
+    t3 = t2 * t
+    return (-0.5 * t3 + t2 - 0.5 * t,
+            1.5 * t3 - 2.5 * t2 + 1.0,
+            -1.5 * t3 + 2.0 * t2 + 0.5 * t,
+            0.5 * t3 - 0.5 * t2)
+
+
+class ManifoldInterpolator:
+    """
+    The ManifoldInterpolator answers closest approach queries from the grid of a solution manifold by bilinear or
+    bicubic interpolation, and falls back to an exact simulator in cells which straddle a discontinuity.  It has the
+    same methods as a SolutionManifold, so it can be used in place of one.
+    """
+
+    def __init__(self, manifold, simulator, method="bilinear", tolerance=None, verify=False):
+        """
+        :param manifold: a solution manifold, as returned by manifold.get_solution_manifold (a ManifoldGrid or a
+        dictionary of points)
+        :param simulator: the exact simulator for the same settings (a SolutionManifold, SolutionManifoldPool or
+        MemoizedSimulator), used for the queries which can't be interpolated
+        :param method: "bilinear" or "bicubic"
+        :param tolerance: optionally, the largest estimated interpolation error (in pixels) of a cell which is still
+        interpolated.  Cells with a larger estimate are simulated exactly.
+        :param verify: simulate a 3 x 3 set of probe points inside every cell (see VERIFY_POSITIONS) and use the
+        largest actual error of the interpolant at the probes as the error estimate of the cell.  Cells where a probe
+        has a different sign from the corners are simulated exactly from then on, which catches discontinuities that
+        don't show at the corners.
+        """
+        if method not in METHODS:
+            raise Exception("The interpolation method must be one of: " + ", ".join(METHODS))
+        self.simulator = simulator
+        self.method = method
+        self.tolerance = tolerance
+        self.interpolated = 0
+        self.simulated = 0
+
+        grid = manifold_library.as_manifold_grid(manifold)
+        if len(grid.angles) < 2 or len(grid.stretches) < 2:
+            raise Exception("The manifold must have at least two angles and two stretches to interpolate")
+        if not grid.is_complete():
+            raise Exception("The manifold is not a complete grid of angles and stretches")
+        self.angles = numpy.asarray(grid.angles, dtype=numpy.float64)
+        self.stretches = numpy.asarray(grid.stretches, dtype=numpy.float64)
+        self.cpa = numpy.asarray(grid.cpa, dtype=numpy.float64)
+        outcomes = numpy.asarray(grid.outcome)
+
+        # A cell straddles a discontinuity if its corners don't all share the same outcome and sign
+        signs = numpy.sign(self.cpa)
+        discontinuous = numpy.zeros((len(self.stretches) - 1, len(self.angles) - 1), dtype=bool)
+        for grid in (outcomes, signs):
+            corners = [grid[:-1, :-1], grid[:-1, 1:], grid[1:, :-1], grid[1:, 1:]]
+            for corner in corners[1:]:
+                discontinuous |= corner != corners[0]
+
+        # The bicubic interpolant of a cell also uses the ring of grid points around it, so a discontinuity in any of
+        # the neighbouring cells spoils it too
+        if method == "bicubic":
+            padded = numpy.pad(discontinuous, 1, mode="constant")
+            spread = numpy.zeros(discontinuous.shape, dtype=bool)
+            for dj in range(3):
+                for di in range(3):
+                    spread |= padded[dj:dj + discontinuous.shape[0], di:di + discontinuous.shape[1]]
+            discontinuous = spread
+        self.discontinuous = discontinuous
+
+        # The error estimate of each cell is the difference of the two interpolants at its center
+        cell_j, cell_i = numpy.meshgrid(numpy.arange(discontinuous.shape[0]), numpy.arange(discontinuous.shape[1]),
+                                        indexing="ij")
+        half = numpy.full(cell_j.shape, 0.5)
+        self.cell_error = numpy.abs(self.__bilinear(cell_j, cell_i, half, half) -
+                                    self.__bicubic(cell_j, cell_i, half, half))
+
+        if verify:
+            for t_stretch in VERIFY_POSITIONS:
+                for t_angle in VERIFY_POSITIONS:
+                    probe_angle = self.angles[cell_i] + t_angle * (self.angles[cell_i + 1] - self.angles[cell_i])
+                    probe_stretch = self.stretches[cell_j] + t_stretch * (self.stretches[cell_j + 1] -
+                                                                          self.stretches[cell_j])
+                    exact = numpy.asarray(simulator.closest_approach_batch(probe_angle, probe_stretch),
+                                          dtype=numpy.float64)
+                    fraction_j = numpy.full(cell_j.shape, t_stretch)
+                    fraction_i = numpy.full(cell_j.shape, t_angle)
+                    if method == "bicubic":
+                        interpolated = self.__bicubic(cell_j, cell_i, fraction_j, fraction_i)
+                    else:
+                        interpolated = self.__bilinear(cell_j, cell_i, fraction_j, fraction_i)
+                    self.cell_error = numpy.maximum(self.cell_error, numpy.abs(interpolated - exact))
+                    discontinuous = discontinuous | (numpy.sign(exact) != signs[:-1, :-1])
+
+        self.exact = discontinuous.copy()
+        if tolerance is not None:
+            self.exact |= self.cell_error > tolerance
+
+    def locate(self, angles, stretches):
+        """
+        Find the grid cells of a set of points.
+        :return: the stretch and angle cell indices, the fractional positions of the points within their cells, and a
+        boolean array marking the points which lie outside of the grid
+        """
+        i = numpy.clip(numpy.searchsorted(self.angles, angles, side="right") - 1, 0, len(self.angles) - 2)
+        j = numpy.clip(numpy.searchsorted(self.stretches, stretches, side="right") - 1, 0, len(self.stretches) - 2)
+        t_angle = (angles - self.angles[i]) / (self.angles[i + 1] - self.angles[i])
+        t_stretch = (stretches - self.stretches[j]) / (self.stretches[j + 1] - self.stretches[j])
+        outside = ((angles < self.angles[0]) | (angles > self.angles[-1]) |
+                   (stretches < self.stretches[0]) | (stretches > self.stretches[-1]))
+        return j, i, t_stretch, t_angle, outside
+
+    def __bilinear(self, j, i, t_stretch, t_angle):
+        f = self.cpa
+        bottom = f[j, i] * (1 - t_angle) + f[j, i + 1] * t_angle
+        top = f[j + 1, i] * (1 - t_angle) + f[j + 1, i + 1] * t_angle
+        return bottom * (1 - t_stretch) + top * t_stretch
+
+    def __bicubic(self, j, i, t_stretch, t_angle):
+        f = self.cpa
+        rows, columns = f.shape
+        angle_weights = cubic_weights(t_angle)
+        stretch_weights = cubic_weights(t_stretch)
+        output = numpy.zeros(numpy.shape(t_angle))
+        for dj, stretch_weight in zip(range(-1, 3), stretch_weights):
+            row = numpy.clip(j + dj, 0, rows - 1)
+            line = numpy.zeros(numpy.shape(t_angle))
+            for di, angle_weight in zip(range(-1, 3), angle_weights):
+                line += angle_weight * f[row, numpy.clip(i + di, 0, columns - 1)]
+            output += stretch_weight * line
+        return output
+
+    def error_estimate(self, angles, stretches):
+        """
+        Return the estimated interpolation error of a set of points, which is zero for points which would be simulated
+        exactly.
+        """
+        angles, stretches = numpy.broadcast_arrays(numpy.asarray(angles, dtype=numpy.float64),
+                                                   numpy.asarray(stretches, dtype=numpy.float64))
+        j, i, t_stretch, t_angle, outside = self.locate(angles, stretches)
+        return numpy.where(outside | self.exact[j, i], 0.0, self.cell_error[j, i])
+
+    def get_closest_approach(self, angle, stretch):
+        """ Return the closest approach of a single point. """
+        return float(self.closest_approach_batch([angle], [stretch])[0])
+
+    def closest_approach_batch(self, angles, stretches):
+        """ Return a numpy array of the closest approaches of arrays of angles
+        and stretches, interpolated where the grid allows and simulated exactly
+        everywhere else. """
+        angles, stretches = numpy.broadcast_arrays(numpy.asarray(angles, dtype=numpy.float64),
+                                                   numpy.asarray(stretches, dtype=numpy.float64))
+        j, i, t_stretch, t_angle, outside = self.locate(angles, stretches)
+        if self.method == "bicubic":
+            results = self.__bicubic(j, i, t_stretch, t_angle)
+        else:
+            results = self.__bilinear(j, i, t_stretch, t_angle)
+
+        exact = outside | self.exact[j, i]
+        if exact.any():
+            results[exact] = self.simulator.closest_approach_batch(angles[exact], stretches[exact])
+        self.simulated += int(exact.sum())
+        self.interpolated += int(exact.size - exact.sum())
+        return results
+
+    def stats(self):
+        """
+        Return a dictionary with the number of queries which were "interpolated" and "simulated", and the fraction of
+        the grid cells which are always simulated as "exact_cells".
+        """
+        return {"interpolated": self.interpolated,
+                "simulated": self.simulated,
+                "exact_cells": float(self.exact.mean())}
+
+    def close_process(self):
+        self.simulator.close_process()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close_process()
@@ -13,54 +13,320 @@ import json
 import subprocess
 import hashlib
 import math
+import multiprocessing
+import multiprocessing.pool
+import contextlib
+import errno
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import numpy
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
 try:
     import tests
+    import simulation
 except:
     import library.tests as tests
+    import library.simulation as simulation
 
 MODULE_PATH = os.path.dirname(__file__)
 BINARY_FOLDER = os.path.join(MODULE_PATH, "manifold_binaries")
 CACHE_FOLDER  = os.path.join(MODULE_PATH, "manifold_cache")
 
+# The simulator processes which can be used by a SolutionManifold with native=False: the original ComputeSolution.exe
+# and the python stand-in which speaks the same protocol on any platform.  Both read the settings.json file in their
+# working directory, which is a temporary folder of their own.
+COMPUTE_SOLUTION_COMMAND = [os.path.join(BINARY_FOLDER, "ComputeSolution.exe")]
+STANDIN_COMMAND = [sys.executable, os.path.join(os.path.abspath(MODULE_PATH), "simulator_process.py")]
+DEFAULT_COMMAND = COMPUTE_SOLUTION_COMMAND if os.name == "nt" else STANDIN_COMMAND
+
+# Whether a SolutionManifold uses the numpy engine when native isn't given.  Where ComputeSolution.exe can run (on
+# Windows, with the binary in place) it stays the simulator, and the engine, which is checked against its answers in
+# test/data/compute_solution_reference.npz, is only the default where it can't.
+NATIVE_DEFAULT = not (os.name == "nt" and os.path.exists(COMPUTE_SOLUTION_COMMAND[0]))
+
+# The Manifold Mapper, which reads settings.json from its working directory and writes solution_manifold.txt there
+MANIFOLD_MAPPER_COMMAND = [os.path.join(BINARY_FOLDER, "Manifold Mapper.exe")]
+
+# The number of points a SolutionManifold keeps in flight to a simulator process, and the frame header of the binary
+# protocol (the number of points in the frame)
+DEFAULT_WINDOW = 512
+
+# The number of seconds close_process waits for a simulator process to exit before killing it
+CLOSE_TIMEOUT = 5.0
+FRAME_HEADER = struct.Struct("<I")
+
+# The binary cache format keeps each manifold in a folder of .npy files, which are memory-mapped when they are loaded
+GRID_EXTENSION = ".grid"
+GRID_ARRAYS = ("angles", "stretches", "cpa", "outcome")
+MISSING_OUTCOME = -1
+
+# The default size limit of the manifold cache in bytes, beyond which the least recently used manifolds are evicted
+DEFAULT_CACHE_BYTES = 2 * 1024 ** 3
+
+# How often a process waiting for another one to produce a manifold checks the lock, and the age in seconds after
+# which a lock (or a temporary folder) is considered abandoned even if its owner can't be checked.  The holder of a lock
+# touches it LOCK_REFRESHES times per LOCK_STALE period, so a lock is only ever that old if its holder has gone.
+LOCK_POLL = 0.1
+LOCK_STALE = 6 * 3600
+LOCK_REFRESHES = 4
+
 
 class SolutionManifold:
     """ The SolutionManifold class exists to perform live computations of the
     closest approach given a settings file and a series of angles and stretches.
-    The class operates by spawning a background instance of ComputeSolution.exe
-    and communicating with it through the standard in and standard out pipes.
-    When finished, the process is closed with a termination command. """
+    With native=True the computations are done by the numpy reimplementation of
+    the game physics in the simulation module, which runs on any platform.  With
+    native=False the class instead spawns a background simulator process
+    (ComputeSolution.exe, or another command which speaks the same protocol,
+    such as STANDIN_COMMAND) and communicates with it through the standard in
+    and standard out pipes.  When finished, the process is closed with a
+    termination command.  By default ComputeSolution.exe is used where it can
+    run and the numpy engine everywhere else, see NATIVE_DEFAULT.
+
+    Batches of points sent to a process are pipelined, keeping up to window
+    points in flight rather than waiting for each answer before sending the next
+    request.  Simulators which support it (the stand-in does, ComputeSolution.exe
+    does not) can be spoken to with the compact binary framing instead of text by
+    passing binary=True, see simulator_process.py for the format. """
     process = None
+    engine = None
+    working_folder = None
 
-    def __init__(self, settings_object):
+    def __init__(self, settings_object, native=None, command=None, binary=False, window=DEFAULT_WINDOW):
         """ Create an instance of the ComputeManifold class, using a settings
-        dictionary object to give the ComputeSolution.exe process the parameters
-        of the simulation. """
-
-        # Find the executable and create a process
-        # The manifold was not cached and must be generated.
-        current_directory = os.getcwd()
-
-        os.chdir(BINARY_FOLDER)
-        if os.path.exists("settings.json"):
-            os.remove("settings.json")
-
-        with open("settings.json", "w") as handle:
-            handle.write(json.dumps(settings_object, indent=4))
-        self.process = subprocess.Popen("ComputeSolution.exe", stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=256)
-        os.chdir(current_directory)
+        dictionary object to give the simulation its parameters.  If native is
+        False the simulator process given by command is used for the
+        simulation, which defaults to ComputeSolution.exe on Windows and the
+        python stand-in elsewhere.  If native is None it is NATIVE_DEFAULT. """
+        if native is None:
+            native = NATIVE_DEFAULT
+        if native:
+            self.engine = simulation.ClosestApproachEngine(settings_object)
+            return
+
+        self.binary = binary
+        self.window = max(1, window)
+        command = list(command if command is not None else DEFAULT_COMMAND)
+        if binary:
+            command.append("--binary")
+
+        # The process reads its settings from its working directory, which is a
+        # temporary folder of its own so that any number of simulators can run
+        # at once, in this process or in others.
+        self.working_folder = tempfile.mkdtemp(prefix="simulator-")
+        try:
+            with open(os.path.join(self.working_folder, "settings.json"), "w") as handle:
+                handle.write(json.dumps(settings_object, indent=4))
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=256,
+                                            cwd=self.working_folder)
+        except:
+            shutil.rmtree(self.working_folder, ignore_errors=True)
+            raise
 
     def get_closest_approach(self, angle, stretch):
         """ Feed the angle and stretch to the embedded simulation process and
         return the results. """
+        if self.engine is not None:
+            return self.engine.closest_approach(angle, stretch)
+        if self.binary:
+            return float(self.closest_approach_batch([angle], [stretch])[0])
+
         self.process.stdin.write("{},{}\n".format(angle, stretch).encode())
         self.process.stdin.flush()
         self.process.stdout.flush()
         result = self.process.stdout.readline()
         return float(result)
 
-    def close_process(self):
-        self.process.stdin.write("end\n".encode())
+    def closest_approach_batch(self, angles, stretches):
+        """ Return a numpy array of the closest approaches of arrays of angles
+        and stretches.  The numpy engine simulates the whole batch at once, and
+        a simulator process is sent the whole batch through a pipeline. """
+        if self.engine is not None:
+            return self.engine.closest_approach_batch(angles, stretches)
+
+        angles, stretches = numpy.broadcast_arrays(numpy.asarray(angles, dtype=numpy.float64),
+                                                   numpy.asarray(stretches, dtype=numpy.float64))
+        if self.binary:
+            results = self.__binary_batch(angles.ravel(), stretches.ravel())
+        else:
+            results = self.__text_batch(angles.ravel(), stretches.ravel())
+        return results.reshape(angles.shape)
+
+    def __text_batch(self, angles, stretches):
+        """ Stream text requests to the process, topping the pipeline back up to
+        window requests whenever half of them have been answered. """
+        count = len(angles)
+        results = numpy.empty(count)
+        written = 0
+        for i in range(count):
+            if written < count and written - i <= self.window // 2:
+                end = min(count, i + self.window)
+                lines = ["{!r},{!r}\n".format(float(angles[k]), float(stretches[k])) for k in range(written, end)]
+                self.process.stdin.write("".join(lines).encode())
+                self.process.stdin.flush()
+                written = end
+            line = self.process.stdout.readline()
+            if not line:
+                raise Exception("The simulator process ended unexpectedly")
+            results[i] = float(line)
+        return results
+
+    def __binary_batch(self, angles, stretches):
+        """ Stream binary frames of half a window of points to the process,
+        keeping up to a full window in flight. """
+        count = len(angles)
+        results = numpy.empty(count)
+        pairs = numpy.empty((count, 2), dtype="<f8")
+        pairs[:, 0] = angles
+        pairs[:, 1] = stretches
+        frame_size = max(1, self.window // 2)
+
+        written = 0
+        done = 0
+        in_flight = []
+        while done < count:
+            while written < count and written - done < self.window:
+                size = min(frame_size, count - written)
+                self.process.stdin.write(FRAME_HEADER.pack(size) + pairs[written:written + size].tobytes())
+                in_flight.append(size)
+                written += size
+            self.process.stdin.flush()
+
+            size = in_flight.pop(0)
+            data = self.process.stdout.read(8 * size)
+            if len(data) != 8 * size:
+                raise Exception("The simulator process ended unexpectedly")
+            results[done:done + size] = numpy.frombuffer(data, dtype="<f8")
+            done += size
+        return results
+
+    def close_process(self, timeout=CLOSE_TIMEOUT):
+        """ Send the termination command to the simulator process and wait for
+        it to exit, killing it if it hasn't exited after timeout seconds.  The
+        process is always reaped and its working folder removed, and closing
+        more than once does nothing. """
+        if self.process is None or self.process.stdin.closed:
+            return
+        try:
+            if self.binary:
+                self.process.stdin.write(FRAME_HEADER.pack(0))
+            else:
+                self.process.stdin.write("end\n".encode())
+            self.process.stdin.flush()
+        except (IOError, OSError):
+            # The process has already gone away
+            pass
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+
+        deadline = time.time() + timeout
+        while self.process.poll() is None and time.time() < deadline:
+            time.sleep(0.01)
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+        shutil.rmtree(self.working_folder, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close_process()
+
+
+class SolutionManifoldPool:
+    """ The SolutionManifoldPool runs several simulator processes for the same
+    settings and splits each batch of points between them, so that batches are
+    simulated on several cores at once.  The results come back in the order of
+    the points that were given.  It has the same methods as a SolutionManifold,
+    so it can be used in place of one, and it should be used as a context
+    manager (or closed with close_process) so that the processes are shut down
+    and reaped:
+
+        with SolutionManifoldPool(data['settings'], workers=8) as pool:
+            cpas = pool.closest_approach_batch(angles, stretches)
+    """
+
+    def __init__(self, settings_object, workers=None, command=None, binary=False, window=DEFAULT_WINDOW):
+        """ Start the simulator processes.  The command, binary and window
+        arguments are passed to each SolutionManifold.
+        :param settings_object: the settings dictionary of the simulation
+        :param workers: the number of simulator processes, defaults to the
+        number of cores
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.simulators = []
+        self._lock = threading.Lock()
+        try:
+            for i in range(max(1, workers)):
+                self.simulators.append(SolutionManifold(settings_object, native=False, command=command,
+                                                        binary=binary, window=window))
+        except:
+            self.close_process()
+            raise
+
+    def get_closest_approach(self, angle, stretch):
+        """ Return the closest approach of a single point. """
+        return float(self.closest_approach_batch([angle], [stretch])[0])
+
+    def closest_approach_batch(self, angles, stretches):
+        """ Return a numpy array of the closest approaches of arrays of angles
+        and stretches, with the points split into one contiguous piece per
+        simulator process.  Each process is driven from its own thread, which
+        spends its time waiting on the pipes. """
+        angles, stretches = numpy.broadcast_arrays(numpy.asarray(angles, dtype=numpy.float64),
+                                                   numpy.asarray(stretches, dtype=numpy.float64))
+        flat_angles = angles.ravel()
+        flat_stretches = stretches.ravel()
+        results = numpy.empty(len(flat_angles))
+        pieces = [piece for piece in numpy.array_split(numpy.arange(len(flat_angles)), len(self.simulators))
+                  if len(piece)]
+        errors = []
+
+        def work(simulator, piece):
+            try:
+                results[piece] = simulator.closest_approach_batch(flat_angles[piece], flat_stretches[piece])
+            except Exception as e:
+                errors.append(e)
+
+        with self._lock:
+            if len(pieces) == 1:
+                work(self.simulators[0], pieces[0])
+            else:
+                threads = [threading.Thread(target=work, args=(simulator, piece))
+                           for simulator, piece in zip(self.simulators, pieces)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        if errors:
+            raise errors[0]
+        return results.reshape(angles.shape)
+
+    def close_process(self, timeout=CLOSE_TIMEOUT):
+        """ Shut down and reap every simulator process. """
+        for simulator in self.simulators:
+            simulator.close_process(timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close_process()
 
 
 def get_angle(pitch, data):
@@ -100,7 +366,10 @@ def validate_same_manifold(test_list):
     :return: True if the tests all lie on the same manifold, False if they do not
     """
     if isinstance(test_list, tests.TestGroup):
-        test_list = test_list.get_data_list()
+        columns = test_list.to_columns(['manifold_token'])
+        if columns.missing['manifold_token'].any():
+            raise Exception("An element in test_list is not a valid test or its settings do not give a manifold token")
+        return len(numpy.unique(columns['manifold_token'])) == 1
 
     # If the elements of test are all dictionaries with the "settings" key in them, we continue as expected. If they are
     # strings then we assume they are filepaths and attempt to load them.  Technically they can be mixed (filenames and
@@ -124,7 +393,7 @@ def validate_same_manifold(test_list):
     # Check to make sure that they all have the same manifold token
     tokens = {}
     for test in test_data:
-        token = generate_manifold_token(test)
+        token = get_manifold_token(test)
         tokens[token] = None
     if len(tokens.keys()) == 1:
         return True
@@ -166,6 +435,134 @@ def generate_manifold_token(data):
     return engine.hexdigest()
 
 
+class ManifoldGrid(Mapping):
+    """ The ManifoldGrid holds a solution manifold as a pair of sorted axes and
+    two 2 dimensional arrays indexed [stretch, angle]: the closest point of
+    approach and an outcome code, which indexes into the labels (by default
+    the simulation.OUTCOMES labels), with MISSING_OUTCOME marking grid points
+    which are not part of the manifold.  The arrays are what the binary cache
+    stores, and when loaded from the cache they are memory-mapped read only, so
+    loading is near instant and the pages are shared between processes.
+
+    For compatibility the ManifoldGrid is also a read only view with the same
+    interface as the dictionaries returned by load_solution_manifold: it is
+    keyed by (angle, stretch) tuples, and each value is a dictionary with the
+    angle, the stretch, the cpa and the outcome label of the point. """
+
+    def __init__(self, angles, stretches, cpa, outcome, labels=simulation.OUTCOMES):
+        self.angles = angles
+        self.stretches = stretches
+        self.cpa = cpa
+        self.outcome = outcome
+        self.labels = tuple(labels)
+        self._angle_index = None
+        self._stretch_index = None
+
+    @classmethod
+    def from_points(cls, manifold):
+        """ Create a ManifoldGrid from a manifold dictionary of points, such as
+        the ones returned by load_solution_manifold. """
+        points = list(manifold.values())
+        labels = list(simulation.OUTCOMES)
+        labels.extend(sorted(set(p['outcome'] for p in points) - set(labels)))
+        codes = dict((label, code) for code, label in enumerate(labels))
+
+        point_angles = numpy.array([p['angle'] for p in points], dtype=numpy.float64)
+        point_stretches = numpy.array([p['stretch'] for p in points], dtype=numpy.float64)
+        angles = numpy.unique(point_angles)
+        stretches = numpy.unique(point_stretches)
+
+        cpa = numpy.full((len(stretches), len(angles)), numpy.nan)
+        outcome = numpy.full(cpa.shape, MISSING_OUTCOME, dtype=numpy.int8)
+        rows = numpy.searchsorted(stretches, point_stretches)
+        columns = numpy.searchsorted(angles, point_angles)
+        cpa[rows, columns] = [p['cpa'] for p in points]
+        outcome[rows, columns] = [codes[p['outcome']] for p in points]
+        return cls(angles, stretches, cpa, outcome, labels)
+
+    def is_complete(self):
+        """ Return True if every point of the grid is part of the manifold. """
+        return not (numpy.asarray(self.outcome) == MISSING_OUTCOME).any()
+
+    def __find(self, key):
+        if self._angle_index is None:
+            self._angle_index = dict((angle, i) for i, angle in enumerate(self.angles.tolist()))
+            self._stretch_index = dict((stretch, j) for j, stretch in enumerate(self.stretches.tolist()))
+        try:
+            angle, stretch = key
+            i = self._angle_index[angle]
+            j = self._stretch_index[stretch]
+        except (TypeError, ValueError, KeyError):
+            raise KeyError(key)
+        if self.outcome[j, i] == MISSING_OUTCOME:
+            raise KeyError(key)
+        return j, i
+
+    def __getitem__(self, key):
+        j, i = self.__find(key)
+        return {"angle": float(self.angles[i]), "stretch": float(self.stretches[j]), "cpa": float(self.cpa[j, i]),
+                "outcome": self.labels[self.outcome[j, i]]}
+
+    def __contains__(self, key):
+        try:
+            self.__find(key)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        present = numpy.asarray(self.outcome) != MISSING_OUTCOME
+        angles = self.angles.tolist()
+        stretches = self.stretches.tolist()
+        for j, i in zip(*numpy.nonzero(present)):
+            yield (angles[i], stretches[j])
+
+    def __len__(self):
+        return int((numpy.asarray(self.outcome) != MISSING_OUTCOME).sum())
+
+
+def as_manifold_grid(manifold):
+    """ Return a manifold as a ManifoldGrid, converting it if it is a
+    dictionary of points or resampling it at its full resolution if it is an
+    adaptive.AdaptiveManifold (or anything else with a to_grid method). """
+    if isinstance(manifold, ManifoldGrid):
+        return manifold
+    if hasattr(manifold, "to_grid"):
+        return manifold.to_grid()
+    return ManifoldGrid.from_points(manifold)
+
+
+def save_manifold_grid(folder, manifold):
+    """ Save a manifold (a ManifoldGrid or a dictionary of points) in the binary
+    format, as a folder with one .npy file for each of the GRID_ARRAYS and one
+    for the outcome labels. """
+    grid = as_manifold_grid(manifold)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    for name in GRID_ARRAYS:
+        numpy.save(os.path.join(folder, name + ".npy"), numpy.ascontiguousarray(getattr(grid, name)))
+    numpy.save(os.path.join(folder, "labels.npy"), numpy.array(grid.labels, dtype=str))
+
+
+def load_manifold_grid(folder, mmap=True):
+    """ Load a manifold saved by save_manifold_grid as a ManifoldGrid.  Unless
+    mmap is False the arrays are memory-mapped read only rather than read. """
+    mode = "r" if mmap else None
+    arrays = [numpy.load(os.path.join(folder, name + ".npy"), mmap_mode=mode) for name in GRID_ARRAYS]
+    labels = numpy.load(os.path.join(folder, "labels.npy")).tolist()
+    return ManifoldGrid(*arrays, labels=labels)
+
+
+def get_manifold_token(data):
+    """ Return the manifold token of a test dictionary, which is the one kept
+    in it if it is a header from a library index or a saved group (see
+    index.extract_header), and otherwise is generated from its settings. """
+    token = data.get('manifold_token')
+    if token is not None:
+        return token
+    return generate_manifold_token(data)
+
+
 def load_solution_manifold(filepath):
     """ Load a solution manifold from a comma separated value text file of the
     sort which is exported by the "Manifold Mapper.exe" binary.  Return the
@@ -189,30 +586,300 @@ def load_solution_manifold(filepath):
 
     return manifold 
 
-def load_cached_manifold(token):
-    """ Load the cached manifold file and return the manifold object.  If the
-    manifold is not already cached, return False."""
-    filepath = os.path.join(CACHE_FOLDER, "{}.mfld".format(token))
-    if not os.path.exists(filepath):
+class ManifoldCache:
+    """ The ManifoldCache manages the folder of cached manifolds, which may be
+    shared by many analysis processes at once.  Manifolds are written to a
+    temporary folder and renamed into place, so a reader never sees a partially
+    written manifold, and get_or_create() takes a per-token lock file around
+    the generation of a manifold, so concurrent requests for the same missing
+    manifold wait for a single producer instead of all generating it.  When
+    the cache grows beyond max_bytes the least recently loaded manifolds are
+    evicted. """
+
+    def __init__(self, folder=None, max_bytes=DEFAULT_CACHE_BYTES, stale_after=LOCK_STALE):
+        """
+        :param folder: the cache folder, defaults to CACHE_FOLDER
+        :param max_bytes: the size limit of the cache, or None for no limit
+        :param stale_after: the age in seconds after which a lock file or
+        temporary folder is considered abandoned
+        """
+        self._folder = folder
+        self.max_bytes = max_bytes
+        self.stale_after = stale_after
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self.waits = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    @property
+    def folder(self):
+        return self._folder if self._folder is not None else CACHE_FOLDER
+
+    def path(self, token):
+        """ Return the path of the cached manifold of a token. """
+        return os.path.join(self.folder, token + GRID_EXTENSION)
+
+    def load(self, token):
+        """ Load a cached manifold as a memory-mapped ManifoldGrid and mark it
+        as recently used, migrating it first if it is in the older .mfld text
+        format.  If the manifold is not cached, return False. """
+        path = self.path(token)
+        if not os.path.exists(path):
+            legacy = os.path.join(self.folder, "{}.mfld".format(token))
+            if not os.path.exists(legacy):
+                self.__count("misses")
+                return False
+            self.save(token, load_solution_manifold(legacy))
+            try:
+                os.remove(legacy)
+            except OSError:
+                # Another process has migrated it at the same time
+                pass
+
+        try:
+            grid = load_manifold_grid(path)
+            os.utime(path, None)
+        except (IOError, OSError):
+            # The manifold was evicted between the check and the load
+            self.__count("misses")
+            return False
+        self.__count("hits")
+        return grid
+
+    def save(self, token, manifold):
+        """ Save a manifold to the cache.  It is written to a temporary folder
+        and renamed into place, and if another process has cached the same
+        token in the meantime its copy is kept. """
+        if not os.path.exists(self.folder):
+            try:
+                os.makedirs(self.folder)
+            except OSError:
+                if not os.path.isdir(self.folder):
+                    raise
+
+        temporary = tempfile.mkdtemp(prefix=token + GRID_EXTENSION + ".", suffix=".tmp", dir=self.folder)
+        try:
+            save_manifold_grid(temporary, manifold)
+            os.rename(temporary, self.path(token))
+        except OSError:
+            if not os.path.exists(self.path(token)):
+                raise
+        finally:
+            if os.path.exists(temporary):
+                shutil.rmtree(temporary, ignore_errors=True)
+
+    def get_or_create(self, token, generate):
+        """ Return the cached manifold of a token, generating and caching it
+        first if it is missing.  Only one process (or thread) generates a
+        given token at a time; the others wait on its lock and then load the
+        manifold it cached.  The new manifold is loaded before the lock is
+        released, so it can't be evicted by a prune in between.
+        :param token: the manifold token
+        :param generate: a function which takes no arguments and returns the
+        manifold (a ManifoldGrid or a dictionary of points)
+        """
+        cached = self.load(token)
+        if cached is not False:
+            return cached
+
+        with self.lock(token):
+            # Another producer may have finished while this one was waiting
+            cached = self.load(token)
+            if cached is not False:
+                return cached
+            self.save(token, generate())
+            self.__count("generated")
+            cached = self.load(token)
+            if self.max_bytes is not None:
+                self.prune(keep=[token])
+        return cached
+
+    @contextlib.contextmanager
+    def lock(self, token, timeout=None):
+        """ A context manager which holds the lock file of a token, waiting
+        for any other holder to release it.  A lock which is older than
+        stale_after, or which belongs to a process on this host which no
+        longer exists, is broken, so while it is held the lock file is
+        touched by a background thread to keep it fresh.
+        :param timeout: the longest time in seconds to wait, or None to wait
+        for as long as it takes
+        """
+        if not os.path.exists(self.folder):
+            try:
+                os.makedirs(self.folder)
+            except OSError:
+                if not os.path.isdir(self.folder):
+                    raise
+
+        path = os.path.join(self.folder, token + ".lock")
+        deadline = None if timeout is None else time.time() + timeout
+        waited = False
+        while True:
+            try:
+                handle = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            if self.__is_stale(path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            if deadline is not None and time.time() > deadline:
+                raise Exception("Timed out waiting for the lock on manifold {}".format(token))
+            if not waited:
+                waited = True
+                self.__count("waits")
+            time.sleep(LOCK_POLL)
+
+        stop = threading.Event()
+
+        def refresh():
+            while not stop.wait(self.stale_after / float(LOCK_REFRESHES)):
+                try:
+                    os.utime(path, None)
+                except OSError:
+                    pass
+
+        refresher = threading.Thread(target=refresh)
+        refresher.daemon = True
+        try:
+            os.write(handle, "{} {}".format(os.getpid(), socket.gethostname()).encode())
+            os.close(handle)
+            refresher.start()
+            yield
+        finally:
+            stop.set()
+            if refresher.is_alive():
+                refresher.join()
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def __is_stale(self, path):
+        try:
+            age = time.time() - os.path.getmtime(path)
+            with open(path) as handle:
+                owner = handle.read().split()
+        except (IOError, OSError):
+            return False
+        if age > self.stale_after:
+            return True
+        if len(owner) != 2 or owner[1] != socket.gethostname() or os.name != "posix":
+            return False
+        try:
+            os.kill(int(owner[0]), 0)
+        except OSError as e:
+            return e.errno == errno.ESRCH
+        except ValueError:
+            return False
         return False
 
-    manifold = load_solution_manifold(filepath)
-    return manifold 
+    def __entries(self):
+        """ Return a list of (last used time, bytes, token) for each cached
+        manifold. """
+        if not os.path.exists(self.folder):
+            return []
+        entries = []
+        for name in os.listdir(self.folder):
+            if not name.endswith(GRID_EXTENSION):
+                continue
+            path = os.path.join(self.folder, name)
+            try:
+                size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, name[:-len(GRID_EXTENSION)]))
+            except OSError:
+                # Evicted by another process while being measured
+                continue
+        return entries
+
+    def cache_stats(self):
+        """ Return a dictionary with the number of cached manifolds
+        ("entries") and their total "bytes", the "max_bytes" limit, and the
+        "hits", "misses", "generated", "waits" and "evictions" counters of
+        this process. """
+        entries = self.__entries()
+        return {"entries": len(entries),
+                "bytes": sum(size for _, size, _ in entries),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "generated": self.generated,
+                "waits": self.waits,
+                "evictions": self.evictions}
+
+    def prune(self, max_bytes=None, keep=()):
+        """ Evict the least recently used manifolds until the cache is within
+        max_bytes (by default the limit of the cache), and remove temporary
+        folders and lock files which have been abandoned.  Manifolds which are
+        locked or listed in keep are never evicted.
+        :return: the list of evicted tokens
+        """
+        max_bytes = max_bytes if max_bytes is not None else self.max_bytes
+        if not os.path.exists(self.folder):
+            return []
+
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            try:
+                if name.endswith(".tmp") and time.time() - os.path.getmtime(path) > self.stale_after:
+                    shutil.rmtree(path, ignore_errors=True)
+                elif name.endswith(".lock") and self.__is_stale(path):
+                    os.remove(path)
+            except OSError:
+                continue
+
+        if max_bytes is None:
+            return []
+        entries = sorted(self.__entries())
+        total = sum(size for _, size, _ in entries)
+        evicted = []
+        for used, size, token in entries:
+            if total <= max_bytes:
+                break
+            if token in keep or os.path.exists(os.path.join(self.folder, token + ".lock")):
+                continue
+            try:
+                shutil.rmtree(self.path(token))
+            except OSError:
+                # Still open elsewhere on a platform which doesn't allow that
+                continue
+            total -= size
+            evicted.append(token)
+            self.__count("evictions")
+        return evicted
+
+    def __count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+def cache_stats():
+    """ Return the statistics of the shared manifold cache, see
+    ManifoldCache.cache_stats. """
+    return MANIFOLD_CACHE.cache_stats()
+
+
+def prune(max_bytes=None):
+    """ Prune the shared manifold cache, see ManifoldCache.prune. """
+    return MANIFOLD_CACHE.prune(max_bytes)
 
-def save_cached_manifold(token, manifold):
-    """ Save the cached manifold file to the CACHE_FOLDER. """
-    if not os.path.exists(CACHE_FOLDER):
-        os.mkdir(CACHE_FOLDER)
-
-    output_path = os.path.join(CACHE_FOLDER, "{}.mfld".format(token))
 
-    output = ["angle,stretch,cpa,outcome"]
-    for k, v in manifold.items():
-        output.append("{angle},{stretch},{cpa},{outcome}".format(**v))
-    output_string = "\n".join(output)
+def load_cached_manifold(token):
+    """ Load the cached manifold and return it as a memory-mapped ManifoldGrid.
+    A manifold cached in the older .mfld text format is migrated to the binary
+    format the first time it is loaded.  If the manifold is not already cached,
+    return False."""
+    return MANIFOLD_CACHE.load(token)
 
-    with open(output_path, "w") as handle:
-        handle.write(output_string)
+def save_cached_manifold(token, manifold):
+    """ Save the manifold to the CACHE_FOLDER in the binary format. """
+    MANIFOLD_CACHE.save(token, manifold)
 
 
 def get_solution_manifold(data):
@@ -220,35 +887,88 @@ def get_solution_manifold(data):
     solution manifold has been computed and cached already.  If it has not been,
     use the binary "Manifold Mapper.exe" file in the manifold_binaries folder to
     generate the solution manifold and cache it.  Otherwise load the cached
-    manifold.  In either case return the manifold object, which is a list of
-    dictionaries, each of which represents a single point in the solution space
-    and has key-value pairs for the angle, stretch, CPA, and outcome."""
-
-    # Get the manifold token and attempt to load the manifold from cache.
-    token = generate_manifold_token(data)
-    cached = load_cached_manifold(token)
-    if cached:
-        return cached 
-    # The manifold was not cached and must be generated.
-    current_directory = os.getcwd()
-
-    os.chdir(BINARY_FOLDER)
-    if os.path.exists("settings.json"):
-        os.remove("settings.json")
-    if os.path.exists("solution_manifold.txt"):
-        os.remove("solution_manifold.txt")
-
-    file("settings.json", "w").write(json.dumps(data['settings']))
-
-    subprocess.call(["Manifold Mapper.exe"])
-    manifold = load_solution_manifold("solution_manifold.txt")
-    os.remove("solution_manifold.txt")
-    os.chdir(current_directory)
-
-    # Cache the manifold so we won't have to do this again in the future
-    save_cached_manifold(token, manifold)
-
-    return manifold
+    manifold.  In either case return the manifold object, a ManifoldGrid which
+    can be used as a dictionary of the points in the solution space, each of
+    which has key-value pairs for the angle, stretch, CPA, and outcome."""
+
+    # Get the manifold token and load the manifold from cache, generating it if
+    # it hasn't been cached yet.
+    token = get_manifold_token(data)
+    return MANIFOLD_CACHE.get_or_create(token, lambda: generate_solution_manifold(data['settings']))
+
+
+def generate_solution_manifold(settings_object, command=None):
+    """ Run the binary "Manifold Mapper.exe" file in the manifold_binaries
+    folder for a settings dictionary and return the manifold it computes, as a
+    dictionary of points.  The mapper is run in a temporary working folder of
+    its own, so any number of manifolds can be generated at once.
+    :param command: the command to run, defaults to MANIFOLD_MAPPER_COMMAND
+    """
+    working_folder = tempfile.mkdtemp(prefix="manifold-")
+    try:
+        with open(os.path.join(working_folder, "settings.json"), "w") as handle:
+            handle.write(json.dumps(settings_object))
+
+        code = subprocess.call(list(command if command is not None else MANIFOLD_MAPPER_COMMAND), cwd=working_folder)
+        output_path = os.path.join(working_folder, "solution_manifold.txt")
+        if not os.path.exists(output_path):
+            raise Exception("The Manifold Mapper did not produce a solution manifold (exit code {})".format(code))
+        return load_solution_manifold(output_path)
+    finally:
+        shutil.rmtree(working_folder, ignore_errors=True)
+
+
+def prewarm_manifold_cache(test_group, workers=None, generate=None):
+    """ Generate every manifold used by a set of tests which is not already
+    cached, several at a time.  Concurrent prewarms (and analyses) in other
+    processes are safe, since each manifold is generated under the lock of the
+    shared cache.  A manifold which fails to generate is reported in the
+    result rather than stopping the others.
+    :param test_group: a TestGroup, or a list of test dictionaries or file paths
+    :param workers: the number of manifolds generated at once, defaults to the
+    number of cores
+    :param generate: the function which generates a manifold from a settings
+    dictionary, defaults to generate_solution_manifold
+    :return: a dictionary of manifold token to "cached", "generated", or the
+    error message of a failed generation
+    """
+    if generate is None:
+        generate = generate_solution_manifold
+    if isinstance(test_group, tests.TestGroup):
+        # Only the first test of each manifold needs to be looked at for its settings
+        test_list = [subgroup.records.get(subgroup.files[0]) or tests.load_cached_test_header(subgroup.files[0])
+                     for subgroup in test_group.group_by_manifold().values()]
+    else:
+        test_list = [tests.load_test_header(t) if tests.is_string(t) else t for t in test_group]
+
+    settings = {}
+    for data in test_list:
+        if data is not None:
+            settings.setdefault(get_manifold_token(data), data['settings'])
+
+    def work(token):
+        if MANIFOLD_CACHE.load(token) is not False:
+            return "cached"
+        try:
+            MANIFOLD_CACHE.get_or_create(token, lambda: generate(settings[token]))
+        except Exception as e:
+            return "{}: {}".format(type(e).__name__, e)
+        return "generated"
+
+    tokens = sorted(settings.keys())
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = max(1, min(workers, len(tokens)))
+
+    # The generation itself runs in a separate process, so a pool of threads
+    # is enough to keep several generators busy at once
+    pool = multiprocessing.pool.ThreadPool(workers)
+    try:
+        results = pool.map(work, tokens)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(tokens, results))
 
 
 def get_manifold_matrix(manifold):
@@ -256,57 +976,36 @@ def get_manifold_matrix(manifold):
     2 dimensional array of the format for the Total Cost Analysis matlab code.
     This should return a nested list which can be direclty converted into a
     numpy n-dimensional array."""
-    angles = list(set([p['angle'] for k, p in manifold.items()]))
-    stretches = list(set([p['stretch'] for k, p in manifold.items()]))
-    angles.sort()
-    stretches.sort()
-
-    output = []
-    for stretch in stretches:
-        row = [manifold[(angle, stretch)]['cpa'] for angle in angles]
-        output.append(row)
-
-    return angles, stretches, output
+    grid = as_manifold_grid(manifold)
+    if not grid.is_complete():
+        raise Exception("The manifold is not a complete grid of angles and stretches")
+    return grid.angles.tolist(), grid.stretches.tolist(), numpy.asarray(grid.cpa).tolist()
 
 
 def get_manifold_draw_matrix(manifold):
     """ Given a manifold list/dictionary object, generate the nested list which
     can be directly converted to a numpy n-dimensional array and plotted via
     imshow, as well as the x and y axis lists."""
-
-    # Resolve the unique angles and stretches, and get the furthest closest
-    # point of approach so that the color base can be scaled against it.
-    angles    = list(set([p['angle'] for k, p in manifold.items()]))
-    stretches = list(set([p['stretch'] for k, p in manifold.items()]))
-    cpaMax    = max([abs(p['cpa']) for k, p in manifold.items()])
-
-    # Sort the angles and stretches
-    angles.sort()
-    stretches.sort()
-
-    output = []
-
-    for stretch in stretches:
-        row = []
-        for angle in angles:
-            key = (angle, stretch)
-            
-            cpa = abs(manifold[key]['cpa'])
-            outcome = manifold[key]['outcome']
-
-            if outcome == "hit":
-                row.append([1, 1, 1])
-            else:
-                value = (cpaMax - cpa) / cpaMax
-                if value < 0:
-                    value = 0
-                if outcome == "obstacle":
-                    row.append([2*value,value,0])
-                else:
-                    row.append([value,value,0])
-        output.append(row)
-
-    return angles, stretches, output
+    grid = as_manifold_grid(manifold)
+    if not grid.is_complete():
+        raise Exception("The manifold is not a complete grid of angles and stretches")
+
+    # Get the furthest closest point of approach so that the color base can be
+    # scaled against it.
+    cpa = numpy.abs(grid.cpa)
+    cpa_max = cpa.max()
+    value = numpy.maximum((cpa_max - cpa) / cpa_max, 0)
+
+    # Hits are white, obstacle strikes are shaded orange and misses yellow
+    labels = numpy.array(grid.labels)[grid.outcome]
+    output = numpy.stack([value, value, numpy.zeros(value.shape)], axis=-1)
+    output[labels == "obstacle", 0] *= 2
+    output[labels == "hit"] = 1
+
+    return grid.angles.tolist(), grid.stretches.tolist(), output.tolist()
+
+# The shared manifold cache in CACHE_FOLDER
+MANIFOLD_CACHE = ManifoldCache()
 
 if __name__ == '__main__':
 
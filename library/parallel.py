@@ -0,0 +1,75 @@
+"""
+    parallel.py
+
+    This module contains the process pool helpers used to spread the loading and validation of test files across
+    several cores.  Loading a test file is almost entirely json parsing and timestamp conversion, which is CPU bound, so
+    on a machine with many cores a large library can be opened far faster by loading files in worker processes.
+
+    Results always come back in the same order as the file list that was given, and a file which fails to load is
+    reported in its result rather than raising an exception and stopping the whole batch.
+"""
+import collections
+import multiprocessing
+
+try:
+    import record_cache
+except:
+    import library.record_cache as record_cache
+
+# The result of loading a single file: the file path, the (size, mtime) stamp of the file taken before it was read,
+# the loaded data (None if the file was not a valid test) and an error message if the loader raised an exception.
+LoadResult = collections.namedtuple("LoadResult", ["path", "stamp", "data", "error"])
+
+
+def _load_one(task):
+    """
+    Worker function which loads a single file.  This has to be a module level function so that the process pool can
+    pickle it.
+    :param task: a tuple of the loader function and the file path
+    :return: a LoadResult
+    """
+    loader, filepath = task
+    stamp = record_cache.file_stamp(filepath)
+    try:
+        return LoadResult(filepath, stamp, loader(filepath), None)
+    except Exception as e:
+        return LoadResult(filepath, stamp, None, "{}: {}".format(type(e).__name__, e))
+
+
+def default_chunk_size(count, workers):
+    """
+    Pick a chunk size which gives each worker roughly four chunks, so that the work stays balanced without paying the
+    inter-process overhead on every single file.
+    """
+    return max(1, int(count / (workers * 4.0)))
+
+
+def load_files(file_list, loader, workers=None, chunk_size=None):
+    """
+    Load a list of files with a pool of worker processes.  The loader must be a module level function (such as
+    tests.load_test_file) so that it can be sent to the workers.
+    :param file_list: a list of file paths to load
+    :param loader: a function which takes a file path and returns the loaded data
+    :param workers: the number of worker processes, defaults to the number of cores.  One or fewer loads the files in
+    this process without a pool.
+    :param chunk_size: the number of files handed to a worker at a time, picked automatically if not given
+    :return: a list of LoadResult tuples in the same order as file_list
+    """
+    tasks = [(loader, filepath) for filepath in file_list]
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = min(workers, len(tasks))
+
+    if workers <= 1:
+        return [_load_one(task) for task in tasks]
+
+    if chunk_size is None:
+        chunk_size = default_chunk_size(len(tasks), workers)
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = list(pool.imap(_load_one, tasks, chunk_size))
+    finally:
+        pool.close()
+        pool.join()
+    return results
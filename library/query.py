@@ -0,0 +1,172 @@
+"""
+    query.py
+
+    This module contains the QueryPlan, a lazy counterpart of the TestGroup.  Chaining TestGroup operations such as
+
+        TestLibrary("data").filter({...}).break_into_blocks()
+
+    materializes a new file list at every step, and every step reads the files again.  A QueryPlan only records the
+    operations, and when the plan is collected it works out which keys the whole chain actually uses, pulls just those
+    keys out of the files in a single scan, and runs every step over the resulting columns.  The TestGroups which come
+    out of the plan carry those columns with them, so asking them for the same keys again costs nothing.
+"""
+import datetime
+
+import numpy
+
+try:
+    import tests
+except:
+    import library.tests as tests
+
+
+class QueryPlan:
+    """
+    A deferred chain of TestGroup operations over a source TestGroup.  Each operation returns a new QueryPlan, and the
+    plan is run by collect().  Using the plan as if it were its result (iterating it, indexing it, taking its length,
+    or calling any other TestGroup method on it) collects it implicitly.
+
+    The result of collect() depends on the operations in the plan: a TestGroup after filter(), a list of TestGroups
+    after split_into_parts(), and a dictionary of subject to a list of TestGroups after break_into_blocks().  Operations
+    which follow a split or a blocking are applied to every resulting group.  If the plan ends with get_list_of_key(),
+    every resulting group is replaced by the (values, filenames) lists, or by a dictionary of key to (values,
+    filenames) if several keys were given.
+    """
+
+    def __init__(self, source, steps=()):
+        """
+        :param source: the TestGroup which the plan reads from
+        :param steps: the tuple of recorded operations, used internally when chaining
+        """
+        self.source = source
+        self.steps = tuple(steps)
+        self._result = None
+
+    def __chain(self, step):
+        if self.steps and self.steps[-1][0] == "keys":
+            raise Exception("No further operations can follow get_list_of_key() in a QueryPlan")
+        return QueryPlan(self.source, self.steps + (step, ))
+
+    def filter(self, filter_data):
+        """
+        Record a filter with the same filter_data dictionary as TestGroup.filter.  A test which is missing one of the
+        filtered keys does not pass the filter.
+        """
+        if type(filter_data) is not dict:
+            raise Exception("The filter_data argument must be a dictionary")
+        return self.__chain(("filter", dict(filter_data)))
+
+    def split_into_parts(self, parts):
+        """
+        Record a split into roughly equal parts, the same as TestGroup.split_into_parts.
+        """
+        return self.__chain(("split", parts))
+
+    def break_into_blocks(self, time_delay=datetime.timedelta(minutes=10)):
+        """
+        Record a break into blocks of time-adjacent trials, the same as TestGroup.break_into_blocks.
+        """
+        return self.__chain(("blocks", time_delay))
+
+    def get_list_of_key(self, *keys):
+        """
+        Record the extraction of one or more keys, ordered by ascending timestamp, the same as
+        TestGroup.get_list_of_key.  This must be the last operation in the plan.
+        """
+        if not keys:
+            raise Exception("get_list_of_key requires at least one key")
+        return self.__chain(("keys", keys))
+
+    def projection(self):
+        """
+        Return the sorted list of keys which the plan needs to read from the test files.
+        """
+        keys = set()
+        for kind, argument in self.steps:
+            if kind == "filter":
+                keys.update(argument.keys())
+            elif kind == "blocks":
+                keys.update(["subject", "timestamp"])
+            elif kind == "keys":
+                keys.add("timestamp")
+                keys.update([key for key in argument if not tests.is_temporal_characteristic(key)])
+                if [key for key in argument if tests.is_temporal_characteristic(key)]:
+                    keys.update(["release_angle", "release_stretch"])
+        return sorted(keys)
+
+    def collect(self):
+        """
+        Run the plan in a single scan of the source group's files and return the result.  The result is remembered,
+        so collecting the same plan again does not scan the files again.
+        """
+        if self._result is not None:
+            return self._result
+
+        columns = self.source.to_columns(self.projection())
+        state = numpy.arange(len(columns.files))
+
+        for kind, argument in self.steps:
+            if kind == "filter":
+                state = _map_leaves(state, lambda rows: _filter_rows(columns, rows, argument))
+            elif kind == "split":
+                state = _map_leaves(state, lambda rows: _split_rows(columns, rows, argument))
+            elif kind == "blocks":
+                state = _map_leaves(state, lambda rows: tests.split_rows_into_blocks(columns, rows, argument))
+
+        groups = _map_leaves(state, self.source.subgroup)
+        if self.steps and self.steps[-1][0] == "keys":
+            keys = self.steps[-1][1]
+            groups = _map_leaves(groups, lambda group: _extract_keys(group, keys))
+
+        self._result = groups
+        return groups
+
+    def __iter__(self):
+        return iter(self.collect())
+
+    def __len__(self):
+        return len(self.collect())
+
+    def __getitem__(self, item):
+        return self.collect()[item]
+
+    def __getattr__(self, name):
+        # Anything else is looked up on the collected result, which makes the plan usable as a drop-in TestGroup
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.collect(), name)
+
+
+def _map_leaves(state, function):
+    """
+    Apply a function to every array of rows in a (possibly nested) structure of lists and dictionaries.
+    """
+    if isinstance(state, dict):
+        return dict((key, _map_leaves(value, function)) for key, value in state.items())
+    if isinstance(state, list):
+        return [_map_leaves(value, function) for value in state]
+    return function(state)
+
+
+def _filter_rows(columns, rows, filter_data):
+    mask = numpy.ones(len(rows), dtype=bool)
+    for key, condition in filter_data.items():
+        missing = columns.missing[key][rows]
+        values = columns.decode(key, rows)
+        for i, value in enumerate(values):
+            if mask[i]:
+                mask[i] = not missing[i] and tests.matches_condition(value, condition)
+    return rows[mask]
+
+
+def _split_rows(columns, rows, parts):
+    names = numpy.array(columns.files)[rows]
+    rows = rows[numpy.argsort(names, kind="mergesort")]
+    group_size = int(len(rows) / float(parts)) + 1
+    return [rows[i:i + group_size] for i in range(0, len(rows), group_size)]
+
+
+def _extract_keys(group, keys):
+    if len(keys) == 1:
+        return group.get_list_of_key(keys[0])
+    return dict((key, group.get_list_of_key(key)) for key in keys)
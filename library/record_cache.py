@@ -0,0 +1,187 @@
+"""
+    record_cache.py
+
+    This module holds the shared cache of parsed test records.  Nearly every operation on a TestGroup needs to look
+    inside the test files, and without a cache the same .json file ends up being read, parsed, and timestamp-converted
+    over and over again in a single query.  The RecordCache keeps the parsed dictionaries in memory, keyed by the path
+    of the file along with its size and modification time so that a file which changes on disk is re-parsed
+    automatically.  The cache is bounded by a memory budget and evicts the least recently used records first.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+# The default memory budget for the cache.  The cost of a record is estimated from the size of its source file on disk
+# multiplied by the EXPANSION_FACTOR, since a parsed python dictionary takes up considerably more memory than the json
+# text it came from.
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+EXPANSION_FACTOR = 4
+
+
+def file_stamp(filepath):
+    """
+    Return a (size, mtime) tuple identifying the current version of a file on disk, or None if the file does not exist.
+    :param filepath: the path of the file
+    :return: a tuple of the file size in bytes and the modification time, or None
+    """
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime
+
+
+class RecordCache:
+    """
+    The RecordCache is a least recently used cache of parsed test records.  Records are retrieved with get(), which
+    checks the file's size and modification time against the cached copy and only calls the loader when the file is
+    new or has changed.  The records handed out by the cache are shared between callers and should be treated as
+    read-only.
+    """
+
+    def __init__(self, loader, max_bytes=DEFAULT_MAX_BYTES, expansion_factor=EXPANSION_FACTOR):
+        """
+        :param loader: a function which takes a file path and returns the parsed record (or None if it is not valid)
+        :param max_bytes: the memory budget of the cache in estimated bytes
+        :param expansion_factor: the estimated size of a record relative to the size of its file, which should be
+        smaller than the default for loaders which only keep part of the file
+        """
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.expansion_factor = expansion_factor
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, filepath):
+        """
+        Return the parsed record for the file at filepath, loading it through the loader if it is not cached or if the
+        file has changed on disk since it was cached.
+        :param filepath: the path of the test file
+        :return: the parsed record, or None if the file does not exist or is not a valid test
+        """
+        stamp = file_stamp(filepath)
+        if stamp is None:
+            self.invalidate(filepath)
+            return None
+
+        with self._lock:
+            entry = self._entries.get(filepath)
+            if entry is not None and entry[0] == stamp:
+                self.hits += 1
+                self._entries.pop(filepath)
+                self._entries[filepath] = entry
+                return entry[1]
+            self.misses += 1
+
+        record = self.loader(filepath)
+        self.put(filepath, record, stamp)
+        return record
+
+    def peek(self, filepath):
+        """
+        Return the cached record for the file at filepath if there is an up to date copy in the cache, without loading
+        the file or counting a hit or a miss.
+        :param filepath: the path of the test file
+        :return: a tuple of (True, record) if the file is cached and (False, None) otherwise
+        """
+        with self._lock:
+            entry = self._entries.get(filepath)
+            if entry is not None and entry[0] == file_stamp(filepath):
+                return True, entry[1]
+        return False, None
+
+    def stale(self, file_list):
+        """
+        Return the files in file_list which are not cached or whose cached copy is out of date, without loading them.
+        :param file_list: a list of file paths
+        :return: a list of the file paths which would have to be loaded
+        """
+        output = []
+        with self._lock:
+            for filepath in file_list:
+                entry = self._entries.get(filepath)
+                if entry is None or entry[0] != file_stamp(filepath):
+                    output.append(filepath)
+        return output
+
+    def put(self, filepath, record, stamp=None):
+        """
+        Place a record which was parsed elsewhere into the cache.
+        :param filepath: the path of the test file the record was parsed from
+        :param record: the parsed record
+        :param stamp: the (size, mtime) stamp of the file when it was parsed, looked up if not given
+        """
+        if stamp is None:
+            stamp = file_stamp(filepath)
+            if stamp is None:
+                return
+
+        # Invalid files are remembered as well so that they are not re-parsed, but they cost nothing against the budget
+        cost = 0 if record is None else int(stamp[0] * self.expansion_factor)
+        if cost > self.max_bytes:
+            return
+
+        with self._lock:
+            self._remove(filepath)
+            self._entries[filepath] = (stamp, record, cost)
+            self.current_bytes += cost
+            self._evict()
+
+    def invalidate(self, filepath=None):
+        """
+        Drop a single file from the cache, or the entire cache if no file path is given.
+        :param filepath: the path of the file to drop, or None to clear the cache
+        """
+        with self._lock:
+            if filepath is None:
+                self._entries.clear()
+                self.current_bytes = 0
+            else:
+                self._remove(filepath)
+
+    def resize(self, max_bytes):
+        """
+        Change the memory budget of the cache, evicting records if the new budget is smaller than the current usage.
+        :param max_bytes: the new memory budget in estimated bytes
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def stats(self):
+        """
+        Return a dictionary with the hit, miss and eviction counters along with the current size of the cache.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "hit_rate": self.hits / float(lookups) if lookups else 0.0,
+                    "entries": len(self._entries),
+                    "bytes": self.current_bytes,
+                    "max_bytes": self.max_bytes}
+
+    def reset_stats(self):
+        """
+        Reset the hit, miss and eviction counters without touching the cached records.
+        """
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def _remove(self, filepath):
+        entry = self._entries.pop(filepath, None)
+        if entry is not None:
+            self.current_bytes -= entry[2]
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._entries:
+            filepath, entry = self._entries.popitem(last=False)
+            self.current_bytes -= entry[2]
+            self.evictions += 1
@@ -0,0 +1,186 @@
+"""
+    simulation.py
+
+    This module is a pure numpy reimplementation of the projectile physics of the voice game, which computes the closest
+    point of approach of a throw to the target for a given release angle and stretch.  It reproduces the simulation mode
+    of the game engine which ComputeSolution.exe and the Manifold Mapper are built on, including the quirks of the
+    original, but it runs on any platform and simulates whole arrays of throws at once, stepping every throw which is
+    still in flight together on each frame.
+
+    The closest approach is signed the same way the game signs it: negative when the ball is below the target at the
+    moment the closest approach is recorded.
+"""
+import numpy
+
+# The length of a frame of the game loop in milliseconds, and the size of the obstacle in the horizontal direction
+FRAME_TIME = 15.666666666666668
+OBSTACLE_WIDTH = 30.0
+
+# The ball is out of play outside of the field horizontally or outside of these vertical limits
+CEILING = 15000.0
+FLOOR = 20.0
+
+# A throw which hasn't ended after this many frames (only possible with no gravity) is stopped where it is and counted as
+# a miss
+MAX_FRAMES = 100000
+
+# Outcome codes of simulate_batch, in the order of the OUTCOMES labels.  IN_FLIGHT only marks the throws which are still
+# being stepped and is never returned.
+IN_FLIGHT = -1
+HIT = 0
+MISS = 1
+OBSTACLE = 2
+OUTCOMES = ("hit", "miss", "obstacle")
+
+# The values the game uses when a settings file leaves them out
+DEFAULT_ANCHOR = {"X": 60.0, "Y": 75.0}
+DEFAULT_TARGET = {"X": 600.0, "Y": 150.0}
+DEFAULT_OBSTACLE = {"Position": 200.0, "Bottom": 0.0, "Top": 400.0}
+DEFAULT_GRAVITY = -0.01
+DEFAULT_FIELD_WIDTH = 800.0
+DEFAULT_TARGET_VALID_DIAMETER = 30.0
+
+
+class ClosestApproachEngine:
+    """
+    The ClosestApproachEngine simulates throws with the physics of the game for a single settings dictionary (the
+    'settings' element of a test file).  Use closest_approach_batch() for the closest approach of arrays of angles and
+    stretches, or simulate_batch() to get the outcome of each throw as well.
+    """
+
+    def __init__(self, settings):
+        """
+        :param settings: the settings dictionary of a test
+        """
+        anchor = settings.get("Anchor") or DEFAULT_ANCHOR
+        target = settings.get("Target") or DEFAULT_TARGET
+        obstacle = settings.get("Obstacle") or DEFAULT_OBSTACLE
+
+        self.anchor = (float(anchor["X"]), float(anchor["Y"]))
+        self.target = (float(target["X"]), float(target["Y"]))
+        self.obstacle = (float(obstacle["Position"]), float(obstacle["Bottom"]), float(obstacle["Top"]))
+        self.gravity = float(settings.get("Gravity", DEFAULT_GRAVITY))
+        self.field_width = float(settings.get("FieldWidth", DEFAULT_FIELD_WIDTH))
+        self.hit_radius = float(settings.get("TargetValidDiameter", DEFAULT_TARGET_VALID_DIAMETER)) / 2.0
+
+    def closest_approach(self, angle, stretch):
+        """
+        Return the closest approach of a single throw.
+        """
+        return float(self.closest_approach_batch([angle], [stretch])[0])
+
+    def closest_approach_batch(self, angles, stretches):
+        """
+        Return the closest approach of every throw in a pair of arrays of release angles (in degrees) and stretches.
+        :param angles: an array of release angles
+        :param stretches: an array of release stretches with the same shape as angles
+        :return: a float array of the signed closest approaches with the same shape as the inputs
+        """
+        return self.simulate_batch(angles, stretches)[0]
+
+    def simulate_batch(self, angles, stretches):
+        """
+        Simulate every throw in a pair of arrays of release angles (in degrees) and stretches.
+        :param angles: an array of release angles
+        :param stretches: an array of release stretches, broadcastable against angles
+        :return: a float array of the signed closest approaches and an integer array of outcome codes (HIT, MISS or
+        OBSTACLE, see OUTCOMES), both with the broadcast shape of the inputs
+        """
+        angles, stretches = numpy.broadcast_arrays(numpy.asarray(angles, dtype=numpy.float64),
+                                                   numpy.asarray(stretches, dtype=numpy.float64))
+        shape = angles.shape
+        count = angles.size
+
+        radians = angles.ravel() * numpy.pi / 180.0
+        speed = stretches.ravel()
+        target_x, target_y = self.target
+        position, bottom, top = self.obstacle
+
+        ball_x = numpy.full(count, self.anchor[0])
+        ball_y = numpy.full(count, self.anchor[1])
+        velocity_x = speed * numpy.cos(radians)
+        velocity_y = speed * numpy.sin(radians)
+
+        cpa = numpy.hypot(target_x - ball_x, target_y - ball_y)
+        cpa[ball_y < target_y] *= -1
+        outcome = numpy.full(count, IN_FLIGHT, dtype=numpy.int8)
+
+        # Only the throws which are still in flight are stepped, as a compacted set of arrays indexed back into the
+        # full outputs by active
+        active = numpy.arange(count)
+        prev_x, prev_y = ball_x, ball_y
+        for frame in range(MAX_FRAMES):
+            if not len(active):
+                break
+
+            velocity_y = velocity_y + self.gravity * (FRAME_TIME / 20.0)
+            ball_x = prev_x + FRAME_TIME * velocity_x
+            ball_y = prev_y + FRAME_TIME * velocity_y
+
+            ended = numpy.full(len(active), IN_FLIGHT, dtype=numpy.int8)
+            ended[(ball_x > position) & (ball_x < position + OBSTACLE_WIDTH) &
+                  (ball_y > bottom) & (ball_y < top)] = OBSTACLE
+            ended[(ball_x > self.field_width) | (ball_x < 0) | (ball_y > CEILING) | (ball_y < FLOOR)] = MISS
+
+            # The closest approach over the segment travelled in this frame.  If the foot of the perpendicular from
+            # the target falls outside the segment the end of the segment is used.  Otherwise the game measures from
+            # the target to the projection vector itself, which is relative to the start of the segment rather than a
+            # point on it; that is reproduced here as it is.
+            segment_x = ball_x - prev_x
+            segment_y = ball_y - prev_y
+            to_target_x = target_x - prev_x
+            to_target_y = target_y - prev_y
+            length = numpy.hypot(segment_x, segment_y)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                unit_x = segment_x / length
+                unit_y = segment_y / length
+            projection = unit_x * to_target_x + unit_y * to_target_y
+            outside = (projection > length) | (projection < 0)
+            point_x = projection * unit_x
+            point_y = projection * unit_y
+
+            distance = numpy.where(outside, numpy.hypot(target_x - ball_x, target_y - ball_y),
+                                   numpy.hypot(target_x - point_x, target_y - point_y))
+            miss_distance = numpy.where(outside, distance,
+                                        numpy.hypot(to_target_x - point_x, to_target_y - point_y))
+            distance = numpy.where(ball_y < target_y, -distance, distance)
+
+            current = cpa[active]
+            closer = numpy.abs(distance) < numpy.abs(current)
+            cpa[active] = numpy.where(closer, distance, current)
+            ended[miss_distance < self.hit_radius] = HIT
+
+            done = ended != IN_FLIGHT
+            if done.any():
+                outcome[active[done]] = ended[done]
+                keep = ~done
+                active = active[keep]
+                ball_x, ball_y = ball_x[keep], ball_y[keep]
+                velocity_x, velocity_y = velocity_x[keep], velocity_y[keep]
+            prev_x, prev_y = ball_x, ball_y
+
+        outcome[outcome == IN_FLIGHT] = MISS
+        return cpa.reshape(shape), outcome.reshape(shape)
+
+    def compare_with_manifold(self, manifold):
+        """
+        Simulate every point of a solution manifold (as returned by manifold.load_solution_manifold or
+        manifold.get_solution_manifold) and compare the results with the stored values, to validate the engine against
+        the Manifold Mapper.
+        :param manifold: a solution manifold dictionary
+        :return: a dictionary with the number of "points", the "max_error" and "rms_error" of the closest approaches,
+        and the fraction of points with the same outcome as "outcome_agreement"
+        """
+        points = list(manifold.values())
+        angles = numpy.array([p['angle'] for p in points])
+        stretches = numpy.array([p['stretch'] for p in points])
+        stored = numpy.array([p['cpa'] for p in points])
+        labels = numpy.array([p['outcome'] for p in points])
+
+        cpa, outcome = self.simulate_batch(angles, stretches)
+        error = numpy.abs(cpa - stored)
+        simulated = numpy.array(OUTCOMES)[outcome]
+        return {"points": len(points),
+                "max_error": float(error.max()) if len(points) else 0.0,
+                "rms_error": float(numpy.sqrt((error ** 2).mean())) if len(points) else 0.0,
+                "outcome_agreement": float((simulated == labels).mean()) if len(points) else 1.0}
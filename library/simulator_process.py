@@ -0,0 +1,137 @@
+"""
+    simulator_process.py
+
+    This is a stand-in for ComputeSolution.exe written in python, which speaks the same standard in/standard out
+    protocol but computes the closest approaches with the numpy engine in library.simulation.  It exists so that the
+    process based simulation in manifold.SolutionManifold can be used, tested and benchmarked on any platform.
+
+    Like ComputeSolution.exe it reads the settings from settings.json in the working directory (or from the path given
+    as an argument) and then answers requests until it is told to end.  There are two protocols:
+
+    Text (the ComputeSolution.exe protocol): each request is a line "angle,stretch" and each answer is a line with the
+    closest approach.  The line "end" stops the process.
+
+    Binary (with the --binary flag): each request is a frame made of a little-endian unsigned 32 bit count followed by
+    that many pairs of little-endian 64 bit floats (angle, stretch), and each answer is count 64 bit floats.  A frame
+    with a count of zero stops the process.
+
+    In both protocols every request which has arrived is simulated together as a batch, so a client which pipelines
+    its requests gets the full speed of the numpy engine.
+
+        python simulator_process.py [--binary] [settings.json]
+"""
+import os
+import sys
+import json
+import struct
+
+import numpy
+
+try:
+    import simulation
+except:
+    import library.simulation as simulation
+
+FRAME_HEADER = struct.Struct("<I")
+READ_SIZE = 65536
+
+
+def serve_text(engine, read, write):
+    """
+    Answer text requests until an "end" line or the end of the input.
+    :param engine: a simulation.ClosestApproachEngine
+    :param read: a function which returns the next available bytes of input, or empty bytes at the end of the input
+    :param write: a function which writes and flushes bytes of output
+    """
+    pending = b""
+    while True:
+        chunk = read()
+        if not chunk:
+            return
+        pending += chunk
+        lines = pending.split(b"\n")
+        pending = lines.pop()
+
+        pairs = []
+        finished = False
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            if line == b"end":
+                finished = True
+                break
+            angle, stretch = line.split(b",")
+            pairs.append((float(angle), float(stretch)))
+
+        if pairs:
+            pairs = numpy.array(pairs)
+            results = engine.closest_approach_batch(pairs[:, 0], pairs[:, 1])
+            write("".join("{!r}\n".format(float(value)) for value in results).encode())
+        if finished:
+            return
+
+
+def serve_binary(engine, read, write):
+    """
+    Answer binary framed requests until a frame with a count of zero or the end of the input.
+    :param engine: a simulation.ClosestApproachEngine
+    :param read: a function which returns the next available bytes of input, or empty bytes at the end of the input
+    :param write: a function which writes and flushes bytes of output
+    """
+    pending = b""
+    while True:
+        chunk = read()
+        if not chunk:
+            return
+        pending += chunk
+
+        # Gather every complete frame which has arrived into a single batch
+        counts = []
+        pieces = []
+        finished = False
+        while len(pending) >= FRAME_HEADER.size:
+            count = FRAME_HEADER.unpack_from(pending)[0]
+            if count == 0:
+                finished = True
+                break
+            size = FRAME_HEADER.size + 16 * count
+            if len(pending) < size:
+                break
+            counts.append(count)
+            pieces.append(pending[FRAME_HEADER.size:size])
+            pending = pending[size:]
+
+        if counts:
+            pairs = numpy.frombuffer(b"".join(pieces), dtype="<f8").reshape(-1, 2)
+            results = engine.closest_approach_batch(pairs[:, 0], pairs[:, 1])
+            write(numpy.ascontiguousarray(results, dtype="<f8").tobytes())
+        if finished:
+            return
+
+
+def main(arguments):
+    binary = "--binary" in arguments
+    paths = [argument for argument in arguments if argument != "--binary"]
+    settings_path = paths[0] if paths else "settings.json"
+    with open(settings_path, "r") as handle:
+        engine = simulation.ClosestApproachEngine(json.loads(handle.read()))
+
+    input_fd = sys.stdin.fileno()
+    output = getattr(sys.stdout, "buffer", sys.stdout)
+
+    def read():
+        return os.read(input_fd, READ_SIZE)
+
+    def write(data):
+        output.write(data)
+        output.flush()
+
+    if binary:
+        serve_binary(engine, read, write)
+    else:
+        serve_text(engine, read, write)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
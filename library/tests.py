@@ -4,6 +4,7 @@
     This module exists to aid in the management of tests files.  It functions as a primitive database management
     system in the selection of groups of test files from the data.
 """
+import copy
 import json
 import datetime
 import os
@@ -16,14 +17,216 @@ import os
 import re
 
 import math
+import numbers
+import threading
 import numpy
 
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+try:
+    import record_cache
+    import index
+    import parallel
+except:
+    import library.record_cache as record_cache
+    import library.index as index
+    import library.parallel as parallel
+
 
 def chunks(l, n):
     n = max(1, n)
     return [l[i:i + n] for i in range(0, len(l), n)]
 
 
+# The numpy types of the scalar fields which are most commonly pulled out of the test files.  Categorical fields are
+# stored as integer codes into a list of labels.  Fields which are not listed here become float arrays if every value
+# is numeric and object arrays otherwise.
+COLUMN_TYPES = {"timestamp": "datetime64[us]",
+                "release_angle": "float64",
+                "release_stretch": "float64",
+                "closest_approach": "float64",
+                "subject": "category",
+                "outcome": "category",
+                "manifold_token": "category"}
+
+# Placeholder for a key which is missing from a test file
+MISSING = object()
+
+# The fields of a test file which make up the bulk of its size.  They are skipped by the header loader and decoded only
+# on first access by a projected load, since most queries never look at them.
+HEAVY_FIELDS = ("trace",)
+
+# The version of the archive layout written by TestGroup.save_to_file
+SNAPSHOT_VERSION = 1
+
+# Keys of the form "x0.5" name the temporal characteristic at that angle rather than a field of the test files
+TEMPORAL_PATTERN = re.compile(r"^x([-+]?[0-9]*\.?[0-9]+)$")
+
+
+class TestColumns(dict):
+    """
+    The TestColumns class is a dictionary of key to numpy array, holding the scalar fields of every test in a TestGroup
+    with one row per file in the order of TestGroup.files.  Categorical fields hold integer codes into the label lists
+    in the categories dictionary (with -1 for a missing value), and the rows where a key was missing from the test
+    file are flagged in the boolean arrays of the missing dictionary.
+    """
+
+    def __init__(self, files):
+        dict.__init__(self)
+        self.files = files
+        self.categories = {}
+        self.missing = {}
+
+    def valid(self, *keys):
+        """
+        Return a boolean array which is True for every row in which all of the given keys are present.
+        """
+        mask = numpy.ones(len(self.files), dtype=bool)
+        for key in keys:
+            mask &= ~self.missing[key]
+        return mask
+
+    def decode(self, key, rows=None):
+        """
+        Return the values of a column as a list of python objects, translating categorical codes back into their labels
+        and numpy timestamps back into datetime objects.
+        :param key: the column to decode
+        :param rows: an optional array of row indices to decode, otherwise all rows are decoded
+        :return: a list of values
+        """
+        column = self[key] if rows is None else self[key][rows]
+        if key in self.categories:
+            labels = self.categories[key]
+            return [labels[code] if code >= 0 else None for code in column.tolist()]
+        return column.tolist()
+
+
+def build_column(key, values):
+    """
+    Build a single numpy column from a list of python values, using MISSING (or None) to mark absent values.
+    :param key: the name of the field, used to look up its type in COLUMN_TYPES
+    :param values: a list of python values, one for each test
+    :return: a tuple of the column array, the boolean missing mask, and the list of category labels (or None)
+    """
+    count = len(values)
+    missing = numpy.array([v is MISSING or v is None for v in values], dtype=bool)
+
+    column_type = COLUMN_TYPES.get(key)
+    if column_type is None:
+        # A column is only made numeric when that gives back the same python values: whole numbers become an integer
+        # array as long as none are missing (an integer array has no room for a NaN), and real numbers a float array.
+        # Anything else, including whole numbers with gaps or mixed with real numbers, is kept as it is.
+        integers = reals = False
+        for value, absent in zip(values, missing):
+            if absent:
+                continue
+            if isinstance(value, bool) or not isinstance(value, numbers.Number):
+                integers = reals = True
+                break
+            if isinstance(value, numbers.Integral):
+                integers = True
+            else:
+                reals = True
+        if integers and (reals or missing.any()):
+            column_type = "object"
+        else:
+            column_type = "int64" if integers else "float64"
+
+    if column_type == "category":
+        categories = []
+        lookup = {}
+        codes = numpy.empty(count, dtype=numpy.int32)
+        for i, value in enumerate(values):
+            if missing[i]:
+                codes[i] = -1
+                continue
+            code = lookup.get(value)
+            if code is None:
+                code = lookup[value] = len(categories)
+                categories.append(value)
+            codes[i] = code
+        return codes, missing, categories
+
+    if column_type == "object":
+        array = numpy.empty(count, dtype=object)
+        for i, value in enumerate(values):
+            array[i] = None if missing[i] else value
+        return array, missing, None
+
+    fill = numpy.datetime64("NaT") if column_type.startswith("datetime64") else float("nan")
+    array = numpy.array([fill if absent else value for value, absent in zip(values, missing)], dtype=column_type)
+    return array, missing, None
+
+
+def split_rows_into_blocks(columns, rows, time_delay):
+    """
+    Split a set of rows into blocks of time-adjacent trials from a consistent subject, using a single sort by subject
+    and timestamp and a vectorized search for the gaps.  Rows missing a subject or timestamp are left out.
+    :param columns: a TestColumns object holding at least the 'subject' and 'timestamp' columns
+    :param rows: an array of the row indices to split
+    :param time_delay: a datetime.timedelta giving the minimum gap between two trials which starts a new block
+    :return: a dictionary of subject to a list of row index arrays, one per block, each in timestamp order
+    """
+    rows = numpy.asarray(rows, dtype=numpy.intp)
+    rows = rows[columns.valid('subject', 'timestamp')[rows]]
+    if not len(rows):
+        return {}
+
+    names = numpy.array(columns.files)[rows]
+    order = numpy.lexsort((names, columns['timestamp'][rows], columns['subject'][rows]))
+    rows = rows[order]
+    codes = columns['subject'][rows]
+    times = columns['timestamp'][rows]
+
+    delay = numpy.timedelta64(int(round(time_delay.total_seconds() * 1e6)), 'us')
+    breaks = (codes[1:] != codes[:-1]) | ((times[1:] - times[:-1]) > delay)
+    starts = numpy.concatenate([[0], numpy.flatnonzero(breaks) + 1])
+    ends = numpy.concatenate([starts[1:], [len(rows)]])
+
+    output = {}
+    labels = columns.categories['subject']
+    for start, end in zip(starts, ends):
+        output.setdefault(labels[codes[start]], []).append(rows[start:end])
+    return output
+
+
+def is_temporal_characteristic(key):
+    """
+    Return True if the key names the computed temporal characteristic (e.g. "x0") instead of a field of the tests.
+    """
+    return TEMPORAL_PATTERN.match(key) is not None
+
+
+def matches_condition(value, condition):
+    """
+    Check a single value against a filter condition, which is either a value to compare for equality or a callable
+    which returns True or False.
+    """
+    if hasattr(condition, '__call__'):
+        return condition(value)
+    return value == condition
+
+
+def is_string(value):
+    """
+    Return True if the value is a text string, under both python 2 and 3.
+    """
+    try:
+        return isinstance(value, basestring)
+    except NameError:
+        return isinstance(value, str)
+
+
+def to_datetime(value):
+    """
+    Convert a numpy datetime64 scalar back into a python datetime object.
+    """
+    return value.astype("datetime64[us]").item()
+
+
 class TestGroup:
     """
     The TestGroup class is a group of test files.  It is similar to the TestLibrary except that it is not bound to
@@ -32,12 +235,22 @@ class TestGroup:
     objects), sorted, and so on.  Analyses which are based on groups of tests should be written to handle TestGroups.
     """
     files = []
+    filter_stats = None
 
-    def __init__(self, file_list=[]):
+    def __init__(self, file_list=[], headers=None, records=None):
         """
         :param file_list: optional list of file paths to initialize the test group
+        :param headers: optional dictionary of file path to header fields (as kept by a TestLibrary's index) which
+        can be used in place of loading the files
+        :param records: optional dictionary of file path to complete test dictionary (as restored from a saved group)
+        which is used instead of the files on disk
         """
         self.files = file_list
+        self.headers = headers if headers is not None else index.HeaderTable()
+        self.records = records if records is not None else {}
+        self._column_store = {}
+        self._column_files = None
+        self._column_stamps = None
 
     def __add__(self, other):
         """
@@ -52,7 +265,156 @@ class TestGroup:
         uniques = {}
         for f in all_files:
             uniques[f] = None
-        return TestGroup(uniques.keys())
+
+        headers = self.headers
+        if other.headers is not headers:
+            headers = index.HeaderTable(self.headers)
+            headers.update(other.headers)
+
+        records = self.records
+        if other.records is not records:
+            records = dict(self.records)
+            records.update(other.records)
+        return TestGroup(list(uniques.keys()), headers, records)
+
+    def __derive(self, file_list):
+        """
+        Create a new TestGroup from a list of files which came from this group, sharing this group's headers and records.
+        """
+        return TestGroup(file_list, self.headers, self.records)
+
+    def __load_record(self, item):
+        """
+        Return the test dictionary for a file in this group, from the group's own records if it has one for the file
+        and otherwise from the shared RECORD_CACHE.
+        """
+        if item in self.records:
+            return self.records[item]
+        return load_cached_test_file(item)
+
+    def __load_header(self, item):
+        """
+        Return the test dictionary for a file in this group without its heavy fields (such as the trace), from the
+        group's own records if it has one for the file and otherwise through load_cached_test_header.
+        """
+        if item in self.records:
+            return self.records[item]
+        return load_cached_test_header(item)
+
+    def __load_manifold_token(self, item):
+        """
+        Return the manifold token of a file in this group, or None if it is not a valid test or its settings are
+        incomplete.
+        """
+        if item in self.records:
+            return None if self.records[item] is None else index.manifold_token(self.records[item])
+        return load_cached_manifold_token(item)
+
+    def __file_stamps(self):
+        """
+        Return the (size, mtime) stamp of every file in the group, with None for the files whose tests are held in the
+        group's own records rather than read from disk.
+        """
+        return [None if item in self.records else record_cache.file_stamp(item) for item in self.files]
+
+    def to_columns(self, keys):
+        """
+        Build contiguous numpy arrays of scalar fields from every test in the group in a single pass over the files.
+        Timestamps become datetime64 values, the angles, stretches and closest approach become floats, and the subject
+        and outcome become integer category codes.  Columns are kept with the group, so asking for the same key again
+        costs nothing as long as neither the file list nor the size and modification time of any of the files has
+        changed.
+        :param keys: a list of the keys to extract
+        :return: a TestColumns dictionary of key to numpy array, with one row per file in the order of self.files
+        """
+        stamps = self.__file_stamps()
+        if self._column_files != self.files or self._column_stamps != stamps:
+            self._column_store = {}
+            self._column_files = list(self.files)
+            self._column_stamps = stamps
+
+        needed = [key for key in keys if key not in self._column_store]
+        if needed:
+            # The headers of the files have every field except the heavy ones, so the full record is only loaded if one
+            # of those was asked for
+            if any(key in HEAVY_FIELDS for key in needed):
+                load = self.__load_record
+            else:
+                load = self.__load_header
+            raw = dict((key, []) for key in needed)
+            for item in self.files:
+                header = self.headers.get(item)
+                data = None
+                loaded = False
+                for key in needed:
+                    if header is not None and key in header:
+                        raw[key].append(header[key])
+                        continue
+                    if key == 'manifold_token':
+                        raw[key].append(self.__load_manifold_token(item))
+                        continue
+                    if not loaded:
+                        data = load(item)
+                        loaded = True
+                    raw[key].append(MISSING if data is None else data.get(key, MISSING))
+
+            for key in needed:
+                self._column_store[key] = build_column(key, raw[key])
+
+        columns = TestColumns(self._column_files)
+        for key in keys:
+            array, missing, categories = self._column_store[key]
+            columns[key] = array
+            columns.missing[key] = missing
+            if categories is not None:
+                columns.categories[key] = categories
+        return columns
+
+    def subgroup(self, rows):
+        """
+        Return a new TestGroup made of the given rows of this group, in the given order.  Any columns which have already
+        been built for this group are sliced and carried forward, so the new group doesn't have to look at the files
+        again for them.
+        :param rows: a sequence of row indices into self.files
+        :return: a TestGroup
+        """
+        rows = numpy.asarray(rows, dtype=numpy.intp)
+        group = self.__derive([self.files[i] for i in rows])
+        if self._column_files == self.files:
+            group._column_files = list(group.files)
+            group._column_stamps = [self._column_stamps[i] for i in rows]
+            for key, (array, missing, categories) in self._column_store.items():
+                group._column_store[key] = (array[rows], missing[rows], categories)
+        return group
+
+    def lazy(self):
+        """
+        Return a deferred query plan over this group.  Operations on the plan (filter, split_into_parts,
+        break_into_blocks, get_list_of_key) are only recorded, and the whole plan is run in a single scan of the files
+        when collect() is called or the result is used.  See library.query.QueryPlan.
+        """
+        try:
+            import query
+        except:
+            import library.query as query
+        return query.QueryPlan(self)
+
+    def __time_ordered_rows(self, columns, *keys):
+        """
+        Return the row indices of the columns for which the timestamp and all of the keys are present, ordered by
+        ascending timestamp with ties broken by the file name.
+        """
+        return self.__order_by_time(columns, numpy.flatnonzero(columns.valid('timestamp', *keys)))
+
+    @staticmethod
+    def __order_by_time(columns, rows):
+        """
+        Order an array of row indices by ascending timestamp with ties broken by the file name.
+        """
+        if not len(rows):
+            return rows
+        names = numpy.array(columns.files)[rows]
+        return rows[numpy.lexsort((names, columns['timestamp'][rows]))]
 
     def get_list_of_key(self, key):
         """
@@ -63,20 +425,25 @@ class TestGroup:
         :return: two lists, the first containing the assembled values, and the second containing the filenames
         """
         # Check if this is the temporal characteristic
-        match = re.match(r"^x([-+]?[0-9]*\.?[0-9]+)$", key)
+        match = TEMPORAL_PATTERN.match(key)
         if match:
             angle_value = float(match.group(1))
             return self.__get_2d_temporal_x_characteristic(angle_value)
 
-        extracted = []
-        for item in self.files:
-            data = load_test_file(item)
-            if data is not None:
-                if key in data.keys():
-                    extracted.append((data['timestamp'], data[key], item))
-        extracted.sort()
-        timestamps, values, filenames = zip(*extracted)
-        return values, filenames
+        columns = self.to_columns([key, 'timestamp'])
+
+        # A test which has the key with a value of None is included like any other, but its column can't tell it apart
+        # from a test without the key, so the few rows with no value are looked up in the tests themselves
+        nulls = numpy.zeros(len(columns.files), dtype=bool)
+        load = self.__load_record if key in HEAVY_FIELDS else self.__load_header
+        for i in numpy.flatnonzero(columns.valid('timestamp') & columns.missing[key]):
+            data = load(columns.files[i])
+            nulls[i] = data is not None and key in data
+
+        present = columns.valid('timestamp') & (nulls | ~columns.missing[key])
+        rows = self.__order_by_time(columns, numpy.flatnonzero(present))
+        values = [None if nulls[i] else value for i, value in zip(rows, columns.decode(key, rows))]
+        return tuple(values), tuple(columns.files[i] for i in rows)
 
     def __get_2d_temporal_x_characteristic(self, angle):
         """
@@ -86,26 +453,17 @@ class TestGroup:
         """
 
         # Get the release angles and the stretch
-        extracted = []
-        for item in self.files:
-            data = load_test_file(item)
-            extracted.append((data['timestamp'], data['release_angle'], data['release_stretch'], item))
-        extracted.sort()
-
-        # Unpack them and compute the means and standard deviations
-        timestamps, release_angle, release_stretch, filenames = zip(*extracted)
+        columns = self.to_columns(['timestamp', 'release_angle', 'release_stretch'])
+        rows = self.__time_ordered_rows(columns, 'release_angle', 'release_stretch')
+        release_angle = columns['release_angle'][rows]
+        release_stretch = columns['release_stretch'][rows]
+        filenames = tuple(columns.files[i] for i in rows)
 
-        p_mean = numpy.mean(release_angle)
-        v_mean = numpy.mean(release_stretch)
-        p_std = numpy.std(release_angle)
-        v_std = numpy.std(release_stretch)
+        # Compute the means and standard deviations and normalize
+        normalized_p = (release_angle - release_angle.mean()) / release_angle.std()
+        normalized_v = (release_stretch - release_stretch.mean()) / release_stretch.std()
 
-        normalized_p = [(p-p_mean)/p_std for p in release_angle]
-        normalized_v = [(v-v_mean)/v_std for v in release_stretch]
-
-        values = []
-        for x1, x2 in zip(normalized_p, normalized_v):
-            values.append(x1 * math.cos(angle) + x2 * math.sin(angle))
+        values = (normalized_p * math.cos(angle) + normalized_v * math.sin(angle)).tolist()
 
         if len(filenames) != len(values):
             raise ValueError("The number of computed values didn't come out to be the same as the number of files in the TestGroup, check the algorithm")
@@ -120,7 +478,7 @@ class TestGroup:
         self.files.sort()
 
         group_size = int(len(self.files) / float(parts)) + 1
-        return [TestGroup(x) for x in chunks(self.files, group_size)]
+        return [self.__derive(x) for x in chunks(self.files, group_size)]
 
     def get_unique_list_of_key(self, key):
         """
@@ -131,19 +489,50 @@ class TestGroup:
         attributes, filenames = self.get_list_of_key(key)
         return list(set(attributes))
 
-    def get_data_list(self):
+    def preload(self, workers=None, chunk_size=None, headers_only=False):
+        """
+        Load every file in the group which isn't already in the RECORD_CACHE using a pool of worker processes, so that
+        the methods which follow find the parsed data waiting for them.  Files which fail to load are reported in the
+        returned dictionary rather than raising an exception, and are treated as invalid tests from then on.
+        :param workers: the number of worker processes, defaults to the number of cores
+        :param chunk_size: the number of files handed to a worker at a time, picked automatically if not given
+        :param headers_only: load only the headers of the files into the HEADER_CACHE, skipping the heavy fields
+        :return: a dictionary of file path to error message for any files which failed to load
+        """
+        if headers_only:
+            cache, loader = HEADER_CACHE, load_test_header
+        else:
+            cache, loader = RECORD_CACHE, load_test_file
+
+        errors = {}
+        stale = cache.stale([item for item in self.files if item not in self.records])
+        for result in parallel.load_files(stale, loader, workers, chunk_size):
+            cache.put(result.path, result.data, result.stamp)
+            if result.error is not None:
+                errors[result.path] = result.error
+        return errors
+
+    def get_data_list(self, workers=None, shared=False):
         """
-        Return a list of python dictionaries containing the data in the test group
+        Return a list of python dictionaries containing the data in the test group.  The dictionaries are copies which
+        the caller is free to modify, unless shared is set.
+        :param workers: optionally load the files with this many worker processes (see preload)
+        :param shared: return the dictionaries held by the RECORD_CACHE (or the group's own records) themselves, which
+        saves copying them but which must not be modified, since every later load of the same files would see the change
         :return: list of python dictionaries
         """
-        return [load_test_file(path) for path in self.files]
+        if workers is not None:
+            self.preload(workers)
+        records = [self.__load_record(path) for path in self.files]
+        return records if shared else copy.deepcopy(records)
 
     def get_release_points(self):
         """
         Return a list of release angles and stretches
         :return: a list of 2-element tuples containing the release angle and stretches
         """
-        return [(r['release_angle'], r['release_stretch']) for r in self.get_data_list()]
+        columns = self.to_columns(['release_angle', 'release_stretch'])
+        return list(zip(columns['release_angle'].tolist(), columns['release_stretch'].tolist()))
 
     def filter(self, filter_data):
         """
@@ -160,41 +549,236 @@ class TestGroup:
         if type(filter_data) is not dict:
             raise Exception("The filter_data argument must be a dictionary")
 
-        reduced = list(self.files)
+        # Equality conditions on the indexed header fields are answered from the hash index of the header table.  Every
+        # other condition is checked against the header if the header has the key, and only then against the test
+        # data itself, which is loaded at most once per file no matter how many conditions there are.
+        stats = {"files": len(self.files), "index_lookups": 0, "header_checks": 0, "opened": 0}
+        indexed = {}
+        candidates = None
+        conditions = []
         for key, value in filter_data.items():
-
-            subgroup = []
-            if hasattr(value, '__call__'):
-                # the sorting value is a callable object (a function) and should be used to evaluate the filter
-                function = value
-                for item in reduced:
-                    data = load_test_file(item)
-                    if data is not None:
-                        if function(data[key]):
-                            subgroup.append(item)
-            else:
-                for item in reduced:
-                    data = load_test_file(item)
-                    if data is not None:
-                        if data[key] == value:
-                            subgroup.append(item)
-            reduced = list(subgroup)
-
-        return TestGroup(reduced)
-
-    def save_to_file(self, file_path):
+            if self.headers and key in index.INDEXED_FIELDS and not hasattr(value, '__call__'):
+                indexed[key] = self.headers.lookup(key, value)
+                stats["index_lookups"] += 1
+
+                # A file can only pass if the index matches it, or if its header doesn't hold the key and the test
+                # itself has to be checked
+                possible = indexed[key] | self.headers.lookup(key, None)
+                candidates = possible if candidates is None else candidates & possible
+            conditions.append((key, value))
+        conditions.sort(key=lambda condition: condition[0] not in indexed)
+
+        files = self.files
+        if candidates is not None:
+            headers = self.headers
+            files = [item for item in self.files if item in candidates or item not in headers]
+        stats["candidates"] = len(files)
+
+        reduced = []
+        for item in files:
+            header = self.headers.get(item)
+            remaining = []
+            passed = True
+            for key, value in conditions:
+                if header is None or header.get(key) is None:
+                    remaining.append((key, value))
+                    continue
+                if key in indexed:
+                    passed = item in indexed[key]
+                else:
+                    stats["header_checks"] += 1
+                    passed = matches_condition(header[key], value)
+                if not passed:
+                    break
+
+            if passed and remaining:
+                if any(key in HEAVY_FIELDS for key, value in remaining):
+                    data = self.__load_record(item)
+                else:
+                    data = self.__load_header(item)
+                stats["opened"] += 1
+                if data is None:
+                    passed = False
+                for key, value in remaining:
+                    if not passed:
+                        break
+                    if key == "manifold_token" and key not in data:
+                        passed = matches_condition(self.__load_manifold_token(item), value)
+                    else:
+                        passed = matches_condition(data[key], value)
+
+            if passed:
+                reduced.append(item)
+
+        stats["matched"] = len(reduced)
+        group = self.__derive(reduced)
+        group.filter_stats = stats
+        return group
+
+    def save_to_file(self, file_path, include_traces=False):
         """
-        Save the group to a zip file at file_path
+        Save the group to a single compressed numpy archive (a zip file) at file_path.  The archive holds the file list,
+        every scalar field of the tests as a numpy column, the manifold tokens, the distinct settings blocks (each stored
+        once no matter how many tests share it), any other fields as json, and optionally the traces.  A group restored
+        with load_from_file needs neither the original files nor any json parsing of them.
+        :param file_path: the path of the archive to write
+        :param include_traces: also store the 'trace' of every test, which makes the archive much larger
         """
-        # TODO: implement TestGroup.save_to_file()
-        raise Exception("TestGroup.save_to_file() is not implemented yet")
+        records = self.get_data_list(shared=True)
+        valid = [record for record in records if record is not None]
+
+        # Sort out which keys can be stored as columns and which have to go into the json extras.  A column can't tell a
+        # value of None from a missing key, so keys which are ever None go into the extras too.
+        scalar_keys = set()
+        other_keys = set()
+        for record in valid:
+            for key, value in record.items():
+                if key in ('settings', 'trace'):
+                    continue
+                if isinstance(value, (numbers.Number, datetime.datetime)) or is_string(value):
+                    scalar_keys.add(key)
+                else:
+                    other_keys.add(key)
+        scalar_keys -= other_keys
+
+        arrays = {"version": numpy.array(SNAPSHOT_VERSION),
+                  "files": numpy.array(self.files, dtype=numpy.str_)}
+
+        for key in sorted(scalar_keys):
+            array, missing, categories = build_column(key, [MISSING if r is None else r.get(key, MISSING)
+                                                            for r in records])
+            if array.dtype == object:
+                other_keys.add(key)
+                continue
+            arrays["column:" + key] = array
+            arrays["missing:" + key] = missing
+            if categories is not None:
+                arrays["categories:" + key] = numpy.array([json.dumps(c) for c in categories], dtype=numpy.str_)
+
+        # Store each distinct settings block once, with an index into them for every test
+        settings_blocks = []
+        settings_lookup = {}
+        settings_index = numpy.full(len(records), -1, dtype=numpy.int32)
+        tokens = []
+        for i, record in enumerate(records):
+            tokens.append("" if record is None else index.manifold_token(record) or "")
+            if record is None or 'settings' not in record:
+                continue
+            text = json.dumps(record['settings'], sort_keys=True)
+            if text not in settings_lookup:
+                settings_lookup[text] = len(settings_blocks)
+                settings_blocks.append(text)
+            settings_index[i] = settings_lookup[text]
+        arrays["settings"] = numpy.array(settings_blocks, dtype=numpy.str_)
+        arrays["settings_index"] = settings_index
+        arrays["manifold_tokens"] = numpy.array(tokens, dtype=numpy.str_)
+
+        if other_keys:
+            extras = []
+            for record in records:
+                present = {} if record is None else dict((k, record[k]) for k in other_keys if k in record)
+                extras.append(json.dumps(present))
+            arrays["extras"] = numpy.array(extras, dtype=numpy.str_)
+
+        if include_traces:
+            lengths = numpy.zeros(len(records), dtype=numpy.int64)
+            widths = numpy.zeros(len(records), dtype=numpy.int32)
+            has_trace = numpy.zeros(len(records), dtype=bool)
+            pieces = []
+            for i, record in enumerate(records):
+                if record is None or 'trace' not in record:
+                    continue
+                trace = numpy.asarray(record['trace'], dtype=numpy.float64)
+                has_trace[i] = True
+                lengths[i] = trace.shape[0]
+                widths[i] = trace.shape[1] if trace.ndim > 1 else 0
+                pieces.append(trace.ravel())
+            arrays["trace_data"] = numpy.concatenate(pieces) if pieces else numpy.zeros(0)
+            arrays["trace_lengths"] = lengths
+            arrays["trace_widths"] = widths
+            arrays["trace_present"] = has_trace
+
+        with open(file_path, "wb") as handle:
+            numpy.savez_compressed(handle, **arrays)
 
     def load_from_file(self, file_path):
         """
-        Load a group from a zip file at file_path
+        Load a group from an archive written by save_to_file, replacing the contents of this group.  The tests are
+        restored into the group's own records, so the original .json files don't need to exist.  Tests restored from
+        an archive saved without traces have no 'trace' key, and restored trace values are floats.
+        :param file_path: the path of the archive to read
+        :return: this TestGroup, for convenience
         """
-        # TODO: implement TestGroup.load_from_file()
-        raise Exception("TestGroup.load_from_file() is not implemented yet")
+        with numpy.load(file_path) as archive:
+            if "version" not in archive.files or int(archive["version"]) != SNAPSHOT_VERSION:
+                raise Exception("'{}' is not a TestGroup archive this version can read".format(file_path))
+
+            files = archive["files"].tolist()
+            store = {}
+            for name in archive.files:
+                if not name.startswith("column:"):
+                    continue
+                key = name[len("column:"):]
+                categories = None
+                if "categories:" + key in archive.files:
+                    categories = [json.loads(c) for c in archive["categories:" + key].tolist()]
+                store[key] = (archive[name], archive["missing:" + key], categories)
+
+            settings_blocks = [json.loads(text) for text in archive["settings"].tolist()]
+            settings_index = archive["settings_index"]
+            tokens = archive["manifold_tokens"].tolist()
+            extras = archive["extras"].tolist() if "extras" in archive.files else None
+
+            traces = None
+            if "trace_data" in archive.files:
+                traces = (archive["trace_data"], archive["trace_lengths"], archive["trace_widths"],
+                          archive["trace_present"])
+
+        # Decode every column into python values once, then assemble the test dictionaries row by row
+        decoded = {}
+        for key, (array, missing, categories) in store.items():
+            columns = TestColumns(files)
+            columns[key] = array
+            if categories is not None:
+                columns.categories[key] = categories
+            decoded[key] = (columns.decode(key), missing)
+
+        records = {}
+        headers = index.HeaderTable()
+        offset = 0
+        for i, path in enumerate(files):
+            if settings_index[i] < 0 and not tokens[i]:
+                records[path] = None
+                continue
+
+            record = {}
+            for key, (values, missing) in decoded.items():
+                if not missing[i]:
+                    record[key] = values[i]
+            if extras is not None:
+                record.update(json.loads(extras[i]))
+            if settings_index[i] >= 0:
+                record['settings'] = settings_blocks[settings_index[i]]
+            if traces is not None and traces[3][i]:
+                data, lengths, widths, present = traces
+                size = int(lengths[i] * max(widths[i], 1))
+                trace = data[offset:offset + size]
+                offset += size
+                record['trace'] = (trace.reshape(lengths[i], widths[i]) if widths[i] else trace).tolist()
+            records[path] = record
+
+            # The same header fields as the index of a TestLibrary holds
+            header = dict((field, record.get(field)) for field, column_type in index.HEADER_FIELDS)
+            header['manifold_token'] = tokens[i] or None
+            headers[path] = header
+
+        self.files = files
+        self.headers = headers
+        self.records = records
+        self._column_store = store
+        self._column_files = list(files)
+        self._column_stamps = [None] * len(files)
+        return self
 
     def break_into_blocks(self, time_delay=datetime.timedelta(minutes=10)):
         """
@@ -205,40 +789,32 @@ class TestGroup:
         trials in order to create a separate block
         :return: a dictionary of blocks
         """
-        output = {}
-
-        # Get the unique test subjects
-        subjects = self.get_unique_list_of_key('subject')
+        # One sort by subject and timestamp over the columns, with the gaps found in a single vectorized pass.  The
+        # blocks are made with subgroup() so that they carry the columns forward rather than looking at the files again.
+        columns = self.to_columns(['subject', 'timestamp'])
+        blocks = split_rows_into_blocks(columns, numpy.arange(len(self.files)), time_delay)
 
-        for subject in subjects:
-            # Get the timestamp and filenames of all tests with this subject
-            blocks = []
-            subject_files = []
-            for item in self.files:
-                data = load_test_file(item)
-                if data['subject'] == subject:
-                    subject_files.append([data['timestamp'], item])
-
-            # Sort the files by timestamp
-            subject_files.sort()
-
-            block = [subject_files[0]]
-            subject_files.remove(subject_files[0])
-
-            # Create blocks
-            for item in subject_files:
-                if item[0] - block[-1][0] > time_delay:
-                    # gap, form a new block
-                    if block:
-                        blocks.append(TestGroup([b[1] for b in block]))
-                        block = [item]
-                else:
-                    block.append(item)
-            if block:
-                blocks.append(TestGroup([b[1] for b in block]))
+        output = {}
+        for subject, block_rows in blocks.items():
+            output[subject] = [self.subgroup(rows) for rows in block_rows]
+        return output
 
-            output[subject] = blocks
+    def group_by_manifold(self):
+        """
+        Split the group by manifold in a single pass, using the manifold tokens kept in the headers or in the shared
+        TOKEN_CACHE, so no settings are hashed again.  Tests which are not valid (or whose settings don't give a
+        manifold token) are left out.
+        :return: a dictionary of manifold token to TestGroup, each holding its tests in the order of this group
+        """
+        columns = self.to_columns(['manifold_token'])
+        codes = columns['manifold_token']
+        rows = numpy.flatnonzero(codes >= 0)
+        rows = rows[numpy.argsort(codes[rows], kind="mergesort")]
+        starts = numpy.flatnonzero(numpy.diff(codes[rows])) + 1
 
+        output = {}
+        for token_rows in numpy.split(rows, starts) if len(rows) else []:
+            output[columns.categories['manifold_token'][codes[token_rows[0]]]] = self.subgroup(token_rows)
         return output
 
     def get_timespan(self):
@@ -246,17 +822,10 @@ class TestGroup:
         Return a dictionary with the first and last test timestamp, as well as the span of the tests as a
         datetime.timedelta object
         """
-        first = None
-        last = None
-
-        for item in self.files:
-            data = load_test_file(item)
-
-            if first is None or data['timestamp'] < first:
-                first = data['timestamp']
-
-            if last is None or data['timestamp'] > last:
-                last = data['timestamp']
+        columns = self.to_columns(['timestamp'])
+        timestamps = columns['timestamp'][columns.valid('timestamp')]
+        first = to_datetime(timestamps.min())
+        last = to_datetime(timestamps.max())
 
         return {"first": first, "last": last, "span": last - first}
 
@@ -265,40 +834,27 @@ class TestGroup:
         Return a summary dictionary which gives information about the test group
         """
 
-        # Though doing these computations manually instead of using the other functions seems redundant and more
-        # complex than necessary, the issue here is that each of those other functions performs a loop through the
-        # entire file list, requiring a disk access on each.  This way has redundant code, but only requires one pass
-        # through the file list, and thus one round of disk access only. On long lists of files this makes a difference.
-        subjects = []
-        count = 0
-        hits = 0
-        misses = 0
-        obstacle = 0
-        first = None
-        last = None
-
-        for item in self.files:
-            data = load_test_file(item)
-            subjects.append(data['subject'])
-            count += 1
-            if data['outcome'] == "hit":
-                hits += 1
-            if data['outcome'] == "miss":
-                misses += 1
-            if data['outcome'] == "obstacle":
-                obstacle += 1
-
-            if first is None or data['timestamp'] < first:
-                first = data['timestamp']
-
-            if last is None or data['timestamp'] > last:
-                last = data['timestamp']
-
-        output = {"subjects": list(set(subjects)),
-                  "count": count,
-                  "hits": hits,
-                  "misses": misses,
-                  "obstacles": obstacle,
+        # All three fields come out of a single pass through the file list (or straight from the library index), so
+        # the summary only requires one round of disk access at most.
+        columns = self.to_columns(['subject', 'outcome', 'timestamp'])
+
+        outcomes = columns['outcome']
+        counts = numpy.bincount(outcomes[outcomes >= 0], minlength=len(columns.categories['outcome']))
+        tally = dict(zip(columns.categories['outcome'], counts.tolist()))
+
+        # The category lists may be shared with a larger group, so only report the subjects which actually appear
+        subject_codes = columns['subject']
+        subjects = [columns.categories['subject'][code] for code in numpy.unique(subject_codes[subject_codes >= 0])]
+
+        timestamps = columns['timestamp'][columns.valid('timestamp')]
+        first = to_datetime(timestamps.min())
+        last = to_datetime(timestamps.max())
+
+        output = {"subjects": subjects,
+                  "count": len(columns.files),
+                  "hits": tally.get("hit", 0),
+                  "misses": tally.get("miss", 0),
+                  "obstacles": tally.get("obstacle", 0),
                   "timespan": td_format(last - first)}
         return output
 
@@ -320,67 +876,298 @@ class TestGroup:
 class TestLibrary(TestGroup):
     """
     The TestLibrary class serves as a primitive database management system, and aids in the selection, grouping, and
-    filtering of test files.
+    filtering of test files.  The file list and headers are only changed while holding self.lock, which to_columns and
+    filter take as well, so a LibraryWatcher can update the library from a background thread while it is being read.
     """
     library_path = None
     files = None
 
-    def __init__(self, library_path):
+    def __init__(self, library_path, use_index=True, workers=None, chunk_size=None):
         """
         :param library_path: the directory path that points at a folder full of test files
+        :param use_index: keep a persistent metadata index in the library folder so that only new or changed files
+        need to be parsed when the library is opened again
+        :param workers: optionally load and validate the files with this many worker processes
+        :param chunk_size: the number of files handed to a worker at a time, picked automatically if not given
         :return: None
         """
         TestGroup.__init__(self)
+        self.lock = threading.RLock()
 
         # Set the library path
         self.library_path = library_path
         if not os.path.exists(self.library_path):
             raise Exception("TestLibrary could not find the path '{}'".format(self.library_path))
 
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.load_errors = {}
+
+        self.index = None
+        if use_index:
+            try:
+                self.index = index.LibraryIndex(self.library_path)
+            except Exception:
+                # The folder may be read-only or the database damaged, in which case we fall back to a full scan
+                self.index = None
+
         # Update the self.files list from the library
         self.update_library()
 
     def update_library(self):
         """
-        Go through the library_path and find all test files and verify them
+        Go through the library_path and find all test files and verify them.  Any files which failed to load when
+        using worker processes are listed in self.load_errors.
         :return:
         """
-        file_objects = [os.path.join(self.library_path, item) for item in os.listdir(self.library_path) if
-                        item.endswith(".json")]
+        file_names = [item for item in os.listdir(self.library_path) if item.endswith(".json")]
+
+        if self.workers is not None:
+            if self.index is not None:
+                stale = [os.path.join(self.library_path, name) for name in self.index.stale(file_names)]
+            else:
+                stale = [os.path.join(self.library_path, name) for name in file_names]
+            self.load_errors = TestGroup(stale).preload(self.workers, self.chunk_size, headers_only=True)
+
+        if self.index is not None:
+            indexed = self.index.update(file_names, load_cached_test_header)
+            with self.lock:
+                self.headers.clear()
+                self.headers.update(indexed)
+                self.files = [path for path, header in indexed]
+            return
+
+        file_objects = [os.path.join(self.library_path, item) for item in file_names]
 
         # Validate the files
         validated = []
         for item in file_objects:
-            if load_test_file(item) is not None:
+            if load_cached_test_header(item) is not None:
                 validated.append(item)
 
-        self.files = validated
+        with self.lock:
+            self.files = validated
 
+    def to_columns(self, keys):
+        with self.lock:
+            return TestGroup.to_columns(self, keys)
 
-def load_test_file(filepath):
+    def filter(self, filter_data):
+        with self.lock:
+            return TestGroup.filter(self, filter_data)
+
+    def watch(self, interval=2.0):
+        """
+        Return a LibraryWatcher which keeps this library up to date with the files landing in its folder during a data
+        collection session, feeding new tests to running aggregates and callbacks.  See library.ingest.
+        :param interval: the number of seconds between polls when the watcher is running
+        :return: a LibraryWatcher
+        """
+        try:
+            import ingest
+        except:
+            import library.ingest as ingest
+        return ingest.LibraryWatcher(self, interval)
+
+
+class LazyRecord(Mapping):
     """
-    Given the path of a .json test file, load it, parse it to a test dictionary, and return it.  If the file does not
-    appear to be a valid test (no 'settings', 'timestamp', or 'test_id' key) return None
+    A read-only test dictionary returned by a projected load_test_file.  The light fields are decoded when the file is
+    loaded, while the heavy fields (see HEAVY_FIELDS) are kept as their raw json text and only decoded the first time
+    they are accessed.
+    """
+
+    def __init__(self, fields, raw=None):
+        """
+        :param fields: a dictionary of the decoded fields
+        :param raw: a dictionary of field name to the json text of the fields which haven't been decoded yet
+        """
+        self._fields = fields
+        self._raw = raw if raw is not None else {}
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            return self._fields[key]
+        if key in self._raw:
+            value = json.loads(self._raw[key])
+            self._fields[key] = value
+            self._raw.pop(key, None)
+            return value
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(list(self._fields) + [key for key in list(self._raw) if key not in self._fields])
+
+    def __len__(self):
+        return len(set(self._fields) | set(self._raw))
+
+    def is_decoded(self, key):
+        """
+        Return True if the field has been decoded, False if it is still held as json text.
+        """
+        return key in self._fields
+
+    def __repr__(self):
+        return "LazyRecord({}, undecoded={})".format(self._fields, sorted(self._raw))
+
+
+def split_heavy_fields(contents):
+    """
+    Cut the values of the HEAVY_FIELDS out of the json text of a test file without parsing them.  The traces are nested
+    arrays of numbers, so the end of one is the last closing bracket before the next quote in the file, which can be
+    found without stepping through the text character by character.  Each value is replaced with null, and the caller
+    should check that the null shows up at the top level of the parsed document before trusting the split.
+    :param contents: the json text of a test file
+    :return: the json text with the heavy values replaced, and a dictionary of field name to the json text of its value,
+    or None if a heavy value isn't laid out as expected
+    """
+    heavy = {}
+    for key in HEAVY_FIELDS:
+        match = re.search(r'"{}"\s*:\s*\['.format(re.escape(key)), contents)
+        if match is None:
+            continue
+        start = match.end() - 1
+        quote = contents.find('"', start)
+        stop = contents.rfind(']', start, quote if quote >= 0 else len(contents)) + 1
+        value = contents[start:stop]
+        if stop <= start or value.count('[') != value.count(']'):
+            return None
+        heavy[key] = value
+        contents = contents[:start] + "null" + contents[stop:]
+    return contents, heavy
+
+
+def parse_test_file(filepath, skip_heavy=False):
+    """
+    Load and validate a .json test file, optionally leaving the heavy fields as unparsed json text.
     :param filepath: the filepath of the .json test file
-    :return: a dictionary with the test data in it
+    :param skip_heavy: cut out the HEAVY_FIELDS before parsing rather than decoding them
+    :return: a tuple of the test dictionary (None if the file is not a valid test) and a dictionary of field name to
+    json text for the heavy fields which were skipped
     """
     if not os.path.exists(filepath):
-        return None
+        return None, {}
 
     # Load the results from the json file
     with open(filepath, "r") as handle:
         contents = handle.read()
+
+    results = None
+    heavy = {}
+    if skip_heavy:
+        split = split_heavy_fields(contents)
+        if split is not None:
+            try:
+                results = json.loads(split[0])
+                heavy = split[1]
+            except ValueError:
+                results = None
+            # If any of the nulls didn't land on a top level key the split can't be trusted
+            if not isinstance(results, dict) or any(results.get(key, MISSING) is not None for key in heavy):
+                results = None
+                heavy = {}
+            else:
+                for key in heavy:
+                    del results[key]
+
+    if results is None:
         results = json.loads(contents)
 
+        # The slow way round, the heavy fields are decoded and then handed back as json text like a successful split
+        if skip_heavy and isinstance(results, dict):
+            for key in HEAVY_FIELDS:
+                if key in results:
+                    heavy[key] = json.dumps(results.pop(key))
+
     # Validate that the three test keys are in the dictionary
     for valid_key in ['settings', 'timestamp', 'test_id']:
         if valid_key not in results.keys():
-            return None
+            return None, {}
 
     # Convert the string timestamp into a python datetime object
     timestamp = datetime.datetime.strptime(results['timestamp'], "%H:%M:%S, %Y-%m-%d")
     results['timestamp'] = timestamp
-    return results
+
+    return results, heavy
+
+
+def load_test_file(filepath, keys=None):
+    """
+    Given the path of a .json test file, load it, parse it to a test dictionary, and return it.  If the file does not
+    appear to be a valid test (no 'settings', 'timestamp', or 'test_id' key) return None.
+
+    If a list of keys is given, only those keys are returned, in a LazyRecord.  The heavy fields (such as the 'trace')
+    are never parsed unless they are among the keys, and even then they are only decoded when first accessed.
+    :param filepath: the filepath of the .json test file
+    :param keys: optional list of the keys to return
+    :return: a dictionary with the test data in it
+    """
+    results, heavy = parse_test_file(filepath, skip_heavy=keys is not None)
+    if results is None or keys is None:
+        return results
+
+    fields = dict((key, results[key]) for key in keys if key in results)
+    raw = dict((key, heavy[key]) for key in keys if key in heavy)
+    return LazyRecord(fields, raw)
+
+
+def load_test_header(filepath):
+    """
+    Load a .json test file without its heavy fields.  Everything but the HEAVY_FIELDS is returned as a regular test
+    dictionary, which is all that filtering, sorting and grouping ever look at.
+    :param filepath: the filepath of the .json test file
+    :return: a dictionary with the test data but no heavy fields, or None if the file is not a valid test
+    """
+    return parse_test_file(filepath, skip_heavy=True)[0]
+
+
+def load_cached_test_file(filepath):
+    """
+    Load a test file through the shared RECORD_CACHE, so that a file is only parsed again if it has changed on disk
+    since it was last loaded.  The returned dictionary is shared with other callers and should not be modified.
+    :param filepath: the filepath of the .json test file
+    :return: a dictionary with the test data in it, or None if the file is not a valid test
+    """
+    return RECORD_CACHE.get(filepath)
+
+
+def load_cached_test_header(filepath):
+    """
+    Load the header of a test file (see load_test_header) through the shared HEADER_CACHE.  If the complete record is
+    already in the RECORD_CACHE it is returned instead, since it has every field of the header.
+    :param filepath: the filepath of the .json test file
+    :return: a dictionary with the test data in it, or None if the file is not a valid test
+    """
+    found, record = RECORD_CACHE.peek(filepath)
+    if found:
+        return record
+    return HEADER_CACHE.get(filepath)
+
+
+def load_test_manifold_token(filepath):
+    """
+    Return the manifold token of a test file, or None if the file is not a valid test or its settings are missing any
+    of the fields the token is made of.
+    """
+    data = load_cached_test_header(filepath)
+    return None if data is None else index.manifold_token(data)
+
+
+def load_cached_manifold_token(filepath):
+    """
+    Return the manifold token of a test file (see load_test_manifold_token) through the shared TOKEN_CACHE, so the
+    settings of a file are only hashed again if it has changed on disk.  The tokens are kept apart from the test
+    records, which callers are free to change.
+    """
+    return TOKEN_CACHE.get(filepath)
+
+
+# The shared caches of parsed test records, test headers and manifold tokens used by TestGroup and TestLibrary.  A
+# header is a small fraction of its file, so the header cache estimates its memory use accordingly, and a token costs
+# next to nothing.
+RECORD_CACHE = record_cache.RecordCache(load_test_file)
+HEADER_CACHE = record_cache.RecordCache(load_test_header, expansion_factor=0.5)
+TOKEN_CACHE = record_cache.RecordCache(load_test_manifold_token, expansion_factor=0)
 
 
 def td_format(td_object):
@@ -67,11 +67,12 @@ def main3():
     #tests = library.tests.TestLibrary("data")
     tests = library.continuous.ContinuousGroup("data/Test 2017-04-13_10-04-22.json")
 
-    noise_results = library.costs.compute_noise_cost(tests)
-    covariation_results = library.costs.compute_covariation_cost(tests)
-    tolerance_results = library.costs.compute_tolerance_cost(tests)
+    results = library.costs.compute_all_costs(tests)
+    noise_results = results['noise']
+    covariation_results = results['covariation']
+    tolerance_results = results['tolerance']
 
-    print "Initial Score: ", noise_results['initial_score']
+    print "Initial Score: ", results['initial_score']
     print "Noise Cost: ", noise_results['cost']
     print "Covariation Cost: ", covariation_results['cost']
     print "Tolerance Cost: ", tolerance_results['cost']
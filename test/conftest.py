@@ -0,0 +1,64 @@
+"""
+    conftest.py
+
+    Shared fixtures for the tests of the library package.  The tests don't rely on any recorded data, every test file
+    they need is written into a temporary folder from the settings below, which are those the game writes by default.
+"""
+import copy
+import datetime
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SETTINGS = {"PitchMinimum": 75.0, "PitchMaximum": 1000.0, "AngleMinimum": 0.0, "AngleMaximum": 90.0,
+            "VolumeMinimum": -30.0, "VolumeMaximum": 0.0, "StretchMaximum": 1.0, "StretchMinimum": 0.0,
+            "Gravity": -0.01, "TargetDiameter": 30.0, "TargetValidDiameter": 30.0, "SemitoneSpan": 12.0,
+            "UseSemitones": False, "PitchSpan": 200.0, "VolumeSpan": 20.0, "FieldWidth": 800.0, "FieldHeight": 266.6,
+            "TargetShift": -15.0, "CleanTrace": True,
+            "Obstacle": {"Position": 200.0, "Top": 400.0, "Bottom": 0.0, "Height": 400.0},
+            "Target": {"X": 600.0, "Y": 150.0, "Z": 0.0, "Length": 618.4658438426491},
+            "Anchor": {"X": 60.0, "Y": 75.0, "Z": 0.0, "Length": 96.04686356149273}}
+
+START = datetime.datetime(2017, 4, 3, 15, 0, 0)
+
+
+def make_test(number, subject="Alice", angle=None, stretch=None, outcome="miss", settings=None, **fields):
+    """
+    Build the dictionary of a test file, twenty seconds after the previous one.
+    """
+    data = {"test_id": "id{}".format(number),
+            "subject": subject,
+            "timestamp": (START + datetime.timedelta(seconds=20 * number)).strftime("%H:%M:%S, %Y-%m-%d"),
+            "release_angle": 30.0 + number if angle is None else angle,
+            "release_stretch": 0.8 + 0.001 * number if stretch is None else stretch,
+            "closest_approach": 10.0 + number,
+            "outcome": outcome,
+            "trace": [[0.0, 60.0, 75.0], [15.7, 61.0, 76.0]],
+            "settings": copy.deepcopy(SETTINGS if settings is None else settings)}
+    data.update(fields)
+    return data
+
+
+def write_test(folder, data, name=None):
+    """
+    Write a test dictionary to a .json file in folder and return its path.
+    """
+    path = os.path.join(str(folder), name or "Test {}.json".format(data["test_id"]))
+    with open(path, "w") as handle:
+        json.dump(data, handle)
+    return path
+
+
+@pytest.fixture
+def library_folder(tmp_path):
+    """
+    A folder of twelve valid tests by two subjects.
+    """
+    for number in range(12):
+        write_test(tmp_path, make_test(number, subject="Alice" if number < 6 else "Bob",
+                                       outcome="hit" if number % 3 == 0 else "miss"))
+    return str(tmp_path)
@@ -0,0 +1,92 @@
+"""
+    make_compute_solution_reference.py
+
+    Write compute_solution_reference.npz, the closest approaches ComputeSolution.exe gives for three settings (the
+    defaults, a stronger gravity with a shorter obstacle further out, and a lower, larger target) over a grid and a set
+    of random points each.  test_simulation.py checks the numpy engine against them.
+
+    ComputeSolution.exe is run through a SolutionManifold with native=False, so this needs a machine it can run on.  On
+    Windows the command defaults to library/manifold_binaries/ComputeSolution.exe; elsewhere give the command to run it
+    with, such as dotnet and the path of a copy of the binary with its dependencies and a runtimeconfig.json:
+
+        python test/data/make_compute_solution_reference.py
+        python test/data/make_compute_solution_reference.py dotnet path/to/ComputeSolution.exe
+
+    With --check the file is not written, instead its closest approaches are compared with those of ComputeSolution.exe
+    and the largest difference is printed.
+"""
+import copy
+import json
+import os
+import sys
+
+import numpy
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.dirname(os.path.dirname(HERE)))
+
+from conftest import SETTINGS
+from library import manifold
+
+REFERENCE = os.path.join(HERE, "compute_solution_reference.npz")
+RANDOM_POINTS = 800
+SEED = 0
+
+
+def reference_settings():
+    variants = [copy.deepcopy(SETTINGS)]
+    variants.append(dict(copy.deepcopy(SETTINGS), Gravity=-0.02,
+                         Obstacle={"Position": 300.0, "Top": 200.0, "Bottom": 0.0, "Height": 200.0}))
+    variants.append(dict(copy.deepcopy(SETTINGS), TargetValidDiameter=60.0,
+                         Target={"X": 500.0, "Y": 60.0, "Z": 0.0, "Length": 1.0}))
+    return variants
+
+
+def reference_points(random):
+    """ A 46 x 26 grid over the angle and stretch ranges, followed by random points. """
+    grid_angles, grid_stretches = numpy.meshgrid(numpy.linspace(0, 90, 46), numpy.linspace(0, 1, 26))
+    angles = numpy.concatenate([grid_angles.ravel(), random.uniform(0, 90, RANDOM_POINTS)])
+    stretches = numpy.concatenate([grid_stretches.ravel(), random.uniform(0, 1, RANDOM_POINTS)])
+    return angles, stretches
+
+
+def compute_solution(settings, angles, stretches, command):
+    simulator = manifold.SolutionManifold(settings, native=False, command=command)
+    try:
+        return numpy.asarray(simulator.closest_approach_batch(angles, stretches), dtype=numpy.float64)
+    finally:
+        simulator.close_process()
+
+
+def main(arguments):
+    check = "--check" in arguments
+    command = [argument for argument in arguments if argument != "--check"] or manifold.COMPUTE_SOLUTION_COMMAND
+
+    random = numpy.random.RandomState(SEED)
+    output = {"settings": [], "variant": [], "angles": [], "stretches": [], "cpa": []}
+    for number, settings in enumerate(reference_settings()):
+        angles, stretches = reference_points(random)
+        output["settings"].append(json.dumps(settings, sort_keys=True))
+        output["variant"].append(numpy.full(len(angles), number, dtype=numpy.int8))
+        output["angles"].append(angles)
+        output["stretches"].append(stretches)
+        output["cpa"].append(compute_solution(settings, angles, stretches, command))
+
+    arrays = dict((key, numpy.concatenate(values)) for key, values in output.items() if key != "settings")
+    arrays["settings"] = numpy.array(output["settings"])
+
+    if check:
+        with numpy.load(REFERENCE) as archive:
+            for key in ("settings", "variant", "angles", "stretches"):
+                if not numpy.array_equal(archive[key], arrays[key]):
+                    raise Exception("The {} of {} differ from the ones generated here".format(key, REFERENCE))
+            print("largest difference", numpy.abs(archive["cpa"] - arrays["cpa"]).max())
+        return
+
+    numpy.savez_compressed(REFERENCE, **arrays)
+    print("wrote", len(arrays["cpa"]), "points to", REFERENCE)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
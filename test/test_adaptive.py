@@ -0,0 +1,77 @@
+"""
+    Tests of the adaptive manifold mapper against the engine it samples.
+"""
+import numpy
+import pytest
+
+from conftest import SETTINGS
+from library import adaptive, simulation
+
+# The test settings without the obstacle, so the manifold has large smooth regions to leave coarse.  The angles stop
+# short of the vertical, where the closest approach flips sign at isolated points no sampling can find.
+OPEN_SETTINGS = dict(SETTINGS, Obstacle={"Position": 200.0, "Top": 0.0, "Bottom": 0.0, "Height": 0.0},
+                     Target={"X": 300.0, "Y": 100.0, "Z": 0.0, "Length": 316.2})
+ANGLE_RANGE = (0.0, 80.0)
+TOLERANCE = 1.0
+
+
+@pytest.fixture(scope="module")
+def mapped():
+    """
+    The adaptive manifold of the open settings, and the engine's answers on its full resolution lattice.
+    """
+    manifold = adaptive.map_manifold(OPEN_SETTINGS, angle_range=ANGLE_RANGE, coarse=(8, 8), max_depth=3,
+                                     tolerance=TOLERANCE)
+    angles, stretches = manifold.lattice_axes()
+    cpa, outcome = simulation.ClosestApproachEngine(OPEN_SETTINGS).simulate_batch(*numpy.meshgrid(angles, stretches))
+    return manifold, cpa, outcome
+
+
+def test_cells_are_refined_at_the_discontinuities(mapped):
+    manifold, cpa, outcome = mapped
+
+    # The lattice cells whose corners disagree in outcome or sign
+    discontinuous = numpy.zeros((cpa.shape[0] - 1, cpa.shape[1] - 1), dtype=bool)
+    for values in (outcome, numpy.sign(cpa)):
+        corners = [values[:-1, :-1], values[:-1, 1:], values[1:, :-1], values[1:, 1:]]
+        for corner in corners[1:]:
+            discontinuous |= corner != corners[0]
+    j, i = numpy.nonzero(discontinuous)
+    assert len(j) > 100
+
+    # Every one of them lies in a leaf of the finest level, while the smooth regions are left coarse
+    size = manifold.find_leaves(i + 0.5, j + 0.5)[2]
+    assert numpy.all(size == 1)
+    stats = manifold.stats()
+    assert stats["leaves_per_level"][0] > 0
+    assert stats["evaluations"] < 0.7 * stats["dense_evaluations"]
+
+
+def test_the_resampled_grid_matches_the_engine(mapped):
+    manifold, cpa, outcome = mapped
+    grid = manifold.to_grid()
+    assert grid.cpa.shape == cpa.shape
+    assert numpy.array_equal(grid.outcome, outcome)
+
+    # The probes of a leaf only bound the error at the probes themselves, so a few points between them are a little
+    # further off than the tolerance
+    errors = numpy.abs(grid.cpa - cpa)
+    assert numpy.percentile(errors, 99) <= TOLERANCE
+    assert errors.max() < 2 * TOLERANCE
+
+    # Between the lattice points the leaves are interpolated too, which only holds up in the leaves which were left
+    # coarse, since the finest leaves may straddle a jump
+    angles = numpy.linspace(5.0, 75.0, 57)
+    stretches = numpy.linspace(0.05, 0.95, 41)
+    between = manifold.to_grid(angles, stretches)
+    grid_angles, grid_stretches = numpy.meshgrid(angles, stretches)
+    assert numpy.array_equal(between.angles, angles) and numpy.array_equal(between.stretches, stretches)
+    assert numpy.array_equal(between.cpa, manifold.lookup(grid_angles, grid_stretches)[0])
+
+    size = manifold.find_leaves((grid_angles.ravel() - ANGLE_RANGE[0]) / manifold.angle_step,
+                                (grid_stretches.ravel() - manifold.stretch_range[0]) / manifold.stretch_step)[2]
+    coarse = size.reshape(grid_angles.shape) > 1
+    errors = numpy.abs(between.cpa - simulation.ClosestApproachEngine(OPEN_SETTINGS).closest_approach_batch(
+        grid_angles, grid_stretches))
+    assert coarse.sum() > errors.size / 2
+    assert errors[coarse].max() < 2 * TOLERANCE
@@ -0,0 +1,84 @@
+"""
+    Tests of the batch cost runner: groups sent to worker processes, and resuming an interrupted table.
+"""
+import os
+import shutil
+
+import pytest
+
+from library import batch, costs, tests
+
+# A quick noise cost, enough to tell the groups apart
+OPTIONS = {"noise": {"steps": 4, "refine": False}}
+
+
+def costs_by_label(table):
+    return dict(zip(table["label"].tolist(), table["noise_cost"].tolist()))
+
+
+def test_libraries_and_filtered_groups_run_in_worker_processes(library_folder, tmp_path):
+    library = tests.TestLibrary(library_folder)
+    assert library.index is not None
+    alice = library.filter({"subject": "Alice"})
+    groups = {"all": library, "alice": alice, "bob": library.filter({"subject": "Bob"}).files}
+
+    table = batch.run_costs(groups, str(tmp_path / "costs.csv"), which="noise", options=OPTIONS, workers=2,
+                            chunk_size=1)
+
+    assert sorted(table["status"].tolist()) == ["ok"] * 3
+    assert dict(zip(table["label"].tolist(), table["points"].tolist())) == {"all": 12, "alice": 6, "bob": 6}
+    expected = dict((label, costs.compute_all_costs(group, "noise", OPTIONS)["noise"]["cost"])
+                    for label, group in groups.items())
+    assert costs_by_label(table) == pytest.approx(expected, abs=1e-9)
+
+
+def test_groups_are_sent_without_their_library():
+    group = tests.TestGroup(["a.json", "b.json"], records={"a.json": {"test_id": 1}, "c.json": {"test_id": 3}})
+    portable = batch._portable(group)
+    assert portable.files == ["a.json", "b.json"] and portable.records == {"a.json": {"test_id": 1}}
+    assert len(portable.headers) == 0
+    assert batch._portable(["a.json"]) == ["a.json"]
+
+
+def test_an_interrupted_table_is_repaired_and_resumed(library_folder, tmp_path, monkeypatch):
+    library = tests.TestLibrary(library_folder, use_index=False)
+    files = sorted(library.files)
+    missing = os.path.join(str(tmp_path), "later.json")
+    groups = {"first": files[:4], "second": files[4:8], "third": files[8:] + [missing]}
+    path = str(tmp_path / "costs.csv")
+
+    computed = []
+    compute_all_costs = costs.compute_all_costs
+
+    def counting(group, *args, **kwargs):
+        computed.append(sorted(group.files if hasattr(group, "files") else group))
+        return compute_all_costs(group, *args, **kwargs)
+
+    monkeypatch.setattr(costs, "compute_all_costs", counting)
+    first = batch.run_costs(groups, path, which="noise", options=OPTIONS, workers=1)
+    assert dict(zip(first["label"].tolist(), first["status"].tolist())) == \
+        {"first": "ok", "second": "ok", "third": "error"}
+
+    # The run was cut off while writing a row, and the file the third group failed on has turned up since
+    with open(path, "ab") as handle:
+        handle.write(b"fourth,")
+    shutil.copy(files[0], missing)
+    del computed[:]
+    resumed = batch.run_costs(groups, path, which="noise", options=OPTIONS, workers=1)
+
+    assert computed == [sorted(groups["third"])]
+    assert dict(zip(resumed["label"].tolist(), resumed["status"].tolist())) == \
+        {"first": "ok", "second": "ok", "third": "ok"}
+    assert costs_by_label(resumed)["first"] == costs_by_label(first)["first"]
+    with open(path) as handle:
+        lines = handle.read().splitlines()
+    assert len(lines) == 5 and not any(line.startswith("fourth") for line in lines)
+
+    with pytest.raises(Exception):
+        batch.run_costs(groups, path, which=("noise", "covariation"), workers=1)
+
+    del computed[:]
+    batch.run_costs(groups, path, which="noise", options=OPTIONS, workers=1, resume=False)
+    assert len(computed) == 3
+    with open(path) as handle:
+        assert len(handle.read().splitlines()) == 4
@@ -0,0 +1,51 @@
+"""
+    Tests of the columnar view of a TestGroup.
+"""
+import os
+
+from conftest import make_test, write_test
+from library import tests
+
+
+def baseline_list_of_key(group, key):
+    """ The list of a key as get_list_of_key built it by loading every file. """
+    extracted = []
+    for item in group.files:
+        data = tests.load_test_file(item)
+        if data is not None and key in data:
+            extracted.append((data['timestamp'], item, data[key]))
+    extracted.sort()
+    return tuple(value for timestamp, item, value in extracted), tuple(item for timestamp, item, value in extracted)
+
+
+def test_columns_follow_rewritten_files(library_folder):
+    library = tests.TestLibrary(library_folder)
+    angles = library.to_columns(['release_angle'])['release_angle']
+    assert angles[library.files.index(os.path.join(library_folder, "Test id3.json"))] == 33.0
+
+    files = list(library.files)
+    write_test(library_folder, make_test(3, angle=45.125, note="rewritten"))
+    library.update_library()
+    assert library.files == files
+
+    columns = library.to_columns(['release_angle', 'note'])
+    row = library.files.index(os.path.join(library_folder, "Test id3.json"))
+    assert columns['release_angle'][row] == 45.125
+    assert columns.decode('note', [row]) == ["rewritten"]
+
+
+def test_list_of_key_keeps_values_as_loaded(library_folder):
+    write_test(library_folder, make_test(12, release_time=1500, attempt=None))
+    write_test(library_folder, make_test(13, release_time=1520, attempt=2))
+    write_test(library_folder, make_test(14, release_time=1525.5))
+    for use_index in (False, True):
+        library = tests.TestLibrary(library_folder, use_index=use_index)
+        for key in ('release_time', 'attempt', 'test_id', 'outcome', 'release_angle'):
+            values, files = library.get_list_of_key(key)
+            expected = baseline_list_of_key(library, key)
+            assert (values, files) == expected
+            assert [type(value) for value in values] == [type(value) for value in expected[0]]
+
+    values, files = library.get_list_of_key('attempt')
+    assert values == (None, 2)
+    assert [type(value) for value in library.get_list_of_key('release_time')[0]] == [int, int, float]
@@ -0,0 +1,174 @@
+"""
+    Tests of the cost analyses against the original algorithms, which are reproduced here as they were written (one
+    simulation per point through a MemoizedSimulator on a cache of their own).
+"""
+import shutil
+
+import numpy
+import pytest
+
+from conftest import SETTINGS, make_test, write_test
+from library import costs, evaluation_cache, manifold, tests, vector
+
+
+def baseline_simulator(test_data):
+    return evaluation_cache.MemoizedSimulator(manifold.SolutionManifold(test_data[0]['settings']),
+                                              manifold.get_manifold_token(test_data[0]),
+                                              evaluation_cache.EvaluationCache())
+
+
+def baseline_noise_cost(test_data):
+    simulator = baseline_simulator(test_data)
+    release_points = [vector.Vector(data['release_angle'], data['release_stretch'], 0) for data in test_data]
+    n = len(release_points)
+    mean_point = vector.get_average_point(release_points)
+    initial_score = sum(abs(simulator.get_closest_approach(v.x, v.y)) for v in release_points) / n
+    mean_vectors = [point - mean_point for point in release_points]
+
+    total_results = []
+    for scale in range(100):
+        scale_factor = scale / 100.0
+        scaled_distribution = [mean_point + v.unit() * (scale_factor * v.length()) for v in mean_vectors]
+        results = [abs(simulator.get_closest_approach(v.x, v.y)) for v in scaled_distribution]
+        total_results.append([sum(results) / n, scale_factor, scaled_distribution])
+
+    final_score, scale_factor, distribution = min(total_results)
+    return {"cost": initial_score - final_score,
+            "initial_score": initial_score,
+            "final_score": final_score,
+            "scale": scale_factor,
+            "shifted_points": [(v.x, v.y) for v in distribution]}
+
+
+def baseline_covariation_cost(test_data):
+    simulator = baseline_simulator(test_data)
+    distribution = []
+    for data in test_data:
+        score = abs(simulator.get_closest_approach(data['release_angle'], data['release_stretch']))
+        distribution.append({"a": data['release_angle'], "s": data['release_stretch'], "score": score})
+    distribution.sort(key=lambda x: x['score'])
+
+    n = len(distribution) - 1
+    pre_optimized_score = sum([x['score'] for x in distribution]) / len(distribution)
+    while n > 0:
+        profitable = 0
+        offset = 1
+        while n - offset >= 0:
+            initial_score = distribution[n]['score'] + distribution[n - offset]['score']
+            d = [dict(pair) for pair in distribution]
+            d[n]['s'], d[n - offset]['s'] = d[n - offset]['s'], d[n]['s']
+            d[n]['score'] = abs(simulator.get_closest_approach(d[n]['a'], d[n]['s']))
+            d[n - offset]['score'] = abs(simulator.get_closest_approach(d[n - offset]['a'], d[n - offset]['s']))
+            if d[n]['score'] + d[n - offset]['score'] < initial_score:
+                profitable += 1
+                distribution = [dict(pair) for pair in d]
+            offset += 1
+        if not profitable:
+            break
+        n -= 1
+
+    post_optimized_score = sum([x['score'] for x in distribution]) / len(distribution)
+    return {"initial_score": pre_optimized_score,
+            "final_score": post_optimized_score,
+            "cost": pre_optimized_score - post_optimized_score,
+            "shifted_points": [(x['a'], x['s']) for x in distribution]}
+
+# A target in front of the obstacle and close enough that the throws are short, which keeps the one at a time
+# simulations of the original algorithms quick
+COST_SETTINGS = dict(SETTINGS, Obstacle={"Position": 200.0, "Top": 0.0, "Bottom": 0.0, "Height": 0.0},
+                     Target={"X": 300.0, "Y": 100.0, "Z": 0.0, "Length": 316.2})
+
+
+@pytest.fixture
+def cost_group(tmp_path):
+    """
+    Twelve throws scattered around a hit.
+    """
+    random = numpy.random.RandomState(3)
+    for number in range(12):
+        write_test(tmp_path, make_test(number, angle=float(random.normal(22.0, 2.0)),
+                                       stretch=float(random.normal(0.48, 0.02)), settings=COST_SETTINGS))
+    return tests.TestLibrary(str(tmp_path), use_index=False)
+
+
+def assert_close(value, expected):
+    assert abs(value - expected) <= 1e-12 * max(1.0, abs(expected))
+
+
+def test_noise_cost_matches_the_original(cost_group):
+    expected = baseline_noise_cost(cost_group.get_data_list())
+    evaluation_cache.EVALUATION_CACHE.invalidate()
+    result = costs.compute_noise_cost(cost_group, refine=False)
+
+    assert expected["cost"] > 0 and 0 < expected["scale"] < 1
+    for key in ("cost", "initial_score", "final_score"):
+        assert_close(result[key], expected[key])
+    assert result["scale"] == expected["scale"]
+    assert numpy.abs(numpy.array(result["shifted_points"]) - numpy.array(expected["shifted_points"])).max() < 1e-12
+
+    refined = costs.compute_noise_cost(cost_group)
+    assert refined["final_score"] <= result["final_score"]
+    assert abs(refined["scale"] - result["scale"]) <= 1.0 / costs.NOISE_STEPS
+
+
+# The best tolerance cost of the cost group, as found by the basin-hopping search with numpy seeds 0 and 1 (which takes
+# too long to run here)
+BASIN_HOPPING_TOLERANCE_COST = 7.30048
+
+
+def test_fast_tolerance_cost_searches_what_basin_hopping_does(cost_group):
+    result = costs.compute_tolerance_cost(cost_group, fast=True)
+    assert abs(result["cost"] - BASIN_HOPPING_TOLERANCE_COST) < 1e-3
+
+    region = ((COST_SETTINGS['AngleMinimum'], COST_SETTINGS['AngleMaximum']),
+              (COST_SETTINGS['StretchMinimum'], COST_SETTINGS['StretchMaximum']))
+    restricted = costs.compute_tolerance_cost(cost_group, fast=True, region=region)
+    assert restricted["cost"] < result["cost"] - 1.0
+
+
+def test_covariation_cost_matches_the_original(cost_group):
+    expected = baseline_covariation_cost(cost_group.get_data_list())
+    evaluation_cache.EVALUATION_CACHE.invalidate()
+    result = costs.compute_covariation_cost(cost_group)
+
+    assert expected["cost"] > 0
+    for key in ("cost", "initial_score", "final_score"):
+        assert_close(result[key], expected[key])
+    assert result["shifted_points"] == expected["shifted_points"]
+
+
+def test_exact_covariation_cost_bypasses_the_cache(cost_group):
+    greedy = costs.compute_covariation_cost(cost_group)
+    entries = evaluation_cache.EVALUATION_CACHE.stats()["entries"]
+    exact = costs.compute_covariation_cost(cost_group, exact=True)
+
+    assert evaluation_cache.EVALUATION_CACHE.stats()["entries"] == entries
+    assert exact["evaluations"]["misses"] >= 12 * 12
+    assert exact["final_score"] <= greedy["final_score"] + 1e-12
+    assert sorted(stretch for _, stretch in exact["shifted_points"]) == \
+        sorted(stretch for _, stretch in greedy["shifted_points"])
+
+
+def test_simulator_evaluations_count_the_points_simulated(cost_group, tmp_path, monkeypatch):
+    # Every throw twice over, so each batch of the search holds every point twice
+    folder = tmp_path / "twice"
+    folder.mkdir()
+    for number, path in enumerate(cost_group.files):
+        shutil.copy(path, str(folder / "{}a.json".format(number)))
+        shutil.copy(path, str(folder / "{}b.json".format(number)))
+    group = tests.TestLibrary(str(folder), use_index=False)
+
+    simulated = []
+    closest_approach_batch = manifold.SolutionManifold.closest_approach_batch
+
+    def counting(self, angles, stretches):
+        simulated.append(numpy.broadcast(angles, stretches).size)
+        return closest_approach_batch(self, angles, stretches)
+
+    monkeypatch.setattr(manifold.SolutionManifold, "closest_approach_batch", counting)
+    evaluation_cache.EVALUATION_CACHE.invalidate()
+    result = costs.compute_tolerance_cost(group, fast=True, budget=5)
+
+    # The first batch scores the distribution before the search starts
+    assert simulated[0] == 12
+    assert result["simulator_evaluations"] == sum(simulated[1:])
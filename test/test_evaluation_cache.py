@@ -0,0 +1,98 @@
+"""
+    Tests of the EvaluationCache and of the counting of the MemoizedSimulator.
+"""
+import numpy
+
+from library import evaluation_cache
+
+
+class CountingSimulator:
+    """
+    A stand-in for a SolutionManifold whose closest approach is angle + stretch, recording the batches it is given.
+    """
+
+    def __init__(self):
+        self.batches = []
+
+    def closest_approach_batch(self, angles, stretches):
+        self.batches.append(len(angles))
+        return numpy.asarray(angles) + numpy.asarray(stretches)
+
+    def get_closest_approach(self, angle, stretch):
+        self.batches.append(1)
+        return angle + stretch
+
+
+def test_lookup_finds_the_stored_points():
+    cache = evaluation_cache.EvaluationCache(angle_step=0.1, stretch_step=0.1)
+    angle_keys, stretch_keys = cache.quantize([1.0, 2.0, 3.0], [0.5, 0.5, 0.5])
+    cache.store("a", angle_keys[:2], stretch_keys[:2], [10.0, 20.0])
+    cache.store("b", angle_keys[2:], stretch_keys[2:], [30.0])
+
+    results = cache.lookup("a", angle_keys, stretch_keys)
+    assert results[:2].tolist() == [10.0, 20.0] and numpy.isnan(results[2])
+    assert cache.get("b", 3.01, 0.5) == 30.0
+    assert cache.get("b", 1.0, 0.5) is None
+    assert cache.stats()["hits"] == 3 and cache.stats()["misses"] == 2
+
+    cache.put("a", 1.0, 0.5, 11.0)
+    assert cache.get("a", 1.0, 0.5) == 11.0 and len(cache) == 3
+    cache.invalidate("a")
+    assert len(cache) == 1 and cache.get("a", 2.0, 0.5) is None
+
+
+def test_the_least_recently_used_points_are_evicted():
+    cache = evaluation_cache.EvaluationCache(max_entries=3, angle_step=1.0, stretch_step=1.0)
+    cache.put("a", 1, 0, 1.0)
+    cache.put("b", 2, 0, 2.0)
+    cache.put("a", 3, 0, 3.0)
+    assert cache.get("a", 1, 0) == 1.0
+    cache.put("b", 4, 0, 4.0)
+
+    assert cache.get("b", 2, 0) is None
+    assert [cache.get("a", 1, 0), cache.get("a", 3, 0), cache.get("b", 4, 0)] == [1.0, 3.0, 4.0]
+    assert cache.stats()["evictions"] == 1 and len(cache) == 3
+
+
+def test_save_and_load_keep_the_order_of_use(tmp_path):
+    path = str(tmp_path / "evaluations.npz")
+    cache = evaluation_cache.EvaluationCache(angle_step=1.0, stretch_step=1.0, path=path)
+    for angle in range(4):
+        cache.put("a" if angle % 2 else "b", angle, 0, float(angle))
+    cache.get("b", 0, 0)
+    cache.save()
+
+    loaded = evaluation_cache.EvaluationCache(max_entries=3, angle_step=1.0, stretch_step=1.0, path=path)
+    assert len(loaded) == 3 and loaded.get("a", 1, 0) is None
+    assert [loaded.get("b", 0, 0), loaded.get("b", 2, 0), loaded.get("a", 3, 0)] == [0.0, 2.0, 3.0]
+
+    other = evaluation_cache.EvaluationCache(angle_step=0.5, stretch_step=1.0)
+    assert not other.load(path) and len(other) == 0
+
+
+def test_repeated_points_are_simulated_and_counted_once():
+    engine = CountingSimulator()
+    simulator = evaluation_cache.MemoizedSimulator(engine, "a", evaluation_cache.EvaluationCache(stretch_step=1e-3))
+    angles = numpy.array([1.0, 2.0, 1.0, 3.0, 2.0, 1.0])
+    stretches = numpy.array([0.5, 0.5, 0.5, 0.5, 0.5, 0.5])
+
+    assert simulator.closest_approach_batch(angles, stretches).tolist() == (angles + stretches).tolist()
+    assert engine.batches == [3]
+    assert simulator.stats()["misses"] == 3 and simulator.stats()["hits"] == 3
+
+    simulator.closest_approach_batch(angles[:, None], numpy.array([0.5, 0.75])[None, :])
+    assert engine.batches == [3, 3]
+    assert simulator.stats()["misses"] == 6 and simulator.stats()["hits"] == 3 + 9
+
+
+def test_uncached_batches_are_simulated_and_counted_without_the_cache():
+    engine = CountingSimulator()
+    cache = evaluation_cache.EvaluationCache()
+    simulator = evaluation_cache.MemoizedSimulator(engine, "a", cache)
+    simulator.closest_approach_batch([1.0], [0.5])
+
+    results = simulator.closest_approach_batch_uncached(numpy.array([1.0, 2.0])[:, None], numpy.array([0.5, 0.5, 0.75]))
+    assert results.shape == (2, 3) and results[1, 2] == 2.75
+    assert engine.batches == [1, 2]
+    assert simulator.stats()["misses"] == 1 + 6 and simulator.stats()["hits"] == 0
+    assert len(cache) == 1 and cache.stats()["misses"] == 1
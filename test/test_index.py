@@ -0,0 +1,84 @@
+"""
+    Tests of the persistent library index and the header table.
+"""
+import os
+
+from conftest import SETTINGS, make_test, write_test
+from library import index, tests
+
+
+def test_library_with_incomplete_settings(library_folder):
+    settings = dict(SETTINGS)
+    del settings["Gravity"]
+    path = write_test(library_folder, make_test(20, settings=settings))
+
+    library = tests.TestLibrary(library_folder)
+    assert path in library.files
+    assert library.headers[path]["manifold_token"] is None
+    assert len(library.group_by_manifold()) == 1
+
+    reopened = tests.TestLibrary(library_folder)
+    assert reopened.headers[path]["manifold_token"] is None
+    assert set(reopened.files) == set(library.files)
+
+
+def test_incomplete_settings_filter_and_snapshot(library_folder, tmp_path_factory):
+    settings = dict(SETTINGS)
+    del settings["Gravity"]
+    path = write_test(library_folder, make_test(20, settings=settings))
+    library = tests.TestLibrary(library_folder, use_index=False)
+    complete = os.path.join(library_folder, "Test id0.json")
+    token = index.manifold_token(tests.load_test_file(complete))
+
+    # Without an index every condition goes through the lazy path, which opens the files
+    assert sorted(library.filter({"manifold_token": token}).files) == sorted(set(library.files) - {path})
+    assert library.filter({"manifold_token": None}).files == [path]
+
+    archive = os.path.join(str(tmp_path_factory.mktemp("snapshot")), "group.npz")
+    library.save_to_file(archive)
+    restored = tests.TestGroup().load_from_file(archive)
+    assert restored.headers[path]["manifold_token"] is None
+    assert restored.headers[complete]["manifold_token"] == token
+
+
+def test_index_keeps_header_types(library_folder):
+    path = write_test(library_folder, make_test(20, test_id=12345, closest_approach=7))
+    expected = tests.load_test_file(path)
+
+    for attempt in range(2):
+        library = tests.TestLibrary(library_folder)
+        header = library.headers[path]
+        for field, column_type in index.HEADER_FIELDS:
+            assert header[field] == expected[field]
+            assert type(header[field]) is type(expected[field])
+        assert library.filter({"test_id": 12345}).files == [path]
+        assert library.filter({"test_id": "12345"}).files == []
+
+
+def test_header_table_mutation_resets_lookups():
+    table = index.HeaderTable({"a": {"subject": "Alice"}, "b": {"subject": "Bob"}})
+    assert table.lookup("subject", "Alice") == {"a"}
+
+    table.setdefault("c", {"subject": "Alice"})
+    assert table.lookup("subject", "Alice") == {"a", "c"}
+    table.pop("a")
+    assert table.lookup("subject", "Alice") == {"c"}
+    path, header = table.popitem()
+    assert table.lookup("subject", header["subject"]) == set()
+
+
+def test_filter_checks_only_the_indexed_candidates(library_folder):
+    library = tests.TestLibrary(library_folder)
+    extra = write_test(library_folder, make_test(12, subject="Alice", outcome="hit"))
+    group = tests.TestGroup(library.files + [extra], library.headers)
+
+    hits = group.filter({'subject': 'Alice', 'outcome': 'hit', 'release_angle': lambda angle: angle > 31.0})
+    names = [os.path.basename(item) for item in hits.files]
+    assert names == ["Test id3.json", "Test id12.json"]
+    assert hits.filter_stats["candidates"] == 3
+    assert hits.filter_stats["header_checks"] == 2
+    assert hits.filter_stats["opened"] == 1
+
+    unindexed = tests.TestLibrary(library_folder, use_index=False)
+    for conditions in ({'subject': 'Bob'}, {'subject': 'Bob', 'outcome': 'miss'}, {'outcome': 'lost'}):
+        assert library.filter(conditions).files == unindexed.filter(conditions).files
@@ -0,0 +1,97 @@
+"""
+    Tests of the live ingest mode of a TestLibrary.
+"""
+import os
+import threading
+
+from conftest import make_test, write_test
+from library import index, ingest, tests
+
+
+def test_poll_indexes_only_the_files_picked_up(library_folder, monkeypatch):
+    library = tests.TestLibrary(library_folder)
+    watcher = library.watch()
+    summary = watcher.subscribe(ingest.RunningSummary())
+
+    calls = []
+    monkeypatch.setattr(index.LibraryIndex, "headers", lambda self: calls.append(self) or {})
+    added = write_test(library_folder, make_test(12, subject="Carol"))
+    changed = write_test(library_folder, make_test(3, outcome="obstacle", note="rewritten"))
+    removed = os.path.join(library_folder, "Test id5.json")
+    os.remove(removed)
+
+    events = sorted((event, path) for event, path, header in watcher.poll())
+    assert events == sorted([("added", added), ("changed", changed), ("removed", removed)])
+    assert calls == []
+    assert summary.summary()["count"] == 12
+    monkeypatch.undo()
+
+    assert library.headers[changed]["outcome"] == "obstacle"
+    assert removed not in library.files and removed not in library.headers
+    assert library.filter({"subject": "Carol"}).files == [added]
+
+    reopened = tests.TestLibrary(library_folder)
+    assert sorted(reopened.files) == sorted(library.files)
+    for path in reopened.files:
+        assert reopened.headers[path] == library.headers[path]
+
+
+def test_background_watcher_with_readers(library_folder):
+    library = tests.TestLibrary(library_folder)
+    watcher = library.watch(interval=0.001).start()
+    failures = []
+
+    def read():
+        try:
+            for attempt in range(200):
+                columns = library.to_columns(['subject', 'timestamp'])
+                assert len(columns['subject']) == len(columns.files)
+                library.filter({"subject": "Alice"})
+        except Exception as e:
+            failures.append(e)
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    for number in range(12, 60):
+        write_test(library_folder, make_test(number))
+    reader.join()
+    watcher.poll()
+    watcher.stop()
+
+    assert failures == [] and watcher.failure is None
+    assert len(library.files) == 60
+    assert len(library.filter({"subject": "Alice"}).files) == 54
+
+
+def test_watcher_starts_from_the_index(library_folder):
+    tests.TestLibrary(library_folder)
+    tests.RECORD_CACHE.invalidate()
+    tests.HEADER_CACHE.invalidate()
+    library = tests.TestLibrary(library_folder)
+    misses = tests.HEADER_CACHE.stats()["misses"]
+
+    watcher = library.watch()
+    summary = watcher.subscribe(ingest.RunningSummary())
+    assert tests.HEADER_CACHE.stats()["misses"] == misses
+    assert summary.summary()["count"] == 12
+    assert watcher.poll() == []
+
+    changed = write_test(library_folder, make_test(3, outcome="obstacle"))
+    assert [(event, path) for event, path, header in watcher.poll()] == [("changed", changed)]
+    assert summary.summary()["obstacles"] == 1
+    assert summary.summary()["count"] == 12
+
+
+def test_subscribe_after_the_library_grew(library_folder):
+    for use_index in (True, False):
+        library = tests.TestLibrary(library_folder, use_index=use_index)
+        watcher = library.watch()
+        added = write_test(library_folder, make_test(20 if use_index else 21, subject="Carol"))
+        library.update_library()
+
+        summary = watcher.subscribe(ingest.RunningSummary())
+        assert summary.summary()["count"] == len(library.files) - 1
+        assert [(event, path) for event, path, header in watcher.poll()] == [("added", added)]
+        assert summary.summary()["count"] == len(library.files)
+        assert "Carol" in summary.summary()["subjects"]
+        assert len(set(library.files)) == len(library.files)
@@ -0,0 +1,101 @@
+"""
+    Tests of the ManifoldInterpolator against the engine it stands in for.
+"""
+import numpy
+import pytest
+
+from conftest import SETTINGS
+from library import interpolation, manifold, simulation
+
+
+class RecordingEngine:
+    """
+    The engine for the test settings, recording every point it is asked to simulate.
+    """
+
+    def __init__(self):
+        self.engine = simulation.ClosestApproachEngine(SETTINGS)
+        self.points = []
+
+    def closest_approach_batch(self, angles, stretches):
+        angles, stretches = numpy.broadcast_arrays(angles, stretches)
+        self.points.extend(zip(angles.ravel().tolist(), stretches.ravel().tolist()))
+        return self.engine.closest_approach_batch(angles, stretches)
+
+
+@pytest.fixture(scope="module")
+def grid():
+    """
+    The manifold of the test settings on a grid of one degree by 0.02 of stretch.
+    """
+    angles = numpy.linspace(0.0, 90.0, 91)
+    stretches = numpy.linspace(0.0, 1.0, 51)
+    cpa, outcome = simulation.ClosestApproachEngine(SETTINGS).simulate_batch(*numpy.meshgrid(angles, stretches))
+    return manifold.ManifoldGrid(angles, stretches, cpa, outcome.astype(numpy.int8))
+
+
+def points_in_cells(interpolator, cells, per_cell=20, seed=0):
+    """
+    Return random angles and stretches inside each of a list of (stretch, angle) cells.
+    """
+    random = numpy.random.RandomState(seed)
+    j, i = numpy.repeat(numpy.array(cells).reshape(-1, 2), per_cell, axis=0).T
+    angles = interpolator.angles[i] + random.uniform(0.0, 1.0, len(i)) * (interpolator.angles[i + 1] -
+                                                                            interpolator.angles[i])
+    stretches = interpolator.stretches[j] + random.uniform(0.0, 1.0, len(j)) * (interpolator.stretches[j + 1] -
+                                                                                  interpolator.stretches[j])
+    return angles, stretches
+
+
+@pytest.mark.parametrize("method", interpolation.METHODS)
+def test_smooth_cells_are_interpolated_within_the_tolerance(grid, method):
+    engine = RecordingEngine()
+    interpolator = interpolation.ManifoldInterpolator(grid, engine, method=method, tolerance=1.0, verify=True)
+    del engine.points[:]
+
+    # The smoothest cell is interpolated within its error estimate, without asking the engine
+    cell = numpy.unravel_index(numpy.argmin(numpy.where(interpolator.exact, numpy.inf, interpolator.cell_error)),
+                               interpolator.exact.shape)
+    angles, stretches = points_in_cells(interpolator, [cell])
+    errors = numpy.abs(interpolator.closest_approach_batch(angles, stretches) -
+                       engine.engine.closest_approach_batch(angles, stretches))
+    assert errors.max() <= interpolator.cell_error[cell] + 1e-9
+    assert engine.points == [] and interpolator.stats()["interpolated"] == len(angles)
+
+    # Over the whole grid the probes don't bound the error exactly, but they keep it close to the tolerance
+    random = numpy.random.RandomState(1)
+    angles, stretches = random.uniform(0.0, 90.0, 5000), random.uniform(0.0, 1.0, 5000)
+    j, i = interpolator.locate(angles, stretches)[:2]
+    smooth = ~interpolator.exact[j, i]
+    errors = numpy.abs(interpolator.closest_approach_batch(angles, stretches) -
+                       engine.engine.closest_approach_batch(angles, stretches))
+    assert smooth.sum() > 1000
+    assert errors[smooth].max() < 2.0
+    assert numpy.all(errors[~smooth] == 0.0)
+
+
+@pytest.mark.parametrize("method", interpolation.METHODS)
+def test_discontinuous_cells_fall_back_to_the_engine(grid, method):
+    engine = RecordingEngine()
+    interpolator = interpolation.ManifoldInterpolator(grid, engine, method=method)
+    assert engine.points == []
+
+    # Cells whose corners disagree in outcome or sign, along with a point beyond each edge of the grid
+    cells = numpy.argwhere(interpolator.discontinuous)
+    assert 0 < len(cells) < interpolator.discontinuous.size
+    angles, stretches = points_in_cells(interpolator, cells, per_cell=2)
+    angles = numpy.concatenate([angles, [-1.0, 91.0, 45.0, 45.0]])
+    stretches = numpy.concatenate([stretches, [0.5, 0.5, -0.1, 1.1]])
+
+    results = interpolator.closest_approach_batch(angles, stretches)
+    assert numpy.array_equal(results, engine.engine.closest_approach_batch(angles, stretches))
+    assert engine.points == list(zip(angles.tolist(), stretches.tolist()))
+    assert interpolator.stats()["simulated"] == len(angles) and interpolator.stats()["interpolated"] == 0
+    assert numpy.all(interpolator.error_estimate(angles, stretches) == 0.0)
+
+    # Interpolating across the corners of those cells instead would be far off
+    j, i, t_stretch, t_angle = interpolator.locate(angles[:-4], stretches[:-4])[:4]
+    f = interpolator.cpa
+    across = ((f[j, i] * (1 - t_angle) + f[j, i + 1] * t_angle) * (1 - t_stretch) +
+              (f[j + 1, i] * (1 - t_angle) + f[j + 1, i + 1] * t_angle) * t_stretch)
+    assert numpy.abs(across - results[:-4]).max() > 10.0
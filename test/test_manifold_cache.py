@@ -0,0 +1,68 @@
+"""
+    Tests of the manifold cache shared between processes.
+"""
+import contextlib
+import threading
+import time
+
+import pytest
+
+from library import manifold
+
+
+def small_manifold(offset=0.0):
+    return dict(((a, s), {"angle": a, "stretch": s, "cpa": a * s + offset, "outcome": "miss"})
+                for a in (0.0, 45.0, 90.0) for s in (0.0, 0.5, 1.0))
+
+
+class PrunedOnReleaseCache(manifold.ManifoldCache):
+    """ A cache which is pruned to nothing by another process the moment any of its locks is released. """
+
+    @contextlib.contextmanager
+    def lock(self, token, timeout=None):
+        with manifold.ManifoldCache.lock(self, token, timeout):
+            yield
+        manifold.ManifoldCache(self.folder, max_bytes=0).prune()
+
+
+def test_get_or_create_returns_the_generated_manifold(tmp_path):
+    cache = PrunedOnReleaseCache(str(tmp_path))
+    grid = cache.get_or_create("token", small_manifold)
+    assert grid is not False
+    assert grid[(45.0, 0.5)]["cpa"] == 22.5
+    assert cache.generated == 1
+
+
+def test_get_or_create_loads_an_existing_manifold(tmp_path):
+    cache = manifold.ManifoldCache(str(tmp_path))
+    cache.save("token", small_manifold(1.0))
+    assert cache.get_or_create("token", lambda: pytest.fail("generated again"))[(90.0, 1.0)]["cpa"] == 91.0
+    assert cache.generated == 0
+
+
+def test_held_lock_is_kept_fresh(tmp_path):
+    holder = manifold.ManifoldCache(str(tmp_path), stale_after=0.4)
+    waiter = manifold.ManifoldCache(str(tmp_path), stale_after=0.4)
+    held = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with holder.lock("token"):
+            held.set()
+            release.wait()
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    held.wait()
+    try:
+        start = time.time()
+        with pytest.raises(Exception, match="Timed out"):
+            with waiter.lock("token", timeout=1.2):
+                pass
+        assert time.time() - start >= 1.2
+    finally:
+        release.set()
+        thread.join()
+
+    with waiter.lock("token", timeout=1.0):
+        pass
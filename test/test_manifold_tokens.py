@@ -0,0 +1,66 @@
+"""
+    Tests of the manifold tokens kept for test files and the grouping and validation built on them.
+"""
+import copy
+import json
+import os
+
+import pytest
+
+from conftest import SETTINGS, make_test, write_test
+from library import manifold, tests
+
+
+def test_records_are_the_test_files(library_folder):
+    path = os.path.join(library_folder, "Test id0.json")
+    with open(path) as handle:
+        keys = set(json.load(handle).keys())
+    record = tests.load_test_file(path)
+    assert set(record.keys()) == keys
+    assert set(tests.load_test_header(path).keys()) == keys - set(tests.HEAVY_FIELDS)
+
+    library = tests.TestLibrary(library_folder)
+    assert set(library.get_data_list()[0].keys()) == keys
+    assert len(library.filter({"manifold_token": manifold.generate_manifold_token(record)}).files) == 12
+
+
+def test_edited_settings_give_a_new_token(library_folder):
+    record = copy.deepcopy(tests.load_test_file(os.path.join(library_folder, "Test id0.json")))
+    token = manifold.get_manifold_token(record)
+    record['settings']['Gravity'] = -0.02
+    assert manifold.get_manifold_token(record) != token
+    assert manifold.get_manifold_token(record) == manifold.generate_manifold_token(record)
+
+
+@pytest.mark.parametrize("use_index", [False, True])
+def test_group_by_manifold(library_folder, use_index):
+    heavier = dict(SETTINGS, Gravity=-0.02)
+    for number in range(12, 15):
+        write_test(library_folder, make_test(number, settings=heavier))
+    library = tests.TestLibrary(library_folder, use_index=use_index)
+
+    groups = library.group_by_manifold()
+    assert sorted(len(group.files) for group in groups.values()) == [3, 12]
+    for token, group in groups.items():
+        assert manifold.validate_same_manifold(group)
+        assert all(manifold.generate_manifold_token(data) == token for data in group.get_data_list())
+    assert not manifold.validate_same_manifold(library)
+
+
+def test_validate_same_manifold_rejects_tests_without_a_token(library_folder):
+    files = sorted(os.path.join(library_folder, name) for name in os.listdir(library_folder))
+    assert manifold.validate_same_manifold(tests.TestGroup(files))
+
+    invalid = os.path.join(library_folder, "notes.json")
+    with open(invalid, "w") as handle:
+        json.dump({"subject": "Alice"}, handle)
+    with pytest.raises(Exception):
+        manifold.validate_same_manifold(tests.TestGroup(files + [invalid]))
+
+    settings = dict(SETTINGS)
+    del settings["Gravity"]
+    incomplete = write_test(library_folder, make_test(20, settings=settings))
+    with pytest.raises(Exception):
+        manifold.validate_same_manifold(tests.TestGroup(files + [incomplete]))
+    with pytest.raises(Exception):
+        manifold.validate_same_manifold(tests.TestLibrary(library_folder))
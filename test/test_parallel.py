@@ -0,0 +1,50 @@
+"""
+    Tests of loading test files with a pool of worker processes.
+"""
+import os
+
+import pytest
+
+from conftest import make_test, write_test
+from library import parallel, tests
+
+
+@pytest.fixture
+def mixed_files(library_folder):
+    """
+    The twelve tests of the library folder in reverse order, with a file which isn't valid json, a missing file and a
+    json file which isn't a test mixed in.
+    """
+    files = sorted(os.path.join(library_folder, name) for name in os.listdir(library_folder))[::-1]
+    broken = os.path.join(library_folder, "broken.json")
+    with open(broken, "w") as handle:
+        handle.write('{"test_id": "id99", "settings": {')
+    other = write_test(library_folder, {"subject": "Carol"}, name="other.json")
+    files[3:3] = [broken, os.path.join(library_folder, "missing.json"), other]
+    return files, broken
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_load_files_keeps_order_and_reports_failures(mixed_files, workers):
+    files, broken = mixed_files
+    results = parallel.load_files(files, tests.load_test_file, workers=workers, chunk_size=2)
+
+    assert [result.path for result in results] == files
+    for result in results:
+        if result.path == broken:
+            assert result.data is None and "Expecting" in result.error
+            continue
+        assert result.error is None
+        expected = tests.load_test_file(result.path)
+        assert result.data == expected
+        if expected is not None:
+            assert os.path.basename(result.path) == "Test {}.json".format(result.data['test_id'])
+
+
+def test_preload_reports_failed_files(mixed_files):
+    files, broken = mixed_files
+    group = tests.TestGroup(files)
+    errors = group.preload(workers=2)
+
+    assert list(errors) == [broken]
+    assert len([data for data in group.get_data_list() if data is not None]) == 12
@@ -0,0 +1,20 @@
+"""
+    Tests of the cache of parsed test records shared by every TestGroup.
+"""
+from library import tests
+
+
+def test_data_list_copies_are_independent(library_folder):
+    library = tests.TestLibrary(library_folder)
+    data = library.get_data_list()
+    data[0]['subject'] = "Mallory"
+    data[0]['settings']['Gravity'] = 0.0
+
+    reloaded = tests.TestLibrary(library_folder, use_index=False).get_data_list()
+    assert [record['subject'] for record in reloaded].count("Mallory") == 0
+    assert all(record['settings']['Gravity'] == -0.01 for record in reloaded)
+    assert library.get_data_list(shared=True)[0]['subject'] != "Mallory"
+
+    alice = library.filter({'subject': 'Alice'})
+    assert len(alice.files) == 6
+    assert all(record['subject'] == "Alice" for record in alice.get_data_list())
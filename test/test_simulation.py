@@ -0,0 +1,84 @@
+"""
+    Tests of the numpy engine against the closest approaches of ComputeSolution.exe.
+
+    data/compute_solution_reference.npz holds the answers of ComputeSolution.exe for three settings (the defaults, a
+    stronger gravity with a shorter obstacle further out, and a lower, larger target), over a grid and a set of random
+    points each.  It is written, or checked, by data/make_compute_solution_reference.py.
+"""
+import json
+import os
+
+import numpy
+import pytest
+
+from conftest import SETTINGS
+from library import manifold, simulation
+
+REFERENCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "compute_solution_reference.npz")
+
+
+def reference_cases():
+    with numpy.load(REFERENCE) as archive:
+        for number, text in enumerate(archive["settings"].tolist()):
+            rows = archive["variant"] == number
+            yield json.loads(text), archive["angles"][rows], archive["stretches"][rows], archive["cpa"][rows]
+
+
+@pytest.mark.parametrize("case", range(3))
+def test_engine_matches_compute_solution(case):
+    settings, angles, stretches, expected = list(reference_cases())[case]
+    cpa, outcome = simulation.ClosestApproachEngine(settings).simulate_batch(angles, stretches)
+    assert numpy.abs(cpa - expected).max() < 1e-9
+    assert set(numpy.unique(outcome).tolist()) <= {simulation.HIT, simulation.MISS, simulation.OBSTACLE}
+
+
+def test_compare_with_manifold():
+    settings, angles, stretches, expected = list(reference_cases())[0]
+    engine = simulation.ClosestApproachEngine(settings)
+    labels = numpy.array(simulation.OUTCOMES)[engine.simulate_batch(angles, stretches)[1]]
+    points = dict(((a, s), {"angle": a, "stretch": s, "cpa": c, "outcome": label})
+                  for a, s, c, label in zip(angles.tolist(), stretches.tolist(), expected.tolist(), labels.tolist()))
+
+    comparison = engine.compare_with_manifold(manifold.ManifoldGrid.from_points(points))
+    assert comparison["points"] == len(points)
+    assert comparison["max_error"] < 1e-9
+    assert comparison["outcome_agreement"] == 1.0
+
+
+def test_throw_still_in_flight_is_a_miss(monkeypatch):
+    monkeypatch.setattr(simulation, "MAX_FRAMES", 50)
+    settings = dict(SETTINGS, Gravity=0.0)
+    engine = simulation.ClosestApproachEngine(settings)
+    cpa, outcome = engine.simulate_batch([45.0], [0.0])
+    assert outcome.tolist() == [simulation.MISS]
+
+    point = {"angle": 45.0, "stretch": 0.0, "cpa": float(cpa[0]), "outcome": "miss"}
+    assert engine.compare_with_manifold({(45.0, 0.0): point})["outcome_agreement"] == 1.0
+
+
+@pytest.mark.skipif(os.name != "nt", reason="ComputeSolution.exe only runs on Windows")
+def test_compute_solution_process():
+    settings, angles, stretches, expected = list(reference_cases())[0]
+    solution = manifold.SolutionManifold(settings, native=False, command=manifold.COMPUTE_SOLUTION_COMMAND)
+    try:
+        cpa = solution.closest_approach_batch(angles, stretches)
+    finally:
+        solution.close_process()
+    assert numpy.abs(numpy.asarray(cpa) - expected).max() < 1e-9
+
+
+def test_default_simulator_follows_native_default(monkeypatch):
+    assert manifold.NATIVE_DEFAULT == (os.name != "nt" or not os.path.exists(manifold.COMPUTE_SOLUTION_COMMAND[0]))
+
+    monkeypatch.setattr(manifold, "NATIVE_DEFAULT", True)
+    assert manifold.SolutionManifold(SETTINGS).engine is not None
+
+    monkeypatch.setattr(manifold, "NATIVE_DEFAULT", False)
+    monkeypatch.setattr(manifold, "DEFAULT_COMMAND", manifold.STANDIN_COMMAND)
+    solution = manifold.SolutionManifold(SETTINGS)
+    try:
+        assert solution.engine is None and solution.process is not None
+        assert abs(solution.get_closest_approach(30.0, 0.5) -
+                   manifold.SolutionManifold(SETTINGS, native=True).get_closest_approach(30.0, 0.5)) < 1e-9
+    finally:
+        solution.close_process()
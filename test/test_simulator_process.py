@@ -0,0 +1,55 @@
+"""
+    Tests of the python stand-in for ComputeSolution.exe (library/simulator_process.py), run as a separate process over
+    both protocols, against the numpy engine in this process.
+"""
+import os
+
+import numpy
+import pytest
+
+from conftest import SETTINGS
+from library import manifold, simulation
+
+
+def points(count=1500, seed=1):
+    random = numpy.random.RandomState(seed)
+    return random.uniform(0.0, 90.0, count), random.uniform(0.0, 1.0, count)
+
+
+@pytest.mark.parametrize("binary", [False, True])
+@pytest.mark.parametrize("window", [1, 7, manifold.DEFAULT_WINDOW])
+def test_standin_matches_engine(binary, window):
+    # A window of one sends each point on its own, which is slow, so it gets fewer of them
+    angles, stretches = points(100 if window == 1 else 1500)
+    expected = simulation.ClosestApproachEngine(SETTINGS).closest_approach_batch(angles, stretches)
+
+    with manifold.SolutionManifold(SETTINGS, native=False, command=manifold.STANDIN_COMMAND, binary=binary,
+                                   window=window) as simulator:
+        cpa = simulator.closest_approach_batch(angles, stretches)
+        single = simulator.get_closest_approach(angles[0], stretches[0])
+        grid = simulator.closest_approach_batch(angles[:60].reshape(6, 10), stretches[:60].reshape(6, 10))
+        empty = simulator.closest_approach_batch([], [])
+
+    assert numpy.array_equal(cpa, expected)
+    assert single == expected[0]
+    assert numpy.array_equal(grid, expected[:60].reshape(6, 10))
+    assert empty.shape == (0, )
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_standin_pool_matches_engine(binary):
+    angles, stretches = points(seed=2)
+    expected = simulation.ClosestApproachEngine(SETTINGS).closest_approach_batch(angles, stretches)
+    with manifold.SolutionManifoldPool(SETTINGS, workers=2, command=manifold.STANDIN_COMMAND,
+                                       binary=binary) as pool:
+        assert numpy.array_equal(pool.closest_approach_batch(angles, stretches), expected)
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_close_process_reaps_the_standin(binary):
+    simulator = manifold.SolutionManifold(SETTINGS, native=False, command=manifold.STANDIN_COMMAND, binary=binary)
+    simulator.closest_approach_batch(*points(10))
+    simulator.close_process()
+    simulator.close_process()
+    assert simulator.process.returncode == 0
+    assert not os.path.exists(simulator.working_folder)
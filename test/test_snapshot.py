@@ -0,0 +1,77 @@
+"""
+    Tests of saving a TestGroup to a single archive and restoring it.
+"""
+import os
+
+import numpy
+import pytest
+
+from conftest import make_test, write_test
+from library import tests
+
+
+@pytest.fixture
+def snapshot_library(library_folder):
+    """
+    The twelve tests of the library folder along with tests holding extra fields of every kind, and a file which isn't
+    a test.
+    """
+    write_test(library_folder, make_test(12, attempt=3, note=None, reviewed=None, tags=["warm", "up"],
+                                         trace=[[0.0, 1.5], [2.0, 3.25]]))
+    write_test(library_folder, make_test(13, attempt=4, note="late", tags=[], trace=[]))
+    write_test(library_folder, {"subject": "Carol"}, name="other.json")
+    return tests.TestLibrary(library_folder)
+
+
+def test_round_trip_keeps_records_traces_and_headers(snapshot_library, tmp_path):
+    library = snapshot_library
+    path = str(tmp_path / "group.npz")
+    library.save_to_file(path, include_traces=True)
+    restored = tests.TestGroup().load_from_file(path)
+
+    assert restored.files == library.files
+    assert restored.get_data_list() == library.get_data_list()
+    for item in library.files:
+        if item not in library.headers:
+            assert restored.get_data_list()[restored.files.index(item)] is None
+            continue
+        header = library.headers[item]
+        assert dict((key, restored.headers[item][key]) for key in header) == header
+
+    assert restored.get_list_of_key('attempt') == library.get_list_of_key('attempt')
+    assert restored.filter({'subject': 'Bob'}).files == library.filter({'subject': 'Bob'}).files
+    assert restored.summarize() == library.summarize()
+
+
+def test_round_trip_without_traces(snapshot_library, tmp_path):
+    path = str(tmp_path / "group.npz")
+    snapshot_library.save_to_file(path)
+    restored = tests.TestGroup().load_from_file(path)
+
+    expected = snapshot_library.get_data_list()
+    for record in expected:
+        if record is not None:
+            del record['trace']
+    assert restored.get_data_list() == expected
+
+    # The restored group doesn't need the files any more
+    for item in snapshot_library.files:
+        os.remove(item)
+    assert restored.get_data_list() == expected
+
+
+def test_missing_or_stale_snapshot_is_rejected(snapshot_library, tmp_path, monkeypatch):
+    with pytest.raises(IOError):
+        tests.TestGroup().load_from_file(str(tmp_path / "missing.npz"))
+
+    stale = str(tmp_path / "stale.npz")
+    monkeypatch.setattr(tests, "SNAPSHOT_VERSION", tests.SNAPSHOT_VERSION - 1)
+    snapshot_library.save_to_file(stale)
+    monkeypatch.undo()
+    with pytest.raises(Exception, match="not a TestGroup archive"):
+        tests.TestGroup().load_from_file(stale)
+
+    other = str(tmp_path / "other.npz")
+    numpy.savez(other, files=numpy.array(snapshot_library.files))
+    with pytest.raises(Exception, match="not a TestGroup archive"):
+        tests.TestGroup().load_from_file(other)